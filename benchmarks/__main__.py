@@ -0,0 +1,341 @@
+"""
+Offline benchmarks for the bot's hot paths.
+
+Runs entirely against a simulated gateway and a temporary data directory, so no token or network
+access is needed:
+
+    python -m benchmarks [--quick] [--only NAME] [--memory] [--output FILE]
+
+Results are written as JSON so runs can be compared across commits.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable
+
+_scratch = tempfile.mkdtemp(prefix = 'onii-chan-bench-')
+os.environ['DATA_DIR'] = os.path.join(_scratch, 'data')
+os.environ['LOGS_DIR'] = os.path.join(_scratch, 'logs')
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+
+from core.bot import Bot
+from core.handler import JSONHandler
+from core.prefix import get_prefix, invalidate_prefix
+from core.storage import open_record_storage
+
+from .gateway import SimulatedGateway
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+Scenario = Callable[['Benchmark', int], Awaitable[list]]
+
+scenarios: dict[str, tuple[Scenario, tuple, tuple]] = {}
+
+def scenario(name: str, sizes: tuple, quick: tuple = None):
+    """
+    Registers a benchmark run once per size; `quick` narrows the sizes for --quick runs
+    """
+    def decorator(func: Scenario) -> Scenario:
+        scenarios[name] = (func, sizes, quick or sizes[:1])
+        return func
+    return decorator
+
+
+def record(number: int, start: datetime = datetime(2024, 1, 1, tzinfo = timezone.utc)) -> dict:
+    # The layout of `MessageRecord.to_dict`; channel and guild live in the store header
+    return {
+        'id': number,
+        'author': {'id': number % 50, 'name': f'member{number % 50}'},
+        'created_at': (start + timedelta(seconds = number)).isoformat(),
+        'content': f'benchmark message {number} with a few searchable words',
+    }
+
+
+class Benchmark:
+    """
+    Owns the bot and simulated gateway shared by every scenario
+    """
+
+    bot: Bot
+    gateway: SimulatedGateway
+    operations: int
+
+    def __init__(self, operations: int):
+        self.operations = operations
+
+    async def __aenter__(self):
+        self.bot = Bot()
+        await self.bot.__aenter__()
+        await self.bot.load_all_data()
+        self.gateway = SimulatedGateway(self.bot, channels = 100)
+        guild = self.gateway.guilds[0]
+        await self.bot._overwatch_handler.update('Guilds', {guild['id']: [int(channel['id']) for channel in guild['channels']]})
+        await self.bot.reload_all_extensions()
+        self.gateway.install()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.bot.close()
+
+    async def reset_storage(self):
+        for handler in self.bot._message_handlers.values():
+            await handler.close()
+        self.bot._message_handlers.clear()
+        for activity in self.bot._activity.values():
+            await activity.close()
+        self.bot._activity.clear()
+        shutil.rmtree(os.path.join(os.environ['DATA_DIR'], 'overwatch'), ignore_errors = True)
+
+
+async def timed(operation: Callable[[], Awaitable], count: int) -> list:
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        await operation()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+@scenario('overwatch.ingest', sizes = (1, 10, 100))
+async def overwatch_ingest(bench: Benchmark, channels: int) -> list:
+    """
+    Overwatch._handle_message over `channels` watched channels, including the final flush
+    """
+    await bench.reset_storage()
+    cog = bench.bot.get_cog('Overwatch')
+    gateway = bench.gateway
+    messages = [
+        bench.bot._connection.create_message(channel = bench.bot.get_channel(int(channel['id'])), data = gateway.message(channel, gateway.members[number % len(gateway.members)], f'message {number} in the simulated gateway'))
+        for number in range(bench.operations)
+        for channel in [gateway.channels[number % channels]]
+    ]
+    messages = iter(messages)
+    samples = await timed(lambda: cog._handle_message(next(messages)), bench.operations)
+    started = time.perf_counter()
+    for handler in bench.bot._message_handlers.values():
+        await handler.flush()
+    samples[-1] += time.perf_counter() - started
+    return samples
+
+
+@scenario('gateway.message_create', sizes = (1, 100))
+async def gateway_message_create(bench: Benchmark, channels: int) -> list:
+    """
+    Full MESSAGE_CREATE dispatch: parsing, prefix lookup, command processing and every on_message listener
+    """
+    await bench.reset_storage()
+    gateway = bench.gateway
+    payloads = iter([gateway.message(gateway.channels[number % channels], gateway.members[number % len(gateway.members)], f'message {number}') for number in range(bench.operations)])
+    return await timed(lambda: gateway.dispatch('message_create', next(payloads)), bench.operations)
+
+
+@scenario('gateway.message_update', sizes = (1,))
+async def gateway_message_update(bench: Benchmark, channels: int) -> list:
+    """
+    MESSAGE_UPDATE dispatch for messages that are still in the message cache
+    """
+    gateway = bench.gateway
+    payloads = [gateway.message(gateway.channels[number % channels], gateway.members[1], f'message {number}') for number in range(bench.operations)]
+    for payload in payloads:
+        await gateway.dispatch('message_create', payload)
+    edits = iter([gateway.edit(payload, payload['content'] + ' (edited)') for payload in payloads])
+    return await timed(lambda: gateway.dispatch('message_update', next(edits)), bench.operations)
+
+
+@scenario('prefix.get_prefix', sizes = (1, 100))
+async def prefix_lookup(bench: Benchmark, guilds: int) -> list:
+    """
+    get_prefix against a warm cache spread over `guilds` guilds
+    """
+    invalidate_prefix()
+    gateway = bench.gateway
+    channel = bench.bot.get_channel(int(gateway.channels[0]['id']))
+    messages = [bench.bot._connection.create_message(channel = channel, data = gateway.message(gateway.channels[0], gateway.members[1], 'hello')) for _ in range(guilds)]
+    for number, message in enumerate(messages):
+        message.guild = type('Guild', (), {'id': number})()
+    messages = iter(messages * (bench.operations // guilds + 1))
+    return await timed(lambda: get_prefix(bench.bot, next(messages)), bench.operations)
+
+
+@scenario('command.help', sizes = (1,))
+async def command_help(bench: Benchmark, _: int) -> list:
+    """
+    Dispatching the help command end to end, including the embed sent back through the fake REST API
+    """
+    gateway = bench.gateway
+    owner = gateway.members[0]
+    count = max(bench.operations // 20, 10)
+    payloads = iter([gateway.message(gateway.channels[0], owner, '$help') for _ in range(count)])
+    return await timed(lambda: gateway.dispatch('message_create', next(payloads)), count)
+
+
+async def _seeded(bench: Benchmark, backend: str, size: int):
+    await bench.reset_storage()
+    handler = await open_record_storage('overwatch', f'{backend}-{size}', 'id', backend = backend, loop = bench.bot.loop, unique_only = True, time_field = 'created_at')
+    for start in range(0, size, 5000):
+        await handler._run(handler.s_add_many, [record(number) for number in range(start, min(start + 5000, size))])
+    return handler
+
+
+def _storage_scenarios(backend: str):
+    sizes, quick = (1000, 10000, 100000), (1000,)
+
+    @scenario(f'storage.{backend}.open', sizes, quick)
+    async def storage_open(bench: Benchmark, size: int) -> list:
+        handler = await _seeded(bench, backend, size)
+        await handler.close()
+        samples = []
+        for _ in range(5):
+            started = time.perf_counter()
+            handler = await open_record_storage('overwatch', f'{backend}-{size}', 'id', backend = backend, loop = bench.bot.loop, unique_only = True, time_field = 'created_at')
+            await handler._run(handler.s_has, 0)
+            samples.append(time.perf_counter() - started)
+            await handler.close()
+        return samples
+
+    @scenario(f'storage.{backend}.get', sizes, quick)
+    async def storage_get(bench: Benchmark, size: int) -> list:
+        handler = await _seeded(bench, backend, size)
+        keys = iter(range(0, size * bench.operations, size // 7 or 1))
+        try:
+            return await timed(lambda: handler.get('id', next(keys) % size), bench.operations)
+        finally:
+            await handler.close()
+
+    @scenario(f'storage.{backend}.update', sizes, quick)
+    async def storage_update(bench: Benchmark, size: int) -> list:
+        handler = await _seeded(bench, backend, size)
+        count = min(bench.operations, size)
+        updates = iter([{**record(number), 'content': 'edited'} for number in range(count)])
+        async def update():
+            data = next(updates)
+            await handler.update('id', data['id'], data)
+        try:
+            return await timed(update, count)
+        finally:
+            await handler.close()
+
+    @scenario(f'storage.{backend}.remove', sizes, quick)
+    async def storage_remove(bench: Benchmark, size: int) -> list:
+        handler = await _seeded(bench, backend, size)
+        count = min(bench.operations, size)
+        keys = iter(range(count))
+        try:
+            return await timed(lambda: handler.remove('id', next(keys)), count)
+        finally:
+            await handler.close()
+
+    @scenario(f'storage.{backend}.scan', sizes, quick)
+    async def storage_scan(bench: Benchmark, size: int) -> list:
+        handler = await _seeded(bench, backend, size)
+        start = datetime(2024, 1, 1, tzinfo = timezone.utc)
+        async def scan():
+            async for _ in handler.scan(start + timedelta(seconds = size // 2), start + timedelta(seconds = size // 2 + 1000)):
+                pass
+        try:
+            return await timed(scan, 5)
+        finally:
+            await handler.close()
+
+for _backend in ('json', 'sqlite'):
+    _storage_scenarios(_backend)
+
+
+@scenario('document.json', sizes = (100, 10000), quick = (100,))
+async def document_json(bench: Benchmark, size: int) -> list:
+    """
+    JSONHandler get/update pairs on a document with `size` keys, as the prefix and Overwatch config use it
+    """
+    handler = JSONHandler(f'bench-{size}.json', default_data = {str(number): [str(number)] for number in range(size)}, loop = bench.bot.loop)
+    keys = iter(range(bench.operations))
+    async def get_update():
+        key = str(next(keys) % size)
+        await handler.update(key, [*(await handler.get(key) or []), '!'])
+    try:
+        return await timed(get_update, bench.operations)
+    finally:
+        await handler.close()
+
+
+def percentile(samples: list, quantile: float) -> float:
+    return samples[min(int(quantile * len(samples)), len(samples) - 1)]
+
+def peak_rss() -> int:
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+async def run(arguments: argparse.Namespace) -> dict:
+    results = []
+    operations = 200 if arguments.quick else 2000
+    async with Benchmark(operations) as bench:
+        for name, (func, sizes, quick) in scenarios.items():
+            if arguments.only and not name.startswith(arguments.only):
+                continue
+            for size in (quick if arguments.quick else sizes):
+                gc.collect()
+                rss = peak_rss()
+                if arguments.memory:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                samples = sorted(await func(bench, size))
+                elapsed = time.perf_counter() - started
+                result = {
+                    'scenario': name, 'size': size, 'count': len(samples), 'seconds': round(elapsed, 6),
+                    'per_second': round(len(samples) / sum(samples), 1) if sum(samples) else None,
+                    'p50_ms': round(percentile(samples, 0.5) * 1000, 4),
+                    'p95_ms': round(percentile(samples, 0.95) * 1000, 4),
+                    'p99_ms': round(percentile(samples, 0.99) * 1000, 4),
+                    'peak_rss_growth_bytes': peak_rss() - rss,
+                }
+                if arguments.memory:
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    result.update(retained_bytes = current, peak_allocated_bytes = peak)
+                results.append(result)
+                print(f"{name:<28} size={size:<7} n={len(samples):<6} {result['per_second'] or 0:>10.1f}/s  p50={result['p50_ms']:.3f}ms  p95={result['p95_ms']:.3f}ms  p99={result['p99_ms']:.3f}ms", file = sys.stderr)
+        rest_calls = dict(bench.gateway.requests)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'quick': arguments.quick,
+            'rest_calls': rest_calls,
+        },
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks', description = 'Offline benchmarks for the bot hot paths')
+    parser.add_argument('--quick', action = 'store_true', help = 'run each scenario at its smallest size with fewer operations')
+    parser.add_argument('--only', metavar = 'NAME', help = 'only run scenarios whose name starts with NAME')
+    parser.add_argument('--memory', action = 'store_true', help = 'trace Python allocations per scenario (slower)')
+    parser.add_argument('--output', metavar = 'FILE', help = 'write the JSON report to FILE instead of stdout')
+    arguments = parser.parse_args()
+    try:
+        report = asyncio.run(run(arguments))
+    finally:
+        shutil.rmtree(_scratch, ignore_errors = True)
+    payload = json.dumps(report, indent = 2)
+    if arguments.output:
+        with open(arguments.output, 'w', encoding = 'utf-8') as file:
+            file.write(payload + '\n')
+    else:
+        print(payload)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from typing import Any
+
+from discord.ext import commands
+from discord.user import ClientUser
+from discord.utils import time_snowflake
+
+__all__ = ['SimulatedGateway']
+
+class SimulatedGateway:
+    """
+    Local stand-in for the Discord gateway and REST API.
+
+    Synthetic guilds, members and message events are fed through the bot's own connection state,
+    so they are parsed into real discord.py models and dispatched exactly as live events would be.
+    Every REST call is answered from memory by `request`, which replaces `bot.http.request`.
+    """
+
+    bot: commands.Bot
+    guilds: list[dict]
+    channels: list[dict]
+    members: list[dict]
+    requests: dict[str, int]
+
+    def __init__(self, bot: commands.Bot, *, guilds: int = 1, channels: int = 1, members: int = 50):
+        self.bot = bot
+        self.requests = {}
+        self._ids = count(time_snowflake(datetime(2024, 1, 1, tzinfo = timezone.utc)))
+        self._clock = datetime(2024, 1, 1, tzinfo = timezone.utc)
+        self.user = self._user('Onii-Chan', bot = True)
+        self.members = [self._member(self._user(f'member{number}')) for number in range(members)]
+        self.guilds = [self._guild(number, channels) for number in range(guilds)]
+        self.channels = [channel for guild in self.guilds for channel in guild['channels']]
+
+    def _snowflake(self) -> int:
+        return next(self._ids)
+
+    def _user(self, name: str, bot: bool = False) -> dict:
+        return {'id': str(self._snowflake()), 'username': name, 'discriminator': '0', 'global_name': name, 'avatar': None, 'bot': bot}
+
+    def _member(self, user: dict) -> dict:
+        return {'user': user, 'roles': [], 'joined_at': self._clock.isoformat(), 'deaf': False, 'mute': False, 'flags': 0}
+
+    def _guild(self, number: int, channels: int) -> dict:
+        guild_id = str(self._snowflake())
+        return {
+            'id': guild_id, 'name': f'guild{number}', 'owner_id': self.members[0]['user']['id'],
+            'roles': [{'id': guild_id, 'name': '@everyone', 'permissions': str(1 << 3), 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'channels': [
+                {'id': str(self._snowflake()), 'guild_id': guild_id, 'type': 0, 'name': f'channel{index}', 'position': index, 'permission_overwrites': []}
+                for index in range(channels)
+            ],
+            'members': [self._member(self.user), *self.members], 'member_count': len(self.members) + 1,
+            'emojis': [], 'stickers': [], 'features': [], 'threads': [], 'stage_instances': [], 'guild_scheduled_events': [],
+        }
+
+    def install(self) -> None:
+        """
+        Logs the bot in as a synthetic user, registers the guilds and takes over its HTTP client
+        """
+        state = self.bot._connection
+        state.user = ClientUser(state = state, data = self.user)
+        for guild in self.guilds:
+            state._add_guild_from_data(guild)
+        self.bot.owner_id = int(self.members[0]['user']['id'])
+        self.bot.invite_url = 'https://discord.com/oauth2/authorize'
+        self.bot.http.request = self.request
+
+    async def request(self, route, **kwargs) -> Any:
+        key = f'{route.method} {route.path}'
+        self.requests[key] = self.requests.get(key, 0) + 1
+        if route.path == '/channels/{channel_id}/messages' and route.method == 'POST':
+            payload = kwargs.get('json') or {}
+            return self.message(self._channel(route.channel_id), self.user, payload.get('content') or '', embeds = payload.get('embeds') or [])
+        if route.path == '/channels/{channel_id}/messages/{message_id}' and route.method == 'PATCH':
+            payload = kwargs.get('json') or {}
+            return self.message(self._channel(route.channel_id), self.user, payload.get('content') or '', embeds = payload.get('embeds') or [])
+        return None
+
+    def _channel(self, channel_id: Any) -> dict:
+        channel_id = str(channel_id)
+        return next(channel for channel in self.channels if channel['id'] == channel_id)
+
+    def message(self, channel: dict, author: dict, content: str, *, embeds: list = None, attachments: int = 0) -> dict:
+        """
+        Builds a MESSAGE_CREATE payload in `channel`
+        """
+        self._clock += timedelta(milliseconds = 50)
+        user = author.get('user', author)
+        payload = {
+            'id': str(self._snowflake()), 'channel_id': channel['id'], 'guild_id': channel['guild_id'],
+            'author': user, 'content': content, 'timestamp': self._clock.isoformat(), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'pinned': False, 'type': 0,
+            'embeds': embeds or [],
+            'attachments': [
+                {'id': str(self._snowflake()), 'filename': f'file{index}.png', 'size': 1024, 'url': f'https://cdn.example/{index}.png', 'proxy_url': f'https://cdn.example/{index}.png'}
+                for index in range(attachments)
+            ],
+        }
+        if 'user' in author:
+            payload['member'] = {key: value for key, value in author.items() if key != 'user'}
+        return payload
+
+    def edit(self, payload: dict, content: str) -> dict:
+        """
+        Builds a MESSAGE_UPDATE payload that edits a previously created message
+        """
+        self._clock += timedelta(milliseconds = 50)
+        return {**payload, 'content': content, 'edited_timestamp': self._clock.isoformat()}
+
+    async def dispatch(self, event: str, payload: dict) -> None:
+        """
+        Parses a gateway event and waits for every handler it scheduled to finish
+        """
+        before = asyncio.all_tasks()
+        getattr(self.bot._connection, f'parse_{event}')(payload)
+        scheduled = [task for task in asyncio.all_tasks() - before if task.get_name().startswith('discord.py')]
+        if scheduled:
+            await asyncio.gather(*scheduled, return_exceptions = True)
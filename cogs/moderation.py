@@ -1,59 +1,125 @@
-from discord.ext import commands
-import discord
-import typing
-
-from core.bot import Bot
-from core.cog import CustomCogMixin
-
-class Moderation(commands.Cog, CustomCogMixin):
-
-    async def cog_check(self, context: commands.Context):
-        return context.guild is not None
-
-    @commands.command(name = 'kick', description = 'Kicks a user from the server')
-    @commands.has_permissions(kick_members=True)
-    @commands.bot_has_permissions(kick_members=True)
-    async def kick(self, context: commands.Context, member: commands.MemberConverter, *, reason = None):
-        await member.kick(reason = reason)
-        await context.send(f'{member} has been kicked from the server')
-    
-    @commands.command(name = 'ban', description = 'Bans a user from the server')
-    @commands.has_permissions(ban_members=True)
-    @commands.bot_has_permissions(ban_members=True)
-    async def ban(self, context: commands.Context, member: commands.MemberConverter, *, reason = None):
-        await member.ban(reason = reason)
-        await context.send(f'{member} has been banned from the server')
-    
-    @commands.command(name = 'unban', description = 'Unbans a user from the server')
-    @commands.has_permissions(ban_members=True)
-    @commands.bot_has_permissions(ban_members=True)
-    async def unban(self, context: commands.Context, member: commands.UserConverter):
-        await context.guild.unban(member)
-        await context.send(f'{member} has been unbanned from the server')
-    
-    @commands.command(name = 'purge', aliases = ['clear', 'prune'], help = 'Deletes specified number of messages by specified users! If no users are specified, it deletes any message. Default value is 100!', brief = 'Manage Messages')
-    @commands.has_permissions(manage_messages=True)
-    @commands.bot_has_permissions(manage_messages=True)
-    async def _purge(self, context: commands.Context, messages: typing.Optional[int] = 100, params: commands.Greedy[typing.Union[discord.Member, discord.Role]] = None, exclude_pins: typing.Optional[bool] = False, *args):
-        if messages > 1000:
-            await context.send('You can only delete 1000 messages at a time!')
-            return
-        if params is None:
-            values = await context.channel.purge(limit = messages, check = lambda message: not message.pinned if exclude_pins else True, bulk = True)
-            await context.send(f'{len(values)} messages have been deleted!', delete_after = 5)
-        else:
-            def check(message):
-                return message.author in params
-            await context.channel.purge(limit = messages, check = lambda message: check(message) and (not message.pinned if exclude_pins else True), bulk = True)
-
-    @commands.command(name = 'nick', aliases = ['nickname'], description = 'Changes the nickname of a user')
-    @commands.has_permissions(manage_nicknames=True)
-    @commands.bot_has_permissions(manage_nicknames=True)
-    async def nick(self, context: commands.Context, member: commands.MemberConverter, *, nickname: str = None):
-        await member.edit(nick = nickname)
-        await context.send(f'{member}\'s nickname has been ' + ('reset' if nickname is None else f'changed to {nickname}'))
-    
-    
-
-async def setup(bot: Bot):
+import asyncio
+from discord.ext import commands
+import discord
+import typing
+
+from core.bot import Bot
+from core.bulk import BulkAction
+from core.cog import CustomCogMixin
+
+class Moderation(commands.Cog, CustomCogMixin):
+    """
+    Member moderation commands.
+
+    Needs `members` so member arguments that are not cached can be resolved through gateway queries,
+    and `guild_messages` with `message_content` for purge and prefix commands.
+    """
+
+    required_intents = ('guilds', 'members', 'guild_messages', 'message_content')
+
+    async def cog_check(self, context: commands.Context):
+        return context.guild is not None
+
+    @commands.command(name = 'kick', description = 'Kicks a user from the server')
+    @commands.has_permissions(kick_members=True)
+    @commands.bot_has_permissions(kick_members=True)
+    async def kick(self, context: commands.Context, member: commands.MemberConverter, *, reason = None):
+        await member.kick(reason = reason)
+        await context.send(f'{member} has been kicked from the server')
+    
+    @commands.command(name = 'ban', description = 'Bans a user from the server')
+    @commands.has_permissions(ban_members=True)
+    @commands.bot_has_permissions(ban_members=True)
+    async def ban(self, context: commands.Context, member: commands.MemberConverter, *, reason = None):
+        await member.ban(reason = reason)
+        await context.send(f'{member} has been banned from the server')
+    
+    @commands.command(name = 'unban', description = 'Unbans a user from the server')
+    @commands.has_permissions(ban_members=True)
+    @commands.bot_has_permissions(ban_members=True)
+    async def unban(self, context: commands.Context, member: commands.UserConverter):
+        await context.guild.unban(member)
+        await context.send(f'{member} has been unbanned from the server')
+    
+    async def _bulk_targets(self, context: commands.Context, users: list[discord.Object]) -> list[discord.Object]:
+        """
+        Removes duplicates and anyone the author should not be able to act on: themselves, the bot,
+        the server owner and members at or above the author's top role. Members missing from the
+        cache are looked up through gateway queries of up to 100 IDs, and anyone whose roles cannot
+        be checked is skipped; the skipped users are listed in the channel with the reason.
+        """
+        protected = {context.author.id, self.bot.user.id, context.guild.owner_id}
+        targets = {}
+        for user in users:
+            if user.id not in protected and user.id not in targets:
+                targets[user.id] = user
+        if context.author.id == context.guild.owner_id:
+            return list(targets.values())
+        members, missing, skipped = {}, [], []
+        for user_id in targets:
+            member = context.guild.get_member(user_id)
+            if member is not None:
+                members[user_id] = member
+            else:
+                missing.append(user_id)
+        for start in range(0, len(missing), 100):
+            chunk = missing[start:start + 100]
+            try:
+                # Users who are not members are left out of the reply and have no roles to check
+                members.update((member.id, member) for member in await context.guild.query_members(limit = 100, user_ids = chunk, cache = False))
+            except (asyncio.TimeoutError, discord.ClientException):
+                skipped.extend((targets.pop(user_id), 'their roles could not be checked') for user_id in chunk)
+        for user_id, member in members.items():
+            if member.top_role >= context.author.top_role:
+                skipped.append((targets.pop(user_id), 'their top role is not below yours'))
+        if skipped:
+            lines = [f'Skipped {len(skipped)} users:', *(f'- <@{user.id}>: {reason}' for user, reason in skipped[:10])]
+            if len(skipped) > 10:
+                lines.append(f'- and {len(skipped) - 10} more')
+            await context.send('\n'.join(lines), delete_after = 30, allowed_mentions = discord.AllowedMentions.none())
+        return list(targets.values())
+
+    @commands.command(name = 'masskick', help = 'Kicks every listed user from the server at once, e.g. during a raid. Accepts mentions or IDs!', brief = 'Kick Members')
+    @commands.has_permissions(kick_members=True)
+    @commands.bot_has_permissions(kick_members=True)
+    async def masskick(self, context: commands.Context, users: commands.Greedy[discord.Object], *, reason = None):
+        targets = await self._bulk_targets(context, users)
+        if not targets:
+            return await context.send('Specify at least one user I can kick!', delete_after = 30)
+        await BulkAction('Kicking members', targets, lambda user: context.guild.kick(user, reason = reason)).run(context)
+
+    @commands.command(name = 'massban', help = 'Bans every listed user from the server at once, e.g. during a raid. Accepts mentions or IDs, including users who already left!', brief = 'Ban Members')
+    @commands.has_permissions(ban_members=True)
+    @commands.bot_has_permissions(ban_members=True)
+    async def massban(self, context: commands.Context, users: commands.Greedy[discord.Object], *, reason = None):
+        targets = await self._bulk_targets(context, users)
+        if not targets:
+            return await context.send('Specify at least one user I can ban!', delete_after = 30)
+        await BulkAction('Banning users', targets, lambda user: context.guild.ban(user, reason = reason)).run(context)
+
+    @commands.command(name = 'purge', aliases = ['clear', 'prune'], help = 'Deletes specified number of messages by specified users! If no users are specified, it deletes any message. Default value is 100!', brief = 'Manage Messages')
+    @commands.has_permissions(manage_messages=True)
+    @commands.bot_has_permissions(manage_messages=True)
+    async def _purge(self, context: commands.Context, messages: typing.Optional[int] = 100, params: commands.Greedy[typing.Union[discord.Member, discord.Role]] = None, exclude_pins: typing.Optional[bool] = False, *args):
+        if messages > 1000:
+            await context.send('You can only delete 1000 messages at a time!')
+            return
+        if params is None:
+            values = await context.channel.purge(limit = messages, check = lambda message: not message.pinned if exclude_pins else True, bulk = True)
+            await context.send(f'{len(values)} messages have been deleted!', delete_after = 5)
+        else:
+            def check(message):
+                return message.author in params
+            await context.channel.purge(limit = messages, check = lambda message: check(message) and (not message.pinned if exclude_pins else True), bulk = True)
+
+    @commands.command(name = 'nick', aliases = ['nickname'], description = 'Changes the nickname of a user')
+    @commands.has_permissions(manage_nicknames=True)
+    @commands.bot_has_permissions(manage_nicknames=True)
+    async def nick(self, context: commands.Context, member: commands.MemberConverter, *, nickname: str = None):
+        await member.edit(nick = nickname)
+        await context.send(f'{member}\'s nickname has been ' + ('reset' if nickname is None else f'changed to {nickname}'))
+    
+    
+
+async def setup(bot: Bot):
     await bot.add_cog(Moderation(bot))
\ No newline at end of file
@@ -1,117 +1,654 @@
-from discord.ext import commands
-import discord
-
-from core.bot import Bot
-from core.cog import CustomCogMixin
-from core.handler import JSONLineHandler
-
-class Overwatch(commands.Cog, CustomCogMixin):
-
-    _file_ext = 'json1'
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._config = self.bot._overwatch_handler
-        self._guilds = self._config.s_get('Guilds') or {}
-        self._message_handlers = {}
-
-    async def cog_check(self, context: commands.Context):
-        return context.guild is not None
-
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        if message.author.bot:
-            return
-        guild_id = str(message.guild.id)
-        if guild_id in self._guilds:
-            if message.channel.id in self._guilds[guild_id]:
-                await self._handle_message(message)
-    
-    async def _handle_message(self, message: discord.Message):
-        channel_id = message.channel.id
-        handler = self._message_handlers.get(channel_id)
-        if handler is None:
-            handler = JSONLineHandler(f'overwatch/{channel_id}.{self._file_ext}', 'id', loop=self.bot.loop, unique_only=True)
-            self._message_handlers[channel_id] = handler
-        message_data = {
-            "id": message.id,
-            "content": message.content,
-            "author": {
-                "id": message.author.id,
-                "name": message.author.name,
-                "discriminator": message.author.discriminator,
-                "bot": message.author.bot,
-            },
-            "channel": {
-                "id": message.channel.id,
-                "name": message.channel.name,
-            },
-            "guild": {
-                "id": message.guild.id,
-                "name": message.guild.name,
-            },
-            "created_at": message.created_at.isoformat(),
-            "edited_at": message.edited_at.isoformat() if message.edited_at else None,
-            "attachments": [
-                {"id": attachment.id, "filename": attachment.filename, "url": attachment.url}
-                for attachment in message.attachments
-            ],
-            "embeds": [embed.to_dict() for embed in message.embeds],
-            "reactions": [
-                {"emoji": str(reaction.emoji), "count": reaction.count}
-                for reaction in message.reactions
-            ],
-            "pinned": message.pinned,
-            "tts": message.tts,
-        }
-        await handler.add(message_data)
-    
-    @commands.group(name='overwatch', aliases=['ow'], invoke_without_command=True)
-    @commands.has_guild_permissions(administrator=True)
-    async def overwatch_group(self, context: commands.Context):
-        await context.send('Overwatch is a group command. Use `add`, `remove`, or `list` subcommands.')
-    
-    @overwatch_group.command(name='add')
-    async def overwatch_add(self, context: commands.Context, channel: discord.TextChannel):
-        guild_id = str(context.guild.id)
-        channel_id = channel.id
-        if guild_id not in self._guilds:
-            self._guilds[guild_id] = []
-        if channel_id in self._guilds[guild_id]:
-            await context.message.delete(delay = 5)
-            return await context.send(f'Channel {channel.mention} is already being logged.')
-        self._guilds[guild_id].append(channel.id)
-        await self._config.update('Guilds', self._guilds)
-        await context.send(f'Added channel {channel.mention} to be logged.', delete_after = 30)
-        await context.message.delete(delay = 5)
-
-    @overwatch_group.command(name='remove')
-    async def overwatch_remove(self, context: commands.Context, channel: discord.TextChannel):
-        guild_id = str(context.guild.id)
-        channel_id = channel.id
-        if guild_id in self._guilds:
-            if channel_id in self._guilds[guild_id]:
-                self._guilds[guild_id].remove(channel_id)
-                if not self._guilds[guild_id]:
-                    del self._guilds[guild_id]
-                await self._config.update('Guilds', self._guilds)
-                await context.send(f'Removed channel {channel.mention} from being logged.', delete_after = 30)
-            else:
-                await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
-        else:
-            await context.send('No channels are being logged.', delete_after = 30)
-        await context.message.delete(delay = 5)
-        
-    @overwatch_group.command(name='list')
-    async def overwatch_list(self, context: commands.Context):
-        guild_id = str(context.guild.id)
-        if guild_id in self._guilds:
-            channels = [context.guild.get_channel(int(channel_id)).mention for channel_id in self._guilds[guild_id]]
-            await context.send(f'Channels being current logged: {", ".join(channels)}', delete_after = 30)
-        else:
-            await context.send('No channels are being logged in this server.', delete_after = 30)
-        await context.message.delete(delay = 5)
-
-
-async def setup(bot: Bot):
+import asyncio
+from datetime import datetime, timedelta, timezone
+from discord.ext import commands, tasks
+import discord
+from discord.utils import snowflake_time
+from functools import partial
+from pathlib import Path
+import re
+import tempfile
+import time
+from typing import Literal, Optional
+
+from config.settings import OVERWATCH_ACTIVITY_INTERVAL, OVERWATCH_BACKFILL_BATCH, OVERWATCH_RETENTION_BATCH, OVERWATCH_RETENTION_INTERVAL
+from core.activity import GuildActivity, open_guild_activity
+from core.bot import Bot
+from core.cog import CustomCogMixin
+from core.export import ArchiveWriter
+from core.metrics import metrics, timed_method
+from core.paginator import EmbedPaginator
+from core.records import MessageRecord, apply_delete, apply_edit, apply_reaction, expand_record, open_message_storage, queue_message
+from core.search import SearchIndex, tokenize
+
+def parse_date(text: str) -> datetime:
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        raise commands.BadArgument(f'`{text}` is not a valid date, use YYYY-MM-DD')
+    return moment if moment.tzinfo else moment.replace(tzinfo = timezone.utc)
+
+def parse_size(text: str) -> int:
+    units = {'b': 1, 'kb': 1 << 10, 'mb': 1 << 20, 'gb': 1 << 30, 'tb': 1 << 40}
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmgt]?b)?', text.strip().lower())
+    if match is None:
+        raise commands.BadArgument(f'`{text}` is not a valid size, use e.g. 500MB or 2GB')
+    return int(float(match[1]) * units[match[2] or 'b'])
+
+def format_size(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+def sparkline(values: list[int]) -> str:
+    blocks = '▁▂▃▄▅▆▇█'
+    peak = max(values)
+    if not peak:
+        return blocks[0] * len(values)
+    return ''.join(blocks[round(value * (len(blocks) - 1) / peak)] for value in values)
+
+class SearchFlags(commands.FlagConverter):
+    terms: str = None
+    author: discord.User = None
+    channel: discord.TextChannel = None
+    after: parse_date = None
+    before: parse_date = None
+
+class RetentionFlags(commands.FlagConverter):
+    channel: discord.TextChannel = None
+    days: commands.Range[int, 0] = None
+    size: parse_size = None
+
+class ExportFlags(commands.FlagConverter):
+    channel: discord.TextChannel
+    format: Literal['jsonl', 'csv'] = 'jsonl'
+    after: parse_date = None
+    before: parse_date = None
+
+class Overwatch(commands.Cog, CustomCogMixin):
+    """
+    Message logging and search for watched channels.
+
+    Needs `guild_messages` and `message_content` to log messages and their edits and deletions, and
+    `guild_reactions` to keep reaction counts current. Raw events are used throughout, so changes
+    are tracked whether or not the message is still in the message cache.
+    """
+
+    required_intents = ('guilds', 'guild_messages', 'message_content', 'guild_reactions')
+
+    _results_per_page = 5
+    _result_limit = 50
+
+    _export_columns = {
+        'id': lambda record: record['id'],
+        'created_at': lambda record: record['created_at'],
+        'edited_at': lambda record: record.get('edited_at') or '',
+        'deleted_at': lambda record: record.get('deleted_at') or '',
+        'author_id': lambda record: record['author']['id'],
+        'author_name': lambda record: record['author']['name'],
+        'content': lambda record: record['content'],
+        'attachments': lambda record: ' '.join(attachment['url'] for attachment in record.get('attachments', [])),
+        'reactions': lambda record: ' '.join(f'{reaction["emoji"]}:{reaction["count"]}' for reaction in record.get('reactions', [])),
+        'revisions': lambda record: len(record.get('revisions', [])),
+        'pinned': lambda record: record.get('pinned', False),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._config = self.bot._overwatch_handler
+        self._guilds = self._config.s_get('Guilds') or {}
+        self._message_handlers = self.bot._message_handlers
+        self._search_indexes = self.bot._search_indexes
+        self._activity = self.bot._activity
+        self._backfills = {}
+        self._retention_reports = {}
+        self._opening = {}
+        self._opening_activity = {}
+
+    async def cog_load(self):
+        self._flush_indexes.start()
+        self._persist_activity.start()
+        self._enforce_retention.start()
+        self.bot.loop.create_task(self._load_search_indexes())
+        self.bot.loop.create_task(self._resume_backfills())
+
+    async def cog_unload(self):
+        self._flush_indexes.cancel()
+        self._persist_activity.cancel()
+        self._enforce_retention.cancel()
+        for task in self._backfills.values():
+            task.cancel()
+        for handler in self._message_handlers.values():
+            await handler.flush()
+        for index in self._search_indexes.values():
+            await index.flush()
+        for activity in self._activity.values():
+            await activity.flush()
+
+    @tasks.loop(seconds = 5)
+    async def _flush_indexes(self):
+        for guild_id, index in list(self._search_indexes.items()):
+            await index.flush()
+            if index.needs_compaction:
+                # Edits leave dead entries behind in channels that no retention rule compacts
+                try:
+                    await index.compact()
+                except Exception as e:
+                    self.bot.logger.error(f'Overwatch search index compaction of {guild_id} failed: {e}', exc_info = True)
+
+    @tasks.loop(seconds = OVERWATCH_ACTIVITY_INTERVAL)
+    async def _persist_activity(self):
+        for activity in self._activity.values():
+            await activity.flush()
+
+    @tasks.loop(seconds = OVERWATCH_RETENTION_INTERVAL)
+    async def _enforce_retention(self):
+        for guild_id, channels in list(self._guilds.items()):
+            if self.bot.get_guild(int(guild_id)) is None:
+                continue
+            removed = 0
+            for channel_id in list(channels):
+                rule = self._retention_rule(guild_id, channel_id)
+                if not rule:
+                    continue
+                try:
+                    removed += await self._expire_channel(int(guild_id), channel_id, rule)
+                except Exception as e:
+                    self.bot.logger.error(f'Overwatch retention of {channel_id} failed: {e}', exc_info = True)
+            if removed:
+                # Expired messages are only marked removed in the search index until its log is rewritten
+                try:
+                    await self._get_search_index(int(guild_id)).compact()
+                except Exception as e:
+                    self.bot.logger.error(f'Overwatch search index compaction of {guild_id} failed: {e}', exc_info = True)
+
+    def _retention_rule(self, guild_id: str, channel_id: int) -> dict:
+        """
+        Returns the retention limits of a channel, its own rule overriding the server's limit by limit
+        """
+        rules = (self._config.s_get('Retention') or {}).get(guild_id, {})
+        return {**{key: value for key, value in rules.items() if key != 'channels'}, **rules.get('channels', {}).get(str(channel_id), {})}
+
+    @staticmethod
+    def _describe_rule(rule: dict) -> str:
+        limits = []
+        if rule.get('days'):
+            limits.append(f'{rule["days"]} days')
+        if rule.get('size'):
+            limits.append(f'up to {format_size(rule["size"])}')
+        return ', '.join(limits) or 'Kept forever'
+
+    async def _expire_channel(self, guild_id: int, channel_id: int, rule: dict) -> int:
+        """
+        Enforces a retention rule a step of at most `OVERWATCH_RETENTION_BATCH` records at a time. The
+        store is only locked for each step, so logging carries on while old messages are removed.
+        Removed messages are dropped from the search index too; returns how many were removed.
+        """
+        before = datetime.now(timezone.utc) - timedelta(days = rule['days']) if rule.get('days') else None
+        handler = await self._get_handler(channel_id)
+        index = self._get_search_index(guild_id)
+        removed = reclaimed = 0
+        done = False
+        while not done and self._watched(guild_id, channel_id):
+            keys, size, done = await handler.expire(before, rule.get('size'), OVERWATCH_RETENTION_BATCH)
+            for key in keys:
+                index.remove(key)
+            removed, reclaimed = removed + len(keys), reclaimed + size
+            await asyncio.sleep(0)
+        if removed or reclaimed:
+            metrics.increment('overwatch.retention.records', removed)
+            metrics.increment('overwatch.retention.bytes', reclaimed)
+            self.bot.logger.info(f'Overwatch retention removed {removed} messages from {channel_id}, reclaiming {format_size(reclaimed)}')
+        self._retention_reports[channel_id] = (removed, reclaimed, time.time())
+        return removed
+
+    async def _get_handler(self, channel_id: int):
+        handler = self._message_handlers.get(channel_id)
+        if handler is None:
+            if self.bot._ingest is not None:
+                handler = self._message_handlers[channel_id] = self.bot._ingest.handler(channel_id)
+            else:
+                opening = self._opening.get(channel_id)
+                if opening is None:
+                    opening = self._opening[channel_id] = self.bot.loop.create_task(self._open_handler(channel_id))
+                    opening.add_done_callback(lambda _: self._opening.pop(channel_id, None))
+                handler = await asyncio.shield(opening)
+        return handler
+
+    async def _open_handler(self, channel_id: int):
+        """
+        Opens a channel's store in the executor. Everything that needs the store while it opens
+        waits on this same task, in the order it asked, so each channel only ever has one store.
+        """
+        handler = self._message_handlers[channel_id] = await open_message_storage(channel_id, loop=self.bot.loop)
+        return handler
+
+    def _get_search_index(self, guild_id: int) -> SearchIndex:
+        index = self._search_indexes.get(guild_id)
+        if index is None:
+            index = SearchIndex(f'overwatch/search/{guild_id}.log', loop=self.bot.loop)
+            self._search_indexes[guild_id] = index
+            self.bot.loop.create_task(index.load())
+        return index
+
+    async def _get_activity(self, guild_id: int) -> GuildActivity:
+        activity = self._activity.get(guild_id)
+        if activity is None:
+            opening = self._opening_activity.get(guild_id)
+            if opening is None:
+                opening = self._opening_activity[guild_id] = self.bot.loop.create_task(self._open_activity(guild_id))
+                opening.add_done_callback(lambda _: self._opening_activity.pop(guild_id, None))
+            activity = await asyncio.shield(opening)
+        return activity
+
+    async def _open_activity(self, guild_id: int) -> GuildActivity:
+        """
+        Opens a guild's activity counters in the executor, shared by everything that needs them meanwhile
+        """
+        activity = self._activity[guild_id] = await open_guild_activity(f'overwatch/stats/{guild_id}.json', loop=self.bot.loop)
+        return activity
+
+    async def cog_check(self, context: commands.Context):
+        return context.guild is not None
+
+    @commands.Cog.listener()
+    async def on_shared_data_changed(self, name: str):
+        """
+        Adopts Overwatch config changed by another cluster process
+        """
+        if name != '_overwatch_handler':
+            return
+        self._guilds = self._config.s_get('Guilds') or {}
+        watched = {channel_id for channels in self._guilds.values() for channel_id in channels}
+        for channel_id in [channel_id for channel_id in self._message_handlers if channel_id not in watched]:
+            await self._message_handlers.pop(channel_id).close()
+        for guild_id in self._guilds:
+            if self.bot.get_guild(int(guild_id)) is not None:
+                self._get_search_index(int(guild_id))
+
+    @commands.Cog.listener()
+    @timed_method('listener')
+    async def on_message(self, message: discord.Message):
+        if message.author.bot:
+            return
+        guild_id = str(message.guild.id)
+        if guild_id in self._guilds:
+            if message.channel.id in self._guilds[guild_id]:
+                await self._handle_message(message)
+    
+    def _watched(self, guild_id: Optional[int], channel_id: int) -> bool:
+        return guild_id is not None and channel_id in self._guilds.get(str(guild_id), [])
+
+    @commands.Cog.listener()
+    @timed_method('listener')
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if not self._watched(payload.guild_id, payload.channel_id):
+            return
+        data = payload.data
+        handler = await self._get_handler(payload.channel_id)
+        handler.queue_modify(payload.message_id, partial(apply_edit, data))
+        if 'content' in data and 'author' in data and not data['author'].get('bot'):
+            self._get_search_index(payload.guild_id).add(
+                payload.message_id, payload.channel_id, int(data['author']['id']), snowflake_time(payload.message_id),
+                ' '.join((data['content'], *(attachment['filename'] for attachment in data.get('attachments', [])))),
+            )
+
+    @commands.Cog.listener()
+    @timed_method('listener')
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if self._watched(payload.guild_id, payload.channel_id):
+            handler = await self._get_handler(payload.channel_id)
+            handler.queue_modify(payload.message_id, partial(apply_delete, datetime.now(timezone.utc).isoformat()))
+
+    @commands.Cog.listener()
+    @timed_method('listener')
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        if self._watched(payload.guild_id, payload.channel_id):
+            handler = await self._get_handler(payload.channel_id)
+            change = partial(apply_delete, datetime.now(timezone.utc).isoformat())
+            for message_id in payload.message_ids:
+                handler.queue_modify(message_id, change)
+
+    async def _track_reaction(self, payload, emoji: Optional[str], delta: int):
+        if self._watched(payload.guild_id, payload.channel_id):
+            handler = await self._get_handler(payload.channel_id)
+            handler.queue_modify(payload.message_id, partial(apply_reaction, emoji, delta))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        await self._track_reaction(payload, str(payload.emoji), 1)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        await self._track_reaction(payload, str(payload.emoji), -1)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
+        await self._track_reaction(payload, str(payload.emoji), 0)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        await self._track_reaction(payload, None, 0)
+
+    async def _handle_message(self, message: discord.Message):
+        if self.bot._ingest is not None and self.bot._ingest.saturated:
+            await self.bot._ingest.drained()
+        self._store_message(await self._get_handler(message.channel.id), self._get_search_index(message.guild.id), message)
+        if self.bot._attachment_archive is not None:
+            for attachment in message.attachments:
+                self.bot._attachment_archive.enqueue(attachment.id, attachment.filename, attachment.url, attachment.size, message.guild.id, message.channel.id)
+        (await self._get_activity(message.guild.id)).channel(message.channel.id).add(
+            message.created_at.timestamp(), message.author.id, message.author.name,
+            len(message.attachments), len(message.embeds),
+        )
+
+    def _store_message(self, handler, index: SearchIndex, message: discord.Message):
+        record = MessageRecord(message)
+        if self.bot._ingest is not None:
+            # The ingestion worker serializes records itself, so the captured fields are sent as they are
+            handler.queue(record)
+        else:
+            queue_message(handler, record)
+        index.add(
+            message.id, message.channel.id, message.author.id, message.created_at,
+            ' '.join((message.content, *(attachment.filename for attachment in message.attachments))),
+        )
+    
+    async def _load_search_indexes(self):
+        """
+        Loads the search indexes of the watched servers on this process's shards once they are known
+        """
+        await self.bot.wait_until_ready()
+        for guild_id in list(self._guilds):
+            if self.bot.get_guild(int(guild_id)) is not None:
+                self._get_search_index(int(guild_id))
+
+    async def _resume_backfills(self):
+        """
+        Restarts backfills that were interrupted by a reload or restart from their checkpoints
+        """
+        await self.bot.wait_until_ready()
+        for channel_id in self._config.s_get('Backfills') or {}:
+            channel = self.bot.get_channel(int(channel_id))
+            if channel is not None:
+                self._start_backfill(channel)
+
+    def _start_backfill(self, channel: discord.TextChannel, status: discord.Message = None):
+        task = self._backfills.get(channel.id)
+        if task is None or task.done():
+            self._backfills[channel.id] = self.bot.loop.create_task(self._backfill(channel, status))
+
+    async def _save_checkpoint(self, channel_id: int, checkpoint: dict = None):
+        def save(backfills: dict) -> dict:
+            backfills = backfills or {}
+            if checkpoint is None:
+                backfills.pop(str(channel_id), None)
+            else:
+                backfills[str(channel_id)] = checkpoint
+            return backfills
+        await self._config.modify('Backfills', save)
+
+    async def _backfill(self, channel: discord.TextChannel, status: discord.Message = None):
+        """
+        Streams a channel's history into its store, newest first, in batches of `OVERWATCH_BACKFILL_BATCH`.
+
+        Only one batch is held in memory, records already stored are skipped by the handler, and the
+        oldest message reached is checkpointed after every batch is written so an interrupted backfill
+        resumes where it stopped.
+        """
+        checkpoint = (self._config.s_get('Backfills') or {}).get(str(channel.id))
+        if checkpoint is None:
+            return
+        handler = await self._get_handler(channel.id)
+        index = self._get_search_index(channel.guild.id)
+        count, batch = checkpoint['count'], 0
+
+        async def report(text: str):
+            self.bot.logger.info(f'Overwatch backfill of #{channel.name} ({channel.id}): {text}')
+            if status is not None:
+                try:
+                    await status.edit(content = f'Backfilling {channel.mention}: {text}')
+                except discord.HTTPException:
+                    pass
+
+        try:
+            async for message in channel.history(limit = None, before = discord.Object(checkpoint['before'])):
+                checkpoint['before'] = message.id
+                if message.author.bot:
+                    continue
+                self._store_message(handler, index, message)
+                batch += 1
+                if batch >= OVERWATCH_BACKFILL_BATCH:
+                    await handler.flush()
+                    count, batch = count + batch, 0
+                    await self._save_checkpoint(channel.id, {'before': checkpoint['before'], 'count': count})
+                    await report(f'{count} messages archived so far...')
+            await handler.flush()
+            await self._save_checkpoint(channel.id)
+            await report(f'done, {count + batch} messages archived.')
+        except discord.Forbidden:
+            await self._save_checkpoint(channel.id)
+            await report('stopped, I cannot read the message history of this channel.')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.bot.logger.error(f'Overwatch backfill of {channel.id} failed, it will resume from its checkpoint: {e}', exc_info = True)
+        finally:
+            self._backfills.pop(channel.id, None)
+
+    @commands.group(name='overwatch', aliases=['ow'], invoke_without_command=True)
+    @commands.has_guild_permissions(administrator=True)
+    async def overwatch_group(self, context: commands.Context):
+        await context.send('Overwatch is a group command. Use `add`, `remove`, `list`, `backfill`, `export`, `search`, `stats`, `retention` or `attachment` subcommands.')
+    
+    @overwatch_group.command(name='add', help='Starts logging a channel; add `backfill` to also archive its existing history')
+    async def overwatch_add(self, context: commands.Context, channel: discord.TextChannel, backfill: Literal['backfill'] = None):
+        guild_id = str(context.guild.id)
+        channel_id = channel.id
+        if channel_id in self._guilds.get(guild_id, []):
+            await context.message.delete(delay = 5)
+            return await context.send(f'Channel {channel.mention} is already being logged.')
+        def add_channel(guilds: dict) -> dict:
+            guilds = guilds or {}
+            channels = guilds.setdefault(guild_id, [])
+            if channel_id not in channels:
+                channels.append(channel_id)
+            return guilds
+        self._guilds = await self._config.modify('Guilds', add_channel)
+        await context.send(f'Added channel {channel.mention} to be logged.', delete_after = 30)
+        await context.message.delete(delay = 5)
+        if backfill:
+            await self._save_checkpoint(channel_id, {'before': context.message.id, 'count': 0})
+            self._start_backfill(channel, await context.send(f'Backfilling {channel.mention}: starting...'))
+
+    @overwatch_group.command(name='backfill', help='Archives the existing history of a logged channel, resuming any earlier backfill')
+    async def overwatch_backfill(self, context: commands.Context, channel: discord.TextChannel):
+        if channel.id not in self._guilds.get(str(context.guild.id), []):
+            return await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
+        if channel.id in self._backfills:
+            return await context.send(f'Channel {channel.mention} is already being backfilled.', delete_after = 30)
+        if str(channel.id) not in (self._config.s_get('Backfills') or {}):
+            await self._save_checkpoint(channel.id, {'before': context.message.id, 'count': 0})
+        self._start_backfill(channel, await context.send(f'Backfilling {channel.mention}: starting...'))
+
+    @overwatch_group.command(name='remove')
+    async def overwatch_remove(self, context: commands.Context, channel: discord.TextChannel):
+        guild_id = str(context.guild.id)
+        channel_id = channel.id
+        if guild_id in self._guilds:
+            if channel_id in self._guilds[guild_id]:
+                def remove_channel(guilds: dict) -> dict:
+                    guilds = guilds or {}
+                    if channel_id in guilds.get(guild_id, []):
+                        guilds[guild_id].remove(channel_id)
+                        if not guilds[guild_id]:
+                            del guilds[guild_id]
+                    return guilds
+                self._guilds = await self._config.modify('Guilds', remove_channel)
+                task = self._backfills.pop(channel_id, None)
+                if task is not None:
+                    task.cancel()
+                await self._save_checkpoint(channel_id)
+                handler = self._message_handlers.pop(channel_id, None)
+                if handler is not None:
+                    await handler.close()
+                await context.send(f'Removed channel {channel.mention} from being logged.', delete_after = 30)
+            else:
+                await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
+        else:
+            await context.send('No channels are being logged.', delete_after = 30)
+        await context.message.delete(delay = 5)
+        
+    @overwatch_group.command(name='list')
+    async def overwatch_list(self, context: commands.Context):
+        guild_id = str(context.guild.id)
+        if guild_id in self._guilds:
+            channels = [context.guild.get_channel(int(channel_id)).mention for channel_id in self._guilds[guild_id]]
+            await context.send(f'Channels being current logged: {", ".join(channels)}', delete_after = 30)
+        else:
+            await context.send('No channels are being logged in this server.', delete_after = 30)
+        await context.message.delete(delay = 5)
+
+
+    @overwatch_group.command(name='export', help='Exports logged messages as compressed files, e.g. `export channel: #general format: csv after: 2024-01-01`')
+    async def overwatch_export(self, context: commands.Context, *, flags: ExportFlags):
+        channel = flags.channel
+        if channel.id not in self._guilds.get(str(context.guild.id), []):
+            return await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
+        handler = await self._get_handler(channel.id)
+        status = await context.send(f'Exporting {channel.mention}...')
+        # Each part goes in its own message, as the upload limit applies to a message's attachments combined
+        part_size = context.guild.filesize_limit - 64 * 1024
+        with tempfile.TemporaryDirectory() as directory:
+            # Stored records leave out the channel, the guild and empty fields, so they are filled back in
+            header = {'channel': {'id': channel.id, 'name': channel.name}, 'guild': {'id': context.guild.id, 'name': context.guild.name}}
+            writer = ArchiveWriter(
+                Path(directory), f'overwatch-{channel.name}-{channel.id}', flags.format,
+                part_size = part_size, columns = self._export_columns, transform = partial(expand_record, header = header),
+            )
+
+            async def send(parts: list[Path]):
+                for part in parts:
+                    await context.send(file = discord.File(part))
+                    part.unlink()
+
+            async for batch in handler.scan(flags.after, flags.before):
+                await send(await metrics.run_in_executor(self.bot.loop, 'executor.ArchiveWriter.s_write', writer.s_write, batch))
+            await send(await metrics.run_in_executor(self.bot.loop, 'executor.ArchiveWriter.s_close', writer.s_close))
+        if not writer.records:
+            return await status.edit(content = f'No logged messages from {channel.mention} matched that range.')
+        await status.edit(content = f'Exported {writer.records} messages from {channel.mention} in {writer.parts} file(s).')
+
+    @overwatch_group.command(name='search', help='Searches logged messages, e.g. `search terms: invite link author: @user after: 2024-01-01`')
+    async def overwatch_search(self, context: commands.Context, *, flags: SearchFlags):
+        index = self._get_search_index(context.guild.id)
+        if not index.loaded:
+            return await context.send('The search index is still loading, try again shortly.', delete_after = 30)
+        results = index.search(
+            tokenize(flags.terms or ''),
+            author_id = flags.author.id if flags.author else None,
+            channel_id = flags.channel.id if flags.channel else None,
+            after = flags.after, before = flags.before,
+            limit = self._result_limit,
+        )
+        if not results:
+            return await context.send('No logged messages matched that search.', delete_after = 30)
+        lines = []
+        for message_id, channel_id in results:
+            if not self._watched(context.guild.id, channel_id):
+                # Opening the store would recreate it for a channel that is no longer logged
+                continue
+            handler = await self._get_handler(channel_id)
+            record = await handler.get(value = message_id)
+            if record is None:
+                continue
+            url = f'https://discord.com/channels/{context.guild.id}/{channel_id}/{message_id}'
+            created = int(datetime.fromisoformat(record['created_at']).timestamp())
+            content = record.get('content', '')[:200] or '*no text*'
+            if record.get('deleted_at'):
+                content += ' *(deleted)*'
+            elif record.get('revisions'):
+                content += f' *(edited {len(record["revisions"])}x)*'
+            lines.append(f'[<t:{created}:f>]({url}) **{record["author"]["name"]}**: {content}')
+        if not lines:
+            return await context.send('No logged messages matched that search.', delete_after = 30)
+        pages = [
+            discord.Embed(title = f'Search results ({len(lines)})', description = '\n'.join(lines[start:start + self._results_per_page]))
+            for start in range(0, len(lines), self._results_per_page)
+        ]
+        await EmbedPaginator(pages, context.author.id).send(context)
+
+    @overwatch_group.command(name='stats', help='Shows message activity for a logged channel, or every logged channel in the server')
+    async def overwatch_stats(self, context: commands.Context, channel: discord.TextChannel = None):
+        watched = self._guilds.get(str(context.guild.id), [])
+        if channel is not None and channel.id not in watched:
+            return await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
+        if not watched:
+            return await context.send('No channels are being logged in this server.', delete_after = 30)
+        summary = (await self._get_activity(context.guild.id)).summary([channel.id] if channel else watched)
+        daily, attachments, embeds = summary['daily'], summary['attachments'], summary['embeds']
+        embed = discord.Embed(title = f'Activity in {f"#{channel.name}" if channel else "logged channels"}')
+        embed.add_field(name = 'Messages', value = f'24h: {sum(summary["hourly"])}\n7d: {sum(daily[-7:])}\n30d: {sum(daily)}')
+        embed.add_field(name = 'Attachments', value = f'7d: {sum(attachments[-7:])}\n30d: {sum(attachments)}')
+        embed.add_field(name = 'Embeds', value = f'7d: {sum(embeds[-7:])}\n30d: {sum(embeds)}')
+        embed.add_field(name = 'Last 24 hours', value = sparkline(summary['hourly']), inline = False)
+        embed.add_field(name = 'Last 30 days', value = sparkline(daily), inline = False)
+        authors = '\n'.join(f'{rank}. <@{author_id}> ({name}): {count}' for rank, (author_id, name, count) in enumerate(summary['authors'], 1))
+        embed.add_field(name = 'Top authors', value = authors or 'No messages yet.', inline = False)
+        await context.send(embed = embed)
+
+    @overwatch_group.command(name='retention', help='Limits how long logged messages are kept, e.g. `retention days: 90 size: 2GB`, or `retention channel: #general days: 30` for one channel; 0 removes a limit')
+    async def overwatch_retention(self, context: commands.Context, *, flags: RetentionFlags):
+        guild_id = str(context.guild.id)
+        channel = flags.channel
+        if channel is not None and channel.id not in self._guilds.get(guild_id, []):
+            return await context.send(f'Channel {channel.mention} is not being logged.', delete_after = 30)
+        if flags.days is not None or flags.size is not None:
+            def set_rule(retention: dict) -> dict:
+                retention = retention or {}
+                rules = retention.setdefault(guild_id, {})
+                rule = rules.setdefault('channels', {}).setdefault(str(channel.id), {}) if channel else rules
+                for key, value in (('days', flags.days), ('size', flags.size)):
+                    if value:
+                        rule[key] = value
+                    elif value is not None:
+                        rule.pop(key, None)
+                if channel and not rule:
+                    del rules['channels'][str(channel.id)]
+                if not rules.get('channels'):
+                    rules.pop('channels', None)
+                if not rules:
+                    del retention[guild_id]
+                return retention
+            await self._config.modify('Retention', set_rule)
+
+        rules = (self._config.s_get('Retention') or {}).get(guild_id, {})
+        embed = discord.Embed(title = 'Message retention')
+        embed.add_field(name = 'Server', value = self._describe_rule(rules), inline = False)
+        for channel_id, rule in rules.get('channels', {}).items():
+            logged = context.guild.get_channel(int(channel_id))
+            embed.add_field(name = f'#{logged.name}' if logged else channel_id, value = self._describe_rule(rule))
+        reports = [self._retention_reports[channel_id] for channel_id in self._guilds.get(guild_id, []) if channel_id in self._retention_reports]
+        if reports:
+            embed.set_footer(text = f'Last run removed {sum(report[0] for report in reports)} messages and reclaimed {format_size(sum(report[1] for report in reports))}')
+        await context.send(embed = embed)
+
+    @overwatch_group.command(name='attachment', help='Sends the archived copy of a logged attachment by its ID')
+    async def overwatch_attachment(self, context: commands.Context, attachment_id: int):
+        archive = self.bot._attachment_archive
+        if archive is None:
+            return await context.send('Attachment archiving is disabled.', delete_after = 30)
+        archived = await archive.get(attachment_id, context.guild.id)
+        if archived is None:
+            return await context.send(f'Attachment `{attachment_id}` has not been archived in this server.', delete_after = 30)
+        path, filename = archived
+        if path.stat().st_size > context.guild.filesize_limit:
+            return await context.send(f'Attachment `{attachment_id}` is too large to upload here.', delete_after = 30)
+        await context.send(file = discord.File(path, filename = filename))
+
+
+async def setup(bot: Bot):
     await bot.add_cog(Overwatch(bot))
\ No newline at end of file
@@ -1,48 +1,89 @@
-from discord.ext import commands
-
-from core.bot import Bot
-from core.cog import CustomCogMixin
-
-class Owner(commands.Cog, CustomCogMixin, command_attrs=dict(hidden=True)):
-
-    async def cog_check(self, context: commands.Context):
-        return await self.bot.is_owner(context.author)
-
-    @commands.command(name = 'shutdown')
-    async def _shutdown(self, context: commands.Context):
-        """
-        Shutdown the bot
-        """
-        self.bot.logger.info('Shutting down from user command...')
-        await context.message.delete()
-        await self.bot.close()
-    
-    @commands.command(name = 'reload', help = 'Reloads all cogs')
-    async def _reload(self, context: commands.Context):
-        """
-        Reload all cogs and data
-        """
-        self.bot.logger.info('Reloading cogs...')
-        await self.bot.load_all_data()
-        await self.bot.reload_all_extensions()
-        await context.send('All data and cogs reloaded!', delete_after = 30)
-        await context.message.delete(delay = 30)
-
-    @commands.command(name = 'kickall', help = 'Kicks all members from current voice channel')
-    async def _kickall(self, context: commands.Context):
-        """
-        Kicks all members from the current voice channel
-        """
-        await context.message.delete(delay = 30)
-
-        if context.author.voice is None:
-            return await context.send('You must be in a voice channel to use this command!', delete_after = 30)
-
-        voice_channel = context.author.voice.channel
-        for member in voice_channel.members:
-            await member.move_to(None)
-        await context.send('All members have been kicked from the voice channel!', delete_after = 5)
-
-
-async def setup(bot: Bot):
+from discord.ext import commands
+from discord import Embed
+import time
+from typing import Literal
+
+from core.bot import Bot
+from core.bulk import BulkAction
+from core.cog import CustomCogMixin
+from core.metrics import metrics
+
+class Owner(commands.Cog, CustomCogMixin, command_attrs=dict(hidden=True)):
+    """
+    Owner-only maintenance commands.
+
+    Needs `voice_states` for kickall, which also relies on the `voice` member cache flag.
+    """
+
+    required_intents = ('voice_states',)
+
+    async def cog_check(self, context: commands.Context):
+        return await self.bot.is_owner(context.author)
+
+    @commands.command(name = 'shutdown')
+    async def _shutdown(self, context: commands.Context):
+        """
+        Shutdown the bot
+        """
+        self.bot.logger.info('Shutting down from user command...')
+        await context.message.delete()
+        await self.bot.close()
+    
+    @commands.command(name = 'reload', help = 'Reloads cogs whose source changed, or every cog with `reload all`')
+    async def _reload(self, context: commands.Context, scope: Literal['all'] = None):
+        """
+        Reload changed cogs and pick up data changed on disk
+        """
+        self.bot.logger.info('Reloading cogs...')
+        await self.bot.load_all_data()
+        timings = await self.bot.reload_all_extensions(force = scope == 'all')
+        if timings:
+            lines = [f'{name[5:]}: {elapsed * 1000:.1f}ms' if elapsed is not None else f'{name[5:]}: failed, see the log' for name, elapsed in sorted(timings.items())]
+            await context.send('Reloaded cogs:\n' + '\n'.join(lines), delete_after = 30)
+        else:
+            await context.send('No cogs changed, data reloaded.', delete_after = 30)
+        await context.message.delete(delay = 30)
+
+    @commands.command(name = 'kickall', help = 'Kicks all members from current voice channel')
+    async def _kickall(self, context: commands.Context):
+        """
+        Kicks all members from the current voice channel
+        """
+        await context.message.delete(delay = 30)
+
+        if context.author.voice is None:
+            return await context.send('You must be in a voice channel to use this command!', delete_after = 30)
+
+        voice_channel = context.author.voice.channel
+        action = BulkAction(f'Kicking members from {voice_channel.name}', voice_channel.members, lambda member: member.move_to(None))
+        await action.run(context, delete_after = 30)
+
+
+    @commands.command(name = 'stats', help = 'Shows latency percentiles for commands, listeners and storage')
+    async def _stats(self, context: commands.Context, action: str = None):
+        """
+        Shows recorded latencies, or clears them with `stats reset`
+        """
+        if action == 'reset':
+            metrics.reset()
+            return await context.send('Statistics have been reset!', delete_after = 30)
+        window = time.monotonic() - metrics.started
+        rows = [f'{"name":<36} {"count":>7} {"p50":>8} {"p95":>8} {"p99":>8}']
+        for name, count, p50, p95, p99 in metrics.summary():
+            rows.append(f'{name[-36:]:<36} {count:>7} {p50 * 1000:>7.1f}ms {p95 * 1000:>7.1f}ms {p99 * 1000:>7.1f}ms')
+        embed = Embed(title = 'Statistics', description = f'Collected over the last `{window:.0f}s`')
+        field, length = [], 0
+        for row in rows:
+            if length + len(row) > 1000:
+                embed.add_field(name = '\u200b', value = '```' + '\n'.join(field) + '```', inline = False)
+                field, length = [], 0
+            field.append(row)
+            length += len(row) + 1
+        embed.add_field(name = '\u200b', value = '```' + '\n'.join(field) + '```', inline = False)
+        if metrics.counters:
+            embed.add_field(name = 'Counters', value = '```' + '\n'.join(f'{name}: {count}' for name, count in sorted(metrics.counters.items())) + '```', inline = False)
+        await context.send(embed = embed, delete_after = 120)
+
+
+async def setup(bot: Bot):
     await bot.add_cog(Owner(bot))
\ No newline at end of file
@@ -1,18 +1,80 @@
-from decouple import config
-from pathlib import Path
-
-# Base Settings
-COMMAND_PREFIX = config('DISCORD_COMMAND_PREFIX', default='$')
-BOT_TOKEN = config('DISCORD_BOT_TOKEN')
-
-# Paths
-BASE_DIR = Path(__file__).resolve().parent.parent
-COGS_DIR = BASE_DIR / 'cogs'
-LOGS_DIR = BASE_DIR / 'logs'
-DATA_DIR = BASE_DIR / 'data'
-
-# Logging
-LOG_FILE = LOGS_DIR / 'bot.log'
-
-# Data
-WATCH_FILE = DATA_DIR / 'overwatch.json'
+from decouple import Csv, config
+from pathlib import Path
+
+# Base Settings
+COMMAND_PREFIX = config('DISCORD_COMMAND_PREFIX', default='$')
+BOT_TOKEN = config('DISCORD_BOT_TOKEN')
+
+# Gateway and caches
+BOT_INTENTS = config('BOT_INTENTS', default='guilds,members,voice_states,guild_messages,dm_messages,guild_reactions,message_content', cast=Csv())
+BOT_MEMBER_CACHE = config('BOT_MEMBER_CACHE', default='voice', cast=Csv())
+BOT_CHUNK_GUILDS = config('BOT_CHUNK_GUILDS', default=False, cast=bool)
+BOT_MAX_MESSAGES = config('BOT_MAX_MESSAGES', default=1000, cast=int)
+
+# Bulk actions
+BULK_CONCURRENCY = config('BULK_CONCURRENCY', default=5, cast=int)
+BULK_RETRIES = config('BULK_RETRIES', default=3, cast=int)
+BULK_PROGRESS_INTERVAL = config('BULK_PROGRESS_INTERVAL', default=2.0, cast=float)
+
+# Admission control, as tokens per second and bucket size for each scope; a size of 0 turns a scope off
+ADMISSION_CONTROL = config('ADMISSION_CONTROL', default=True, cast=bool)
+ADMISSION_USER_RATE = config('ADMISSION_USER_RATE', default=0.5, cast=float)
+ADMISSION_USER_BURST = config('ADMISSION_USER_BURST', default=10.0, cast=float)
+ADMISSION_CHANNEL_RATE = config('ADMISSION_CHANNEL_RATE', default=2.0, cast=float)
+ADMISSION_CHANNEL_BURST = config('ADMISSION_CHANNEL_BURST', default=15.0, cast=float)
+ADMISSION_GUILD_RATE = config('ADMISSION_GUILD_RATE', default=5.0, cast=float)
+ADMISSION_GUILD_BURST = config('ADMISSION_GUILD_BURST', default=40.0, cast=float)
+ADMISSION_COSTS = config('ADMISSION_COSTS', default='purge:5,massban:10,masskick:10,help:2,overwatch export:10,overwatch search:3', cast=Csv())
+
+# Sharding
+SHARD_COUNT = config('SHARD_COUNT', default=0, cast=int)
+CLUSTER_PROCESSES = config('CLUSTER_PROCESSES', default=1, cast=int)
+CLUSTER_RESTART_DELAY = config('CLUSTER_RESTART_DELAY', default=5.0, cast=float)
+CLUSTER_SYNC_INTERVAL = config('CLUSTER_SYNC_INTERVAL', default=2.0, cast=float)
+
+# Paths
+BASE_DIR = Path(__file__).resolve().parent.parent
+COGS_DIR = BASE_DIR / 'cogs'
+LOGS_DIR = Path(config('LOGS_DIR', default=BASE_DIR / 'logs'))
+DATA_DIR = Path(config('DATA_DIR', default=BASE_DIR / 'data'))
+
+# Logging
+LOG_FILE = LOGS_DIR / 'bot.log'
+LOG_FORMAT = config('LOG_FORMAT', default='text')
+LOG_MAX_BYTES = config('LOG_MAX_BYTES', default=10 * 1024 * 1024, cast=int)
+LOG_ROTATE_WHEN = config('LOG_ROTATE_WHEN', default='')
+LOG_BACKUP_COUNT = config('LOG_BACKUP_COUNT', default=5, cast=int)
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', default=10000, cast=int)
+
+# Metrics
+METRICS_EXPORT_FILE = config('METRICS_EXPORT_FILE', default='')
+METRICS_EXPORT_INTERVAL = config('METRICS_EXPORT_INTERVAL', default=15.0, cast=float)
+
+# Data
+DATA_BACKEND = config('DATA_BACKEND', default='json')
+WATCH_FILE = DATA_DIR / 'overwatch.json'
+PREFIX_FILE = DATA_DIR / 'prefixes.json'
+DATA_FLUSH_DELAY = config('DATA_FLUSH_DELAY', default=1.0, cast=float)
+DATA_COMPACT_JSON = config('DATA_COMPACT_JSON', default=False, cast=bool)
+
+# Overwatch
+OVERWATCH_FLUSH_INTERVAL = config('OVERWATCH_FLUSH_INTERVAL', default=1.0, cast=float)
+OVERWATCH_FLUSH_SIZE = config('OVERWATCH_FLUSH_SIZE', default=500, cast=int)
+OVERWATCH_SEGMENT_SIZE = config('OVERWATCH_SEGMENT_SIZE', default=8 * 1024 * 1024, cast=int)
+OVERWATCH_BACKFILL_BATCH = config('OVERWATCH_BACKFILL_BATCH', default=500, cast=int)
+OVERWATCH_ACTIVITY_INTERVAL = config('OVERWATCH_ACTIVITY_INTERVAL', default=60.0, cast=float)
+OVERWATCH_SEGMENT_AGE = config('OVERWATCH_SEGMENT_AGE', default=24 * 60 * 60, cast=float)
+OVERWATCH_INGEST_WORKER = config('OVERWATCH_INGEST_WORKER', default=False, cast=bool)
+OVERWATCH_INGEST_QUEUE_SIZE = config('OVERWATCH_INGEST_QUEUE_SIZE', default=256, cast=int)
+OVERWATCH_INGEST_BATCH = config('OVERWATCH_INGEST_BATCH', default=200, cast=int)
+OVERWATCH_INGEST_BUFFER = config('OVERWATCH_INGEST_BUFFER', default=10000, cast=int)
+OVERWATCH_INGEST_SPILL_SIZE = config('OVERWATCH_INGEST_SPILL_SIZE', default=256 * 1024 * 1024, cast=int)
+OVERWATCH_RETENTION_INTERVAL = config('OVERWATCH_RETENTION_INTERVAL', default=15 * 60, cast=float)
+OVERWATCH_RETENTION_BATCH = config('OVERWATCH_RETENTION_BATCH', default=1000, cast=int)
+
+# Attachment archive
+ATTACHMENT_ARCHIVE = config('ATTACHMENT_ARCHIVE', default=False, cast=bool)
+ATTACHMENT_ARCHIVE_SIZE = config('ATTACHMENT_ARCHIVE_SIZE', default=10 * 1024 * 1024 * 1024, cast=int)
+ATTACHMENT_MAX_FILE_SIZE = config('ATTACHMENT_MAX_FILE_SIZE', default=25 * 1024 * 1024, cast=int)
+ATTACHMENT_CONCURRENCY = config('ATTACHMENT_CONCURRENCY', default=4, cast=int)
+ATTACHMENT_QUEUE_SIZE = config('ATTACHMENT_QUEUE_SIZE', default=1000, cast=int)
@@ -0,0 +1,157 @@
+from array import array
+import asyncio
+from functools import partial
+import time
+from typing import Iterable, Optional
+
+from core.handler import JSONHandler
+from core.metrics import metrics
+
+__all__ = ['ChannelActivity', 'GuildActivity', 'open_guild_activity']
+
+
+class ChannelActivity:
+    """
+    Rolling activity counters for one channel.
+
+    Counts live in fixed-size ring buffers of hourly and daily bins, each slot stamped with the
+    hour or day it holds so stale slots are reset as the ring wraps around. Top authors are kept
+    with the space-saving algorithm: at most `top_authors` are tracked, and a new author replaces
+    the least active one and inherits its count, which keeps every heavy hitter in the table with
+    an overestimate bounded by the count it inherited.
+    """
+
+    hours = 24 * 7
+    days = 90
+    top_authors = 200
+
+    __slots__ = ('hourly', 'hour_stamps', 'daily', 'day_stamps', 'attachments', 'embeds', 'authors', 'names', 'dirty')
+
+    def __init__(self, data: dict = None):
+        data = data or {}
+        self.hourly = array('I', data.get('hourly', [0] * self.hours))
+        self.hour_stamps = array('q', data.get('hour_stamps', [-1] * self.hours))
+        self.daily = array('I', data.get('daily', [0] * self.days))
+        self.attachments = array('I', data.get('attachments', [0] * self.days))
+        self.embeds = array('I', data.get('embeds', [0] * self.days))
+        self.day_stamps = array('q', data.get('day_stamps', [-1] * self.days))
+        self.authors = {int(author_id): count for author_id, count in data.get('authors', {}).items()}
+        self.names = {int(author_id): name for author_id, name in data.get('names', {}).items()}
+        self.dirty = False
+
+    @staticmethod
+    def _slot(stamps: array, bins: Iterable[array], stamp: int) -> Optional[int]:
+        slot = stamp % len(stamps)
+        if stamps[slot] != stamp:
+            if stamps[slot] > stamp:
+                return None
+            stamps[slot] = stamp
+            for counts in bins:
+                counts[slot] = 0
+        return slot
+
+    def add(self, timestamp: float, author_id: int, author_name: str, attachments: int = 0, embeds: int = 0) -> None:
+        hour = int(timestamp // 3600)
+        slot = self._slot(self.hour_stamps, (self.hourly,), hour)
+        if slot is not None:
+            self.hourly[slot] += 1
+        slot = self._slot(self.day_stamps, (self.daily, self.attachments, self.embeds), hour // 24)
+        if slot is not None:
+            self.daily[slot] += 1
+            self.attachments[slot] += attachments
+            self.embeds[slot] += embeds
+        if author_id in self.authors:
+            self.authors[author_id] += 1
+        elif len(self.authors) < self.top_authors:
+            self.authors[author_id] = 1
+        else:
+            evicted = min(self.authors, key=self.authors.get)
+            self.authors[author_id] = self.authors.pop(evicted) + 1
+            self.names.pop(evicted, None)
+        self.names[author_id] = author_name
+        self.dirty = True
+
+    @staticmethod
+    def window(counts: array, stamps: array, last: int, length: int) -> list:
+        """
+        Returns the `length` bins ending at stamp `last`, oldest first, with missing bins as 0
+        """
+        size = len(stamps)
+        return [counts[stamp % size] if stamps[stamp % size] == stamp else 0 for stamp in range(last - length + 1, last + 1)]
+
+    def to_dict(self) -> dict:
+        return {
+            'hourly': self.hourly.tolist(), 'hour_stamps': self.hour_stamps.tolist(),
+            'daily': self.daily.tolist(), 'attachments': self.attachments.tolist(), 'embeds': self.embeds.tolist(),
+            'day_stamps': self.day_stamps.tolist(),
+            'authors': self.authors, 'names': self.names,
+        }
+
+
+class GuildActivity:
+    """
+    Activity counters for the watched channels of one guild, persisted to a compact JSON document
+    keyed by channel. Counters are updated in memory on every message and written by `flush`.
+    """
+
+    handler: JSONHandler
+    channels: dict[int, ChannelActivity]
+
+    def __init__(self, filename: str, *args, **kwargs):
+        self.handler = JSONHandler(filename, compact=True, **kwargs)
+        self.channels = {int(channel_id): ChannelActivity(data) for channel_id, data in self.handler.s_read().items()}
+
+    def channel(self, channel_id: int) -> ChannelActivity:
+        activity = self.channels.get(channel_id)
+        if activity is None:
+            activity = self.channels[channel_id] = ChannelActivity()
+        return activity
+
+    async def flush(self) -> None:
+        for channel_id, activity in self.channels.items():
+            if activity.dirty:
+                activity.dirty = False
+                await self.handler.update(str(channel_id), activity.to_dict())
+        await self.handler.flush()
+
+    async def close(self) -> None:
+        await self.flush()
+        await self.handler.close()
+
+    def summary(self, channel_ids: Iterable[int], now: float = None, top: int = 10) -> dict:
+        """
+        Combines the counters of the given channels into hourly and daily series ending now
+        """
+        now = now if now is not None else time.time()
+        hour = int(now // 3600)
+        day = hour // 24
+        hourly, daily, attachments, embeds, authors, names = [0] * 24, [0] * 30, [0] * 30, [0] * 30, {}, {}
+        for channel_id in channel_ids:
+            activity = self.channels.get(channel_id)
+            if activity is None:
+                continue
+            for series, counts, stamps, last in (
+                (hourly, activity.hourly, activity.hour_stamps, hour),
+                (daily, activity.daily, activity.day_stamps, day),
+                (attachments, activity.attachments, activity.day_stamps, day),
+                (embeds, activity.embeds, activity.day_stamps, day),
+            ):
+                for index, count in enumerate(ChannelActivity.window(counts, stamps, last, len(series))):
+                    series[index] += count
+            for author_id, count in activity.authors.items():
+                authors[author_id] = authors.get(author_id, 0) + count
+            names.update(activity.names)
+        ranked = sorted(authors.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            'hourly': hourly, 'daily': daily, 'attachments': attachments, 'embeds': embeds,
+            'authors': [(author_id, names.get(author_id, str(author_id)), count) for author_id, count in ranked],
+        }
+
+
+async def open_guild_activity(filename: str, **kwargs) -> GuildActivity:
+    """
+    Opens a guild's activity counters. Opening reads and decodes the whole document, so it is done
+    in the executor.
+    """
+    loop = kwargs['loop'] = kwargs.get('loop') or asyncio.get_running_loop()
+    return await metrics.run_in_executor(loop, 'executor.GuildActivity.open', partial(GuildActivity, filename, **kwargs))
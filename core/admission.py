@@ -0,0 +1,109 @@
+import time
+from typing import Optional
+
+__all__ = ['AdmissionControl', 'TokenBuckets', 'parse_costs']
+
+def parse_costs(items: list[str]) -> dict[str, float]:
+    """
+    Parses `name:cost` pairs, such as `purge:5`, into a cost per command name
+    """
+    costs = {}
+    for item in items:
+        name, separator, cost = item.rpartition(':')
+        if not separator or not name:
+            raise ValueError(f'Invalid ADMISSION_COSTS entry: {item}')
+        costs[name.strip()] = float(cost)
+    return costs
+
+
+class TokenBuckets:
+    """
+    A token bucket for every key of one scope, such as every user.
+
+    Each bucket holds up to `burst` tokens and refills at `rate` tokens per second. Buckets are
+    stored as `[tokens, updated]` pairs and only refilled when they are looked at. A bucket that
+    has been idle long enough to refill completely is the same as a missing one, so those are
+    pruned once the table grows past `max_keys`.
+    """
+
+    __slots__ = ('rate', 'burst', 'max_keys', 'buckets')
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def available(self, key: int, now: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def take(self, key: int, tokens: float, now: float) -> None:
+        """
+        Takes tokens that `available` showed are there
+        """
+        self.buckets[key] = [self.available(key, now) - tokens, now]
+        if len(self.buckets) > self.max_keys:
+            self.prune(now)
+
+    def prune(self, now: float) -> None:
+        idle = self.burst / self.rate if self.rate > 0 else float('inf')
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < idle}
+
+
+class AdmissionControl:
+    """
+    Decides whether a command may run before it is dispatched.
+
+    A command must fit in the token bucket of its author, its channel and its guild, and takes its
+    cost from all three only when it fits in each of them, so requests that are turned away do
+    not drain the shared buckets for anyone else. `admit` returns the scope that rejected a
+    command, or None. Members who can manage messages skip the channel and guild buckets, which
+    keeps moderators responsive while a raid exhausts them.
+
+    A cost larger than the smallest burst could never fit in a bucket, so such a configuration is
+    rejected with a ValueError instead of locking the command out for everyone.
+    """
+
+    scopes: dict[str, TokenBuckets]
+    costs: dict[str, float]
+    default_cost: float
+
+    def __init__(self, limits: dict[str, tuple[float, float]], costs: dict[str, float] = None, default_cost: float = 1.0):
+        self.scopes = {scope: TokenBuckets(rate, burst) for scope, (rate, burst) in limits.items() if burst > 0}
+        self.costs = costs or {}
+        self.default_cost = default_cost
+        if self.scopes:
+            scope, buckets = min(self.scopes.items(), key=lambda item: item[1].burst)
+            for name, cost in [*self.costs.items(), (None, default_cost)]:
+                if cost > buckets.burst:
+                    raise ValueError(f'Admission cost {cost:g} of {name or "other commands"} exceeds the {scope} burst of {buckets.burst:g}')
+
+    def cost(self, command_name: Optional[str]) -> float:
+        """
+        Looks up a command by its qualified name, then by its top-level name
+        """
+        if command_name is None:
+            return self.default_cost
+        cost = self.costs.get(command_name)
+        if cost is None:
+            cost = self.costs.get(command_name.split(' ', 1)[0], self.default_cost)
+        return cost
+
+    def admit(self, command_name: Optional[str], user_id: int, channel_id: int, guild_id: Optional[int], moderator: bool = False, now: float = None) -> Optional[str]:
+        now = time.monotonic() if now is None else now
+        cost = self.cost(command_name)
+        keys = [('user', user_id)]
+        if not moderator:
+            keys.append(('channel', channel_id))
+            if guild_id is not None:
+                keys.append(('guild', guild_id))
+        buckets = [(scope, self.scopes[scope], key) for scope, key in keys if scope in self.scopes]
+        for scope, bucket, key in buckets:
+            if bucket.available(key, now) < cost:
+                return scope
+        for _, bucket, key in buckets:
+            bucket.take(key, cost, now)
+        return None
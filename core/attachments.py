@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+import time
+from typing import Any, Optional
+import uuid
+
+import aiohttp
+
+from config.settings import DATA_DIR
+from core.metrics import metrics
+from core.sqlite import SQLiteDatabase
+
+__all__ = ['AttachmentArchive']
+
+
+class AttachmentArchive:
+    """
+    Content-addressed store for the attachments of watched messages.
+
+    Attachment URLs expire, so files are downloaded while they are still valid and stored under the
+    SHA-256 of their contents, which stores a reposted file once however many messages carry it.
+    Downloads are queued by the ingest path and run by a fixed pool of workers sharing one pooled
+    HTTP session, so logging a message never waits on the network; when the queue is full new
+    attachments are dropped rather than applying backpressure to ingestion. Once the archive grows
+    past `max_bytes` the least recently used files are evicted.
+
+    The index is a SQLite database next to the files. It records the size and last use of every
+    object, and the object, original filename, guild and channel of every attachment, so each
+    download or retrieval only writes the rows it changes. An attachment is only handed out to the
+    guild it was posted in.
+    """
+
+    directory: Path
+    loop: asyncio.AbstractEventLoop
+    max_bytes: int
+    max_file_size: int
+    concurrency: int
+    size: int
+    files: int
+    attachments: int
+    _database: Optional[SQLiteDatabase]
+    _queue: asyncio.Queue
+    _session: Optional[aiohttp.ClientSession]
+    _workers: list[asyncio.Task]
+
+    def __init__(self, directory: str, *args, max_bytes: int, max_file_size: int, concurrency: int = 4, queue_size: int = 1000, **kwargs):
+        self.directory = DATA_DIR / directory
+        self.loop = kwargs.pop('loop', None) or asyncio.get_running_loop()
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.concurrency = max(concurrency, 1)
+        self.size = self.files = self.attachments = 0
+        self._database = None
+        self._queue = asyncio.Queue(queue_size)
+        self._session = None
+        self._workers = []
+
+    def _object_path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    def s_open(self) -> None:
+        (self.directory / 'tmp').mkdir(parents=True, exist_ok=True)
+        self._database = database = SQLiteDatabase.open(f'{self.directory.relative_to(DATA_DIR)}/index.sqlite3')
+        database.execute('CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL)')
+        database.execute('CREATE INDEX IF NOT EXISTS objects_used ON objects (used)')
+        database.execute('CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY, digest TEXT NOT NULL, filename TEXT NOT NULL, guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL)')
+        database.execute('CREATE INDEX IF NOT EXISTS attachments_digest ON attachments (digest)')
+        (self.files, self.size), = database.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects')
+        (self.attachments,), = database.execute('SELECT COUNT(*) FROM attachments')
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        if self._database is None:
+            await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_open', self.s_open)
+        self._session = aiohttp.ClientSession(
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+            timeout = aiohttp.ClientTimeout(total=300, sock_read=60),
+        )
+        self._workers = [self.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def enqueue(self, attachment_id: int, filename: str, url: str, size: int, guild_id: int, channel_id: int) -> bool:
+        """
+        Queues an attachment for download; called from the ingest path so it never waits
+        """
+        if size > self.max_file_size:
+            metrics.increment('attachments.skipped')
+            return False
+        try:
+            self._queue.put_nowait((attachment_id, filename, url, guild_id, channel_id))
+        except asyncio.QueueFull:
+            metrics.increment('attachments.dropped')
+            return False
+        return True
+
+    def s_get(self, attachment_id: int, guild_id: int) -> Optional[tuple[str, str]]:
+        rows = self._database.execute('SELECT digest, filename FROM attachments WHERE id = ? AND guild_id = ?', (attachment_id, guild_id))
+        if not rows:
+            return None
+        digest, filename = rows[0]
+        self._database.execute('UPDATE objects SET used = ? WHERE digest = ?', (time.time(), digest))
+        return digest, filename
+
+    async def get(self, attachment_id: int, guild_id: int) -> Optional[tuple[Path, str]]:
+        """
+        Returns the archived file and original filename of an attachment posted in `guild_id`,
+        counting it as used
+        """
+        archived = await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_get', self.s_get, attachment_id, guild_id)
+        if archived is None:
+            return None
+        digest, filename = archived
+        return self._object_path(digest), filename
+
+    async def _worker(self):
+        while True:
+            attachment = await self._queue.get()
+            try:
+                await self._archive(*attachment)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                metrics.increment('attachments.failed')
+            finally:
+                self._queue.task_done()
+
+    def s_has(self, attachment_id: int) -> bool:
+        return bool(self._database.execute('SELECT 1 FROM attachments WHERE id = ?', (attachment_id,)))
+
+    @staticmethod
+    def s_store(temp: Path, target: Path) -> bool:
+        """
+        Moves a download into place, returning False if the object already existed
+        """
+        if target.exists():
+            temp.unlink()
+            return False
+        target.parent.mkdir(exist_ok=True)
+        os.replace(temp, target)
+        return True
+
+    def s_add(self, attachment_id: int, digest: str, size: int, filename: str, guild_id: int, channel_id: int) -> bool:
+        """
+        Records an archived attachment, returning whether its object is new to the index
+        """
+        stored = bool(self._database.execute('SELECT 1 FROM objects WHERE digest = ?', (digest,)))
+        self._database.execute_many([
+            ('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', [(digest, size, time.time())]),
+            ('INSERT OR IGNORE INTO attachments VALUES (?, ?, ?, ?, ?)', [(attachment_id, digest, filename, guild_id, channel_id)]),
+        ])
+        return not stored
+
+    async def _download(self, url: str, temp: Path) -> tuple[str, int]:
+        digest, size = hashlib.sha256(), 0
+        async with self._session.get(url) as response:
+            response.raise_for_status()
+            with temp.open('wb') as file:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_file_size:
+                        raise ValueError(f'Attachment is larger than {self.max_file_size} bytes')
+                    digest.update(chunk)
+                    await self.loop.run_in_executor(None, file.write, chunk)
+        return digest.hexdigest(), size
+
+    async def _archive(self, attachment_id: int, filename: str, url: str, guild_id: int, channel_id: int) -> None:
+        if await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_has', self.s_has, attachment_id):
+            return
+        temp = self.directory / 'tmp' / uuid.uuid4().hex
+        started = time.perf_counter()
+        try:
+            digest, size = await self._download(url, temp)
+            await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_store', self.s_store, temp, self._object_path(digest))
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        finally:
+            metrics.observe('attachments.download', time.perf_counter() - started)
+        if await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_add', self.s_add, attachment_id, digest, size, filename, guild_id, channel_id):
+            self.size += size
+            self.files += 1
+            metrics.increment('attachments.stored')
+        else:
+            metrics.increment('attachments.deduplicated')
+        self.attachments += 1
+        if self.size > self.max_bytes:
+            await self._evict()
+
+    def s_evict(self, excess: int) -> tuple[int, int, int]:
+        """
+        Removes the least recently used objects holding at least `excess` bytes, always keeping the
+        latest one; returns the objects, bytes and attachments removed
+        """
+        files = reclaimed = attachments = 0
+        while reclaimed < excess:
+            rows = self._database.execute('SELECT digest, size FROM objects WHERE used < (SELECT MAX(used) FROM objects) ORDER BY used LIMIT 100')
+            if not rows:
+                break
+            evicted = []
+            for digest, size in rows:
+                if reclaimed >= excess:
+                    break
+                evicted.append((digest,))
+                reclaimed += size
+            (count,), = self._database.execute(f'SELECT COUNT(*) FROM attachments WHERE digest IN ({", ".join("?" * len(evicted))})', tuple(digest for digest, in evicted))
+            self._database.execute_many([
+                ('DELETE FROM attachments WHERE digest = ?', evicted),
+                ('DELETE FROM objects WHERE digest = ?', evicted),
+            ])
+            for digest, in evicted:
+                self._object_path(digest).unlink(missing_ok=True)
+            files, attachments = files + len(evicted), attachments + count
+        return files, reclaimed, attachments
+
+    async def _evict(self) -> None:
+        """
+        Removes the least recently used objects until the archive fits in `max_bytes`
+        """
+        files, size, attachments = await metrics.run_in_executor(self.loop, 'executor.AttachmentArchive.s_evict', self.s_evict, self.size - self.max_bytes)
+        self.files, self.size, self.attachments = self.files - files, self.size - size, self.attachments - attachments
+        metrics.increment('attachments.evicted', files)
+
+    def stats(self) -> dict[str, Any]:
+        return {'files': self.files, 'attachments': self.attachments, 'bytes': self.size, 'queued': self._queue.qsize()}
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._database is not None:
+            self._database.release()
+            self._database = None
@@ -1,129 +1,416 @@
-from datetime import datetime
-from discord.ext import commands
-from discord.utils import oauth_url
-from discord import Intents, Permissions
-import logging
-
-from config.settings import BOT_TOKEN, COGS_DIR, DATA_DIR, LOGS_DIR, LOG_FILE, WATCH_FILE
-from core.handler import JSONHandler
-from core.help import Help
-from core.prefix import get_prefix
-
-__all__ = ['Bot']
-
-class Bot(commands.Bot):
-
-    token: str
-    logger: logging.Logger
-    start_time: datetime
-
-    def __init__(self, **kwargs):
-        """
-        Initialising bot with state variables and setting required attributes
-        """
-        if not BOT_TOKEN:
-            raise ValueError('No bot token provided')
-        self.token = BOT_TOKEN
-
-        self._ensure_paths_exist()
-
-        self.logger = self._setup_logger(LOG_FILE)
-        self.start_time = datetime.now()
-        
-        super().__init__(
-            case_insensitive = True,
-            command_prefix = get_prefix,
-            heartbeat_timeout = 150.0,
-            help_command = Help(),
-            intents = Intents.all(),
-            **kwargs,
-        )
-    
-    def _setup_logger(self, log_file: str) -> logging.Logger:
-        """
-        Sets up the logger for the bot.
-        """
-        logger = logging.getLogger('bot')
-        logger.setLevel(logging.DEBUG)
-
-        file_handler = logging.FileHandler(log_file, encoding='utf-8')
-        file_handler.setLevel(logging.INFO)
-        file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(file_formatter)
-
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        console_formatter = logging.Formatter('%(levelname)s: %(message)s')
-        console_handler.setFormatter(console_formatter)
-
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
-
-        return logger
-
-    def _ensure_paths_exist(self):
-        """
-        Ensures that the log and data directories exist
-        """
-        if not LOGS_DIR.exists():
-            LOGS_DIR.mkdir(parents = True)
-        if not DATA_DIR.exists():
-            DATA_DIR.mkdir(parents = True)
-        
-    async def start(self, *args, **kwargs):
-        """
-        Start the bot
-        """
-        if not COGS_DIR.exists():
-            self.logger.error('No cogs directory found')
-            raise FileNotFoundError('No cogs directory found')
-        
-        self.logger.info('Loading data...')
-        await self.load_all_data()
-
-        self.logger.info('Loading cogs...')
-        await self.reload_all_extensions()
-
-        self.logger.info('Starting the bot...')
-        await super().start(self.token, *args, **kwargs)
-
-    async def load_all_data(self):
-        """
-        Load all the data
-        """
-        self._overwatch_handler = JSONHandler(WATCH_FILE, default_data={'Guilds': {}})
-    
-    async def reload_all_extensions(self):
-        """
-        Reloads all the extensions
-        """
-        for cog in COGS_DIR.glob('*.py'):
-            try:
-                await self.reload_extension(f'cogs.{cog.stem}')
-                self.logger.info(f'Reloaded cog: {cog.stem}')
-            except commands.ExtensionNotLoaded:
-                try:
-                    await self.load_extension(f'cogs.{cog.stem}')
-                    self.logger.info(f'Loaded cog: {cog.stem}')
-                except Exception as e:
-                    self.logger.error(f'Failed to load cog {cog.stem}: {e}')
-            except Exception as e:
-                self.logger.error(f'Failed to load cog {cog.stem}: {e}')
-
-    async def on_ready(self):
-        """
-        On bot ready event
-        """
-        self.logger.info('Generating invite URL...')
-        self.client_id = (await self.application_info()).id
-        self.invite_url = oauth_url(client_id = self.client_id, permissions = Permissions(administrator=True))
-
-        self.logger.info(f'{self.user.name} is online!')
-
-    async def on_command_error(self, context: commands.Context, exception: commands.CommandError):
-        """
-        Handle errors in command execution.
-        """
-        self.logger.error(f"An error occurred while processing the command '{context.command}': {exception}", exc_info=True)
-        if self.is_owner(context.author):
-            await context.send(f"An error occurred: {exception}")
+import asyncio
+from datetime import datetime
+from discord.ext import commands
+from discord.utils import oauth_url
+from discord import Message, Permissions
+import logging
+from logging.handlers import QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+import os
+from pathlib import Path
+import queue
+import time
+from typing import Optional
+
+from config.settings import (
+    ADMISSION_CHANNEL_BURST, ADMISSION_CHANNEL_RATE, ADMISSION_CONTROL, ADMISSION_COSTS, ADMISSION_GUILD_BURST, ADMISSION_GUILD_RATE, ADMISSION_USER_BURST, ADMISSION_USER_RATE,
+    ATTACHMENT_ARCHIVE, ATTACHMENT_ARCHIVE_SIZE, ATTACHMENT_CONCURRENCY, ATTACHMENT_MAX_FILE_SIZE, ATTACHMENT_QUEUE_SIZE, BOT_CHUNK_GUILDS, BOT_INTENTS, BOT_MAX_MESSAGES, BOT_MEMBER_CACHE, BOT_TOKEN, CLUSTER_PROCESSES, CLUSTER_SYNC_INTERVAL, COGS_DIR, DATA_COMPACT_JSON, DATA_DIR, DATA_FLUSH_DELAY, LOGS_DIR, LOG_BACKUP_COUNT, LOG_FILE,
+    LOG_FORMAT, LOG_MAX_BYTES, LOG_QUEUE_SIZE, LOG_ROTATE_WHEN, METRICS_EXPORT_FILE, METRICS_EXPORT_INTERVAL, OVERWATCH_INGEST_BATCH, OVERWATCH_INGEST_BUFFER,
+    OVERWATCH_INGEST_QUEUE_SIZE, OVERWATCH_INGEST_SPILL_SIZE, OVERWATCH_INGEST_WORKER, PREFIX_FILE, SHARD_COUNT, WATCH_FILE,
+)
+from core.activity import GuildActivity
+from core.admission import AdmissionControl, parse_costs
+from core.attachments import AttachmentArchive
+from core.handler import JSONHandler
+from core.extensions import file_digest, find_imports, load_waves
+from core.help import Help
+from core.ingest import IngestClient, RemoteRecordStorage
+from core.logs import JSONFormatter, LogQueueHandler
+from core.memory import build_intents, build_member_cache_flags, cache_report
+from core.metrics import metrics
+from core.prefix import get_prefix, invalidate_prefix
+from core.search import SearchIndex
+from core.storage import RecordStorage
+
+__all__ = ['Bot']
+
+class Bot(commands.AutoShardedBot):
+
+    token: str
+    cluster_id: Optional[int]
+    logger: logging.Logger
+    log_listener: QueueListener
+    start_time: datetime
+    _message_handlers: dict[int, RecordStorage | RemoteRecordStorage]
+    _ingest: Optional[IngestClient]
+    _search_indexes: dict[int, SearchIndex]
+    _activity: dict[int, GuildActivity]
+    _attachment_archive: Optional[AttachmentArchive]
+    _reported_caches: bool
+    _extension_stamps: dict[str, tuple[int, str]]
+    _extension_imports: dict[str, tuple[int, set[str]]]
+
+    def __init__(self, **kwargs):
+        """
+        Initialising bot with state variables and setting required attributes
+        """
+        if not BOT_TOKEN:
+            raise ValueError('No bot token provided')
+        self.token = BOT_TOKEN
+        self.cluster_id = kwargs.pop('cluster_id', None)
+
+        self._ensure_paths_exist()
+
+        self.logger = self._setup_logger(self._cluster_path(LOG_FILE))
+        self.start_time = datetime.now()
+        self._message_handlers = {}
+        self._search_indexes = {}
+        self._activity = {}
+        self._attachment_archive = None
+        self._ingest = None
+        self._reported_caches = False
+        self._extension_stamps = {}
+        self._extension_imports = {}
+        self._help_cache = {}
+        self._admission = AdmissionControl(
+            {
+                'user': (ADMISSION_USER_RATE, ADMISSION_USER_BURST),
+                'channel': (ADMISSION_CHANNEL_RATE, ADMISSION_CHANNEL_BURST),
+                'guild': (ADMISSION_GUILD_RATE, ADMISSION_GUILD_BURST),
+            },
+            parse_costs(ADMISSION_COSTS),
+        ) if ADMISSION_CONTROL else None
+
+        intents = build_intents(BOT_INTENTS)
+        super().__init__(
+            case_insensitive = True,
+            chunk_guilds_at_startup = BOT_CHUNK_GUILDS,
+            command_prefix = get_prefix,
+            heartbeat_timeout = 150.0,
+            help_command = Help(),
+            intents = intents,
+            max_messages = BOT_MAX_MESSAGES or None,
+            member_cache_flags = build_member_cache_flags(BOT_MEMBER_CACHE, intents),
+            shard_count = kwargs.pop('shard_count', SHARD_COUNT or None),
+            **kwargs,
+        )
+    
+    def _setup_logger(self, log_file: str) -> logging.Logger:
+        """
+        Sets up the logger for the bot.
+
+        Records are put on a queue and written by a listener thread, so file and console I/O
+        never runs on the event loop.
+        """
+        logger = logging.getLogger('bot')
+        logger.setLevel(logging.DEBUG)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+        if LOG_ROTATE_WHEN:
+            file_handler = TimedRotatingFileHandler(log_file, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        else:
+            file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        file_handler.setLevel(logging.INFO)
+        if LOG_FORMAT == 'json':
+            file_formatter = JSONFormatter()
+        else:
+            file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler.setFormatter(file_formatter)
+
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.DEBUG)
+        console_formatter = logging.Formatter('%(levelname)s: %(message)s')
+        console_handler.setFormatter(console_formatter)
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        self.log_listener.start()
+        logger.addHandler(LogQueueHandler(log_queue))
+
+        return logger
+
+    def _cluster_path(self, filepath: Path) -> Path:
+        """
+        Gives each cluster process its own copy of a per-process file
+        """
+        if self.cluster_id is None:
+            return filepath
+        return filepath.with_name(f'{filepath.stem}.cluster{self.cluster_id}{filepath.suffix}')
+
+    def _ensure_paths_exist(self):
+        """
+        Ensures that the log and data directories exist
+        """
+        if not LOGS_DIR.exists():
+            LOGS_DIR.mkdir(parents = True)
+        if not DATA_DIR.exists():
+            DATA_DIR.mkdir(parents = True)
+        
+    async def setup_hook(self):
+        """
+        Start background monitoring once the event loop is available
+        """
+        self.loop.create_task(metrics.monitor_loop_lag())
+        if METRICS_EXPORT_FILE:
+            self.loop.create_task(self._export_metrics(self._cluster_path(Path(METRICS_EXPORT_FILE))))
+        if CLUSTER_PROCESSES > 1:
+            self.loop.create_task(self._sync_shared_data())
+        if OVERWATCH_INGEST_WORKER:
+            self._ingest = IngestClient(
+                self._cluster_path(DATA_DIR / 'overwatch' / 'ingest.spill'),
+                queue_size=OVERWATCH_INGEST_QUEUE_SIZE, batch_size=OVERWATCH_INGEST_BATCH,
+                spill_size=OVERWATCH_INGEST_SPILL_SIZE, max_buffered=OVERWATCH_INGEST_BUFFER, loop=self.loop,
+            )
+            self._ingest.start()
+        if ATTACHMENT_ARCHIVE:
+            self._attachment_archive = AttachmentArchive(
+                self._cluster_path(Path('attachments')).name,
+                max_bytes=ATTACHMENT_ARCHIVE_SIZE, max_file_size=ATTACHMENT_MAX_FILE_SIZE,
+                concurrency=ATTACHMENT_CONCURRENCY, queue_size=ATTACHMENT_QUEUE_SIZE, loop=self.loop,
+            )
+            await self._attachment_archive.start()
+
+    async def _export_metrics(self, filepath: Path):
+        """
+        Periodically writes the metrics in Prometheus text format for a node exporter to collect
+        """
+        def write(payload: str):
+            temp_filepath = filepath.with_suffix('.tmp')
+            temp_filepath.write_text(payload, encoding='utf-8')
+            os.replace(temp_filepath, filepath)
+        while not self.is_closed():
+            await asyncio.sleep(METRICS_EXPORT_INTERVAL)
+            try:
+                await self.loop.run_in_executor(None, write, metrics.prometheus())
+            except OSError as e:
+                self.logger.error(f'Failed to export metrics: {e}')
+
+    async def _sync_shared_data(self):
+        """
+        Picks up data changed by other cluster processes, dispatching `shared_data_changed` with the handler name
+        """
+        while not self.is_closed():
+            await asyncio.sleep(CLUSTER_SYNC_INTERVAL)
+            await self._refresh_data()
+
+    async def _refresh_data(self):
+        for name in ('_overwatch_handler', '_prefix_handler'):
+            try:
+                changed = await getattr(self, name).refresh()
+            except Exception as e:
+                self.logger.error(f'Failed to refresh {name}: {e}')
+                continue
+            if changed:
+                if name == '_prefix_handler':
+                    invalidate_prefix()
+                self.dispatch('shared_data_changed', name)
+
+    async def process_commands(self, message: Message):
+        """
+        Parses and invokes commands, silently dropping those that admission control turns away
+        """
+        if message.author.bot:
+            return
+        context = await self.get_context(message)
+        if context.prefix is not None and self._admission is not None and not await self._admit(context):
+            return
+        await self.invoke(context)
+
+    async def _admit(self, context: commands.Context) -> bool:
+        """
+        Charges a command to the admission buckets of its author, channel and guild; owners are never
+        limited. Rejections are counted per scope for the owner `stats` command.
+        """
+        author = context.author
+        if await self.is_owner(author):
+            return True
+        permissions = getattr(author, 'guild_permissions', None)
+        scope = self._admission.admit(
+            context.command.qualified_name if context.command else None,
+            author.id, context.channel.id, context.guild.id if context.guild else None,
+            moderator=permissions is not None and permissions.manage_messages,
+        )
+        if scope is None:
+            return True
+        metrics.increment(f'admission.rejected.{scope}')
+        return False
+
+    async def invoke(self, context: commands.Context):
+        """
+        Invoke a command, recording how long it took
+        """
+        started = time.perf_counter()
+        try:
+            await super().invoke(context)
+        finally:
+            if context.command is not None:
+                metrics.observe(f'command.{context.command.qualified_name}', time.perf_counter() - started)
+
+    async def start(self, *args, **kwargs):
+        """
+        Start the bot
+        """
+        if not COGS_DIR.exists():
+            self.logger.error('No cogs directory found')
+            raise FileNotFoundError('No cogs directory found')
+        
+        self.logger.info('Loading data...')
+        await self.load_all_data()
+
+        self.logger.info('Loading cogs...')
+        await self.reload_all_extensions()
+
+        self.logger.info('Starting the bot...')
+        await super().start(self.token, *args, **kwargs)
+
+    async def load_all_data(self):
+        """
+        Load all the data, or on later calls pick up changes made to the files on disk.
+
+        Handlers stay open across reloads, so their in-memory documents are kept warm.
+        """
+        if getattr(self, '_overwatch_handler', None) is not None:
+            return await self._refresh_data()
+        shared = CLUSTER_PROCESSES > 1
+        self._overwatch_handler = JSONHandler(WATCH_FILE, default_data={'Guilds': {}}, flush_delay=DATA_FLUSH_DELAY, compact=DATA_COMPACT_JSON, shared=shared)
+        self._prefix_handler = JSONHandler(PREFIX_FILE, flush_delay=DATA_FLUSH_DELAY, compact=DATA_COMPACT_JSON, shared=shared)
+        invalidate_prefix()
+    
+    def _source_changed(self, name: str, path: Path) -> bool:
+        """
+        Checks the modification time first and only hashes the file when it differs, so touching a
+        file without changing it does not trigger a reload
+        """
+        stamp = self._extension_stamps.get(name)
+        if stamp is None:
+            return True
+        mtime = path.stat().st_mtime_ns
+        if mtime == stamp[0]:
+            return False
+        digest = file_digest(path)
+        if digest != stamp[1]:
+            return True
+        self._extension_stamps[name] = (mtime, digest)
+        return False
+
+    def _imports(self, name: str, path: Path) -> set[str]:
+        mtime = path.stat().st_mtime_ns
+        cached = self._extension_imports.get(name)
+        if cached is None or cached[0] != mtime:
+            cached = self._extension_imports[name] = (mtime, find_imports(path))
+        return cached[1]
+
+    async def add_cog(self, cog: commands.Cog, /, **kwargs) -> None:
+        await super().add_cog(cog, **kwargs)
+        self._help_cache.clear()
+
+    async def remove_cog(self, name: str, /, **kwargs) -> Optional[commands.Cog]:
+        cog = await super().remove_cog(name, **kwargs)
+        self._help_cache.clear()
+        return cog
+
+    async def _load_cog(self, name: str, path: Path) -> Optional[float]:
+        mtime, digest = path.stat().st_mtime_ns, file_digest(path)
+        started = time.perf_counter()
+        try:
+            if name in self.extensions:
+                await self.reload_extension(name)
+            else:
+                await self.load_extension(name)
+        except Exception as e:
+            self.logger.error(f'Failed to load cog {path.stem}: {e}')
+            return None
+        elapsed = time.perf_counter() - started
+        self._extension_stamps[name] = (mtime, digest)
+        metrics.observe(f'extension.{path.stem}', elapsed)
+        return elapsed
+
+    async def reload_all_extensions(self, force: bool = False) -> dict[str, Optional[float]]:
+        """
+        Loads new cogs and reloads those whose source changed, or every cog when `force` is set.
+
+        Cogs that import another changed cog are reloaded with it. Cogs are loaded in waves that only
+        depend on earlier ones and each wave loads concurrently. Returns the load time of each cog
+        that was (re)loaded, or None for those that failed.
+        """
+        started = time.perf_counter()
+        paths = {f'cogs.{path.stem}': path for path in COGS_DIR.glob('*.py')}
+        for name in [name for name in self.extensions if name.startswith('cogs.') and name not in paths]:
+            await self.unload_extension(name)
+            self._extension_stamps.pop(name, None)
+            self._extension_imports.pop(name, None)
+            self.logger.info(f'Unloaded removed cog: {name[5:]}')
+        graph = {name: self._imports(name, path) & paths.keys() - {name} for name, path in paths.items()}
+        changed = {name for name, path in paths.items() if force or name not in self.extensions or self._source_changed(name, path)}
+        dependents = {name for name in paths if name not in changed and graph[name] & changed}
+        while dependents:
+            changed |= dependents
+            dependents = {name for name in paths if name not in changed and graph[name] & changed}
+
+        timings = {}
+        for wave in load_waves({name: graph[name] for name in changed}):
+            results = await asyncio.gather(*(self._load_cog(name, paths[name]) for name in wave))
+            timings.update(zip(wave, results))
+        if timings:
+            report = ', '.join(f'{name[5:]} {elapsed * 1000:.1f}ms' if elapsed is not None else f'{name[5:]} failed' for name, elapsed in sorted(timings.items()))
+            self.logger.info(f'Loaded {len(timings)} cog(s) in {(time.perf_counter() - started) * 1000:.1f}ms: {report}')
+        return timings
+
+    async def close(self):
+        """
+        Close the bot, flushing any buffered data
+        """
+        await super().close()
+        self.logger.info('Flushing data...')
+        for handler in self._message_handlers.values():
+            await handler.close()
+        self._message_handlers.clear()
+        if self._ingest is not None:
+            await self._ingest.close()
+        for index in self._search_indexes.values():
+            await index.close()
+        self._search_indexes.clear()
+        for activity in self._activity.values():
+            await activity.close()
+        self._activity.clear()
+        if self._attachment_archive is not None:
+            await self._attachment_archive.close()
+        for name in ('_overwatch_handler', '_prefix_handler'):
+            if getattr(self, name, None) is not None:
+                await getattr(self, name).close()
+        self.log_listener.stop()
+
+    async def on_ready(self):
+        """
+        On bot ready event
+        """
+        self.logger.info('Generating invite URL...')
+        self.client_id = (await self.application_info()).id
+        self.invite_url = oauth_url(client_id = self.client_id, permissions = Permissions(administrator=True))
+
+        self.logger.info(f'{self.user.name} is online!')
+        if not self._reported_caches:
+            self._reported_caches = True
+            self.log_cache_report()
+
+    def log_cache_report(self):
+        """
+        Logs the enabled intents and the estimated memory held by each model cache
+        """
+        intents = ', '.join(name for name, value in self.intents if value)
+        member_cache = ', '.join(name for name, value in self._connection.member_cache_flags if value) or 'none'
+        self.logger.info(f'Intents: {intents}; member cache: {member_cache}; max messages: {self._connection.max_messages}')
+        total = 0
+        for name, count, size in cache_report(self):
+            total += size
+            self.logger.info(f'Cache {name}: {count} entries, ~{size / 1024:.0f} KiB')
+        self.logger.info(f'Caches hold ~{total / 1024 / 1024:.1f} MiB in total')
+
+    async def on_command_error(self, context: commands.Context, exception: commands.CommandError):
+        """
+        Handle errors in command execution.
+        """
+        metrics.increment('command.errors')
+        self.logger.error(f"An error occurred while processing the command '{context.command}': {exception}", exc_info=True)
+        if self.is_owner(context.author):
+            await context.send(f"An error occurred: {exception}")
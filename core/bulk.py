@@ -0,0 +1,136 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+import aiohttp
+import discord
+from discord.abc import Messageable
+
+from config.settings import BULK_CONCURRENCY, BULK_PROGRESS_INTERVAL, BULK_RETRIES
+from core.metrics import metrics
+
+__all__ = ['BulkAction']
+
+class BulkAction:
+    """
+    Applies an API call to many targets with a bounded pool of concurrent workers.
+
+    discord.py already holds requests back once a rate-limit bucket is exhausted, so the pool only
+    has to keep enough calls in flight to use the bucket fully without piling up a long queue
+    behind it. A 429 that still gets through pauses every worker until the bucket resets, server
+    errors and timeouts are retried with exponential backoff, and anything else, such as missing
+    permissions, fails that target straight away. Progress is shown by editing a single message.
+    """
+
+    label: str
+    targets: list
+    action: Callable[[Any], Awaitable]
+    concurrency: int
+    retries: int
+    succeeded: list
+    failed: list[tuple[Any, str]]
+    status: Optional[discord.Message]
+
+    def __init__(self, label: str, targets: Iterable, action: Callable[[Any], Awaitable], *, concurrency: int = BULK_CONCURRENCY, retries: int = BULK_RETRIES):
+        self.label = label
+        self.targets = list(targets)
+        self.action = action
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.succeeded = []
+        self.failed = []
+        self.status = None
+        self._resume_at = 0.0
+        self._last_report = 0.0
+        self._started = 0.0
+
+    @property
+    def done(self) -> int:
+        return len(self.succeeded) + len(self.failed)
+
+    def progress(self) -> str:
+        text = f'{self.label}: {self.done}/{len(self.targets)}'
+        if self.failed:
+            text += f' ({len(self.failed)} failed)'
+        return text
+
+    def summary(self, limit: int = 10) -> str:
+        lines = [f'{self.progress()} in {time.monotonic() - self._started:.1f}s']
+        for target, reason in self.failed[:limit]:
+            lines.append(f'- <@{target.id}>: {reason}')
+        if len(self.failed) > limit:
+            lines.append(f'- and {len(self.failed) - limit} more')
+        return '\n'.join(lines)
+
+    async def _report(self, final: bool = False, delete_after: float = None):
+        if self.status is None:
+            return
+        now = time.monotonic()
+        if not final and now - self._last_report < BULK_PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        try:
+            await self.status.edit(content = self.summary() if final else self.progress(), delete_after = delete_after)
+        except discord.HTTPException:
+            pass
+
+    async def _cooldown(self):
+        delay = self._resume_at - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._resume_at - time.monotonic()
+
+    async def _apply(self, target: Any) -> Optional[str]:
+        """
+        Runs the action on one target, returning why it failed or None on success
+        """
+        reason = None
+        for attempt in range(self.retries + 1):
+            await self._cooldown()
+            started = time.perf_counter()
+            try:
+                await self.action(target)
+                return None
+            except discord.RateLimited as e:
+                self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+                reason = 'rate limited'
+                continue
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    retry_after = float(e.response.headers.get('Retry-After', 1.0))
+                    self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+                    reason = 'rate limited'
+                    continue
+                if e.status < 500:
+                    return e.text or type(e).__name__
+                reason = f'server error {e.status}'
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                reason = type(e).__name__
+            finally:
+                metrics.observe('bulk.action', time.perf_counter() - started)
+            await asyncio.sleep(min(2 ** attempt, 30))
+        return f'{reason}, gave up after {self.retries + 1} attempts'
+
+    async def _worker(self, targets: Iterable):
+        for target in targets:
+            reason = await self._apply(target)
+            if reason is None:
+                self.succeeded.append(target)
+            else:
+                self.failed.append((target, reason))
+            await self._report()
+
+    async def run(self, destination: Messageable = None, *, delete_after: float = None) -> 'BulkAction':
+        """
+        Runs the action on every target, reporting progress to `destination` when given
+        """
+        self._started = time.monotonic()
+        if destination is not None:
+            self.status = await destination.send(self.progress())
+            self._last_report = time.monotonic()
+        targets = iter(self.targets)
+        await asyncio.gather(*(self._worker(targets) for _ in range(min(self.concurrency, len(self.targets)))))
+        metrics.increment('bulk.succeeded', len(self.succeeded))
+        metrics.increment('bulk.failed', len(self.failed))
+        await self._report(final = True, delete_after = delete_after)
+        return self
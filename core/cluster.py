@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+from multiprocessing.process import BaseProcess
+import signal
+import time
+from typing import Optional
+
+from discord.http import HTTPClient, Route
+
+from config.settings import BOT_TOKEN, CLUSTER_RESTART_DELAY
+
+__all__ = ['Cluster', 'run_bot']
+
+def run_bot(**kwargs):
+    """
+    Runs a single bot process until it is closed, shutting down cleanly on SIGTERM
+    """
+    from core.bot import Bot
+
+    async def main():
+        async with Bot(**kwargs) as bot:
+            try:
+                bot.loop.add_signal_handler(signal.SIGTERM, lambda: bot.loop.create_task(bot.close()))
+            except (NotImplementedError, RuntimeError):
+                pass
+            await bot.start()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+class Cluster:
+    """
+    Supervises a group of worker processes that each run a contiguous range of shards.
+
+    Workers are started one after another, leaving enough time for their shards to identify within
+    the gateway's session start limit. A worker that crashes is restarted with exponential backoff,
+    reset once it stays up for `stable_after` seconds; a worker that exits cleanly (for example through
+    the shutdown command) is left stopped.
+    """
+
+    identify_interval = 5.0
+    stable_after = 60.0
+    max_restart_delay = 300.0
+
+    processes: int
+    shard_count: int
+    logger: logging.Logger
+    _workers: dict[int, BaseProcess]
+    _started: dict[int, float]
+    _failures: dict[int, int]
+    _restart_at: dict[int, float]
+    _stopping: bool
+
+    def __init__(self, processes: int, shard_count: int = 0):
+        self.processes = processes
+        self.shard_count = shard_count
+        self.logger = logging.getLogger('cluster')
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = {}
+        self._started = {}
+        self._failures = {}
+        self._restart_at = {}
+        self._stopping = False
+
+    async def _gateway_limits(self) -> tuple[int, int]:
+        """
+        Returns the recommended shard count and identify concurrency for the bot token
+        """
+        http = HTTPClient(asyncio.get_running_loop())
+        try:
+            await http.static_login(BOT_TOKEN)
+            data = await http.request(Route('GET', '/gateway/bot'))
+        finally:
+            await http.close()
+        return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+    def shard_ranges(self) -> list[list[int]]:
+        size = math.ceil(self.shard_count / self.processes)
+        return [list(range(start, min(start + size, self.shard_count))) for start in range(0, self.shard_count, size)]
+
+    def _spawn(self, cluster_id: int, shard_ids: list[int]) -> None:
+        worker = self._context.Process(
+            target = run_bot, name = f'cluster-{cluster_id}',
+            kwargs = {'cluster_id': cluster_id, 'shard_ids': shard_ids, 'shard_count': self.shard_count},
+        )
+        worker.start()
+        self._workers[cluster_id] = worker
+        self._started[cluster_id] = time.monotonic()
+        self.logger.info(f'Started cluster {cluster_id} (pid {worker.pid}) with shards {shard_ids[0]}-{shard_ids[-1]}')
+
+    def _stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        """
+        Starts every worker and supervises them until they have all stopped
+        """
+        logging.basicConfig(level = logging.INFO, format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        recommended, concurrency = asyncio.run(self._gateway_limits())
+        if not self.shard_count:
+            self.shard_count = recommended
+        if self.processes > self.shard_count:
+            self.logger.warning(f'CLUSTER_PROCESSES is {self.processes} but there are only {self.shard_count} shards, running {self.shard_count} processes')
+            self.processes = self.shard_count
+        ranges = self.shard_ranges()
+        self.logger.info(f'Running {self.shard_count} shards across {len(ranges)} processes')
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            for cluster_id, shard_ids in enumerate(ranges):
+                if self._stopping:
+                    break
+                self._spawn(cluster_id, shard_ids)
+                self._sleep(math.ceil(len(shard_ids) / concurrency) * self.identify_interval)
+            while not self._stopping and self._workers:
+                self._supervise(ranges)
+                self._sleep(1.0)
+        finally:
+            self._shutdown()
+
+    def _sleep(self, seconds: float):
+        deadline = time.monotonic() + seconds
+        while not self._stopping and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+
+    def _supervise(self, ranges: list[list[int]]):
+        now = time.monotonic()
+        for cluster_id, worker in list(self._workers.items()):
+            if worker.is_alive():
+                if now - self._started[cluster_id] > self.stable_after:
+                    self._failures[cluster_id] = 0
+                continue
+            if worker.exitcode == 0:
+                self.logger.info(f'Cluster {cluster_id} shut down')
+                del self._workers[cluster_id]
+                continue
+            restart_at = self._restart_at.get(cluster_id)
+            if restart_at is None:
+                failures = self._failures.get(cluster_id, 0)
+                delay = min(CLUSTER_RESTART_DELAY * 2 ** failures, self.max_restart_delay)
+                self._failures[cluster_id] = failures + 1
+                self._restart_at[cluster_id] = now + delay
+                self.logger.error(f'Cluster {cluster_id} exited with code {worker.exitcode}, restarting in {delay:.0f}s')
+            elif now >= restart_at:
+                del self._restart_at[cluster_id]
+                self._spawn(cluster_id, ranges[cluster_id])
+
+    def _shutdown(self, timeout: Optional[float] = 30.0):
+        for worker in self._workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + timeout
+        for cluster_id, worker in self._workers.items():
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                self.logger.warning(f'Cluster {cluster_id} did not stop in time, killing it')
+                worker.kill()
+                worker.join()
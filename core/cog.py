@@ -1,16 +1,27 @@
-from discord.ext import commands
-
-from core.bot import Bot
-
-__all__ = ['CustomCogMixin']
-
-class CustomCogMixin:
-
-    def __init__(self, bot: Bot):
-        super().__init__()
-        self.bot = bot
-    
-    @commands.Cog.listener()
-    async def on_ready(self):
-        print(f"{self.__class__.__name__} cog has been loaded")
+from discord.ext import commands
+
+from core.bot import Bot
+
+__all__ = ['CustomCogMixin']
+
+class CustomCogMixin:
+    """
+    Common cog setup.
+
+    `required_intents` names the gateway intents a cog relies on, so a warning is logged on load
+    when `BOT_INTENTS` leaves any of them disabled.
+    """
+
+    required_intents: tuple[str, ...] = ()
+
+    def __init__(self, bot: Bot):
+        super().__init__()
+        self.bot = bot
+        missing = [name for name in self.required_intents if not getattr(bot.intents, name)]
+        if missing:
+            bot.logger.warning(f'{self.__class__.__name__} needs intents that are disabled: {", ".join(missing)}')
+    
+    @commands.Cog.listener()
+    async def on_ready(self):
+        print(f"{self.__class__.__name__} cog has been loaded")
     
\ No newline at end of file
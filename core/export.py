@@ -0,0 +1,132 @@
+import csv
+import gzip
+import io
+import json
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Optional
+import zlib
+
+__all__ = ['ArchiveWriter']
+
+
+class ArchiveWriter:
+    """
+    Writes records to gzip-compressed JSON lines or CSV files split into parts below `part_size`,
+    passing each through `transform` first when one is given.
+
+    Records are compressed as they arrive, so memory use does not depend on how many are exported.
+    Every part is a complete archive of its own, CSV parts included with their header row. The
+    compressed size of the open part is only known after a sync flush, so one is issued whenever
+    the uncompressed bytes written since the last flush could take the part over its limit; as a
+    part fills up this converges on the limit in a handful of flushes.
+    """
+
+    formats = ('jsonl', 'csv')
+
+    directory: Path
+    basename: str
+    format: str
+    part_size: int
+    columns: dict[str, Callable[[dict], Any]]
+    transform: Optional[Callable[[dict], dict]]
+    parts: int
+    records: int
+    _raw: Optional[BinaryIO]
+    _file: Optional[gzip.GzipFile]
+    _path: Optional[Path]
+    _flushed: int
+    _unflushed: int
+    _part_records: int
+
+    def __init__(self, directory: Path, basename: str, format: str = 'jsonl', *, part_size: int = 25 * 1024 * 1024, columns: dict[str, Callable[[dict], Any]] = None, transform: Callable[[dict], dict] = None):
+        if format not in self.formats:
+            raise ValueError(f'Unsupported export format: {format}')
+        if format == 'csv' and not columns:
+            raise ValueError('CSV exports need columns')
+        self.directory = directory
+        self.basename = basename
+        self.format = format
+        self.part_size = part_size
+        self.columns = columns or {}
+        self.transform = transform
+        self.parts = 0
+        self.records = 0
+        self._raw = None
+        self._file = None
+        self._path = None
+        self._flushed = 0
+        self._unflushed = 0
+        self._part_records = 0
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer)
+
+    def _encode(self, record: dict) -> bytes:
+        if self.transform is not None:
+            record = self.transform(record)
+        if self.format == 'jsonl':
+            return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        return self._row([extract(record) for extract in self.columns.values()])
+
+    def _row(self, values: list) -> bytes:
+        self._buffer.seek(0)
+        self._buffer.truncate(0)
+        self._csv.writerow(values)
+        return self._buffer.getvalue().encode('utf-8')
+
+    def _open_part(self) -> None:
+        self.parts += 1
+        self._path = self.directory / f'{self.basename}-{self.parts:03}.{self.format}.gz'
+        self._raw = self._path.open('wb')
+        self._file = gzip.GzipFile(filename=self._path.stem, mode='wb', fileobj=self._raw)
+        self._flushed = self._raw.tell()
+        self._unflushed = 0
+        self._part_records = 0
+        if self.format == 'csv':
+            self._write(self._row(list(self.columns)))
+
+    def _close_part(self) -> Path:
+        self._file.close()
+        self._raw.close()
+        path, self._path, self._file, self._raw = self._path, None, None, None
+        return path
+
+    def _write(self, line: bytes) -> None:
+        self._file.write(line)
+        self._unflushed += len(line)
+
+    def _sync(self) -> None:
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        self._flushed = self._raw.tell()
+        self._unflushed = 0
+
+    def _bound(self, pending: int) -> int:
+        return self._flushed + pending + (pending >> 11) + 64
+
+    def s_write(self, records: list) -> list[Path]:
+        """
+        Compresses a batch of records, returning any parts that were completed
+        """
+        completed = []
+        for record in records:
+            line = self._encode(record)
+            if self._file is None:
+                self._open_part()
+            # Deflate never grows its input by more than about one byte in 4 KiB plus a few bytes
+            # of framing, so this bound is safe without knowing the real compressed size
+            if self._bound(self._unflushed + len(line)) > self.part_size:
+                self._sync()
+                if self._bound(len(line)) > self.part_size and self._part_records:
+                    completed.append(self._close_part())
+                    self._open_part()
+            self._write(line)
+            self._part_records += 1
+            self.records += 1
+        return completed
+
+    def s_close(self) -> list[Path]:
+        """
+        Finishes the open part, returning it if anything was written
+        """
+        if self._file is None:
+            return []
+        return [self._close_part()]
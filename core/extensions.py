@@ -0,0 +1,46 @@
+import ast
+import hashlib
+from pathlib import Path
+
+__all__ = ['file_digest', 'find_imports', 'load_waves']
+
+def file_digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def find_imports(path: Path) -> set[str]:
+    """
+    Returns the absolute module names imported by the source at `path`, including `module.name`
+    for every `from module import name` since the name may itself be a module
+    """
+    tree = ast.parse(path.read_bytes(), str(path))
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules = [node.module, *(f'{node.module}.{alias.name}' for alias in node.names)]
+        else:
+            continue
+        found.update(modules)
+    return found
+
+def load_waves(graph: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Groups extensions into waves that only depend on earlier waves, so each wave can load concurrently.
+
+    Dependencies outside the graph are ignored, and extensions caught in an import cycle are loaded
+    together in a final wave.
+    """
+    remaining = {name: dependencies & graph.keys() - {name} for name, dependencies in graph.items()}
+    waves = []
+    while remaining:
+        wave = sorted(name for name, dependencies in remaining.items() if not dependencies)
+        if not wave:
+            waves.append(sorted(remaining))
+            break
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(wave)
+    return waves
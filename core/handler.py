@@ -1,200 +1,880 @@
-import asyncio
-import json 
-import jsonlines
-import os
-from pathlib import Path
-from typing import Any
-
-from config.settings import DATA_DIR
-
-__all__ = ['JSONHandler', 'JSONLineHandler']
-
-
-class JSONHandler:
-
-    filename: str
-    filepath: Path
-    lock: asyncio.Lock
-    loop: asyncio.AbstractEventLoop
-    default_data: dict
-
-    def __init__(self, filename: str, *args, default_data: dict = None, **kwargs):
-        self.filename = DATA_DIR / filename
-        self.filepath = Path(self.filename)
-        self.lock = asyncio.Lock()
-        self.loop = kwargs.pop('loop', asyncio.get_running_loop())
-        self.default_data = default_data or {}
-        if not self.filepath.exists():
-            self.filepath.touch()
-            self.s_clear()
-
-    def s_read(self) -> Any:
-        with self.filepath.open('r', encoding='utf-8') as file:
-            try:
-                return json.load(file)
-            except json.JSONDecodeError:
-                return {}
-
-    def s_write(self, data: Any) -> None:
-        with self.filepath.open('w', encoding='utf-8') as file:
-            json.dump(data, file, ensure_ascii=False, indent=4)
-
-    def s_get(self, key: str) -> Any:
-        data = self.s_read()
-        return data.get(key)
-
-    def s_update(self, key: str, value: Any) -> None:
-        data = self.s_read()
-        data[key] = value
-        self.s_write(data)
-
-    def s_remove(self, key: str) -> None:
-        data = self.s_read()
-        if key in data:
-            del data[key]
-            self.s_write(data)
-
-    def s_clear(self) -> None:
-        self.s_write(self.default_data)
-
-    async def read(self) -> Any:
-        async with self.lock:
-            return await self.loop.run_in_executor(None, self.s_read)
-
-    async def write(self, data: Any) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_write, data)
-
-    async def get(self, key: str) -> Any:
-        async with self.lock:
-            return await self.loop.run_in_executor(None, self.s_get, key)
-
-    async def update(self, key: str, value: Any) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_update, key, value)
-
-    async def remove(self, key: str) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_remove, key)
-
-    async def clear(self) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_clear)
-
-
-class JSONLineHandler:
-
-    filename: str
-    filepath: Path
-    key_name: str
-    lock: asyncio.Lock
-    loop: asyncio.AbstractEventLoop
-    unique_only: bool
-
-    def __init__(self, filename: str, key_name: str, *args, default_data: Any = None, unique_only: bool = False, **kwargs):
-        self.filename = DATA_DIR / filename
-        self.filepath = Path(self.filename)
-        self.key_name = key_name
-        self.lock     = asyncio.Lock()
-        self.loop     = kwargs.pop('loop', asyncio.get_running_loop())
-        self.unique_only = unique_only
-        self._ensure_exists()
-        
-    def _ensure_exists(self):
-        if not self.filepath.parent.exists():
-            self.filepath.parent.mkdir(parents=True)
-        if not self.filepath.exists():
-            self.filepath.touch()
-            
-
-
-    def s_get(self, key: Any = None, value: Any = None) -> dict:
-        if value is None:
-            raise ValueError('Value cannot be None')
-        key = key or self.key_name
-        with jsonlines.open(self.filename, 'r') as reader:
-            for line in reader:
-                if line[key] == value:
-                    return line
-
-    def s_get_all(self, key: Any = None, value: Any = None) -> list:
-        if value is None:
-            raise ValueError('Value cannot be None')
-        key = key or self.key_name
-        with jsonlines.open(self.filename, 'r') as reader:
-            return [line for line in reader if line[key] == value]
-    
-    def s_read(self) -> list:
-        with jsonlines.open(self.filename, 'r') as reader:
-            return list(reader)
-    
-    def s_add(self, data: dict) -> None:
-        with jsonlines.open(self.filename, 'a') as writer:
-            if self.unique_only:
-                if self.s_get(self.key_name, data[self.key_name]):
-                    return
-            writer.write(data)
-
-    def s_update(self, key: Any = None, value: Any = None, data: dict = None) -> None:
-        if value is None:
-            raise ValueError('Value cannot be None')
-        key = key or self.key_name
-        temp_filepath = self.filepath.with_suffix('.tmp')
-        updated = False
-        with jsonlines.open(self.filename, 'r') as reader, jsonlines.open(temp_filepath, 'w') as writer:
-            for line in reader:
-                if line[key] == value and not updated:
-                    writer.write(data)
-                    updated = True
-                else:
-                    writer.write(line)
-        if updated:
-            os.replace(temp_filepath, self.filename)
-        else:
-            os.remove(temp_filepath)
-            self.s_add(data)
-        
-    def s_remove(self, key: Any = None, value: Any = None) -> None:
-        if value is None:
-            raise ValueError('Value cannot be None')
-        key = key or self.key_name
-        temp_filepath = self.filepath.with_suffix('.tmp')
-        with jsonlines.open(self.filename, 'r') as reader, jsonlines.open(temp_filepath, 'w') as writer:
-            for line in reader:
-                if line[key] != value:
-                    writer.write(line)
-        os.replace(temp_filepath, self.filename)
-
-    def s_clear(self) -> None:
-        self.filepath.unlink()
-        self.filepath.touch()
-    
-    async def get(self, key: Any = None, value: Any = None) -> dict:
-        async with self.lock:
-            return await self.loop.run_in_executor(None, self.s_get, key, value)
-    
-    async def get_all(self, key: Any = None, value: Any = None) -> list:
-        async with self.lock:
-            return await self.loop.run_in_executor(None, self.s_get_all, key, value)
-
-    async def read(self) -> list:
-        async with self.lock:
-            return await self.loop.run_in_executor(None, self.s_read)
-        
-    async def add(self, data: dict) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_add, data)
-
-    async def update(self, key: Any = None, value: Any = None, data: dict = None) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_update, key, value, data)
-    
-    async def remove(self, key: Any = None, value: Any = None) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_remove, key, value)
-    
-    async def clear(self) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.s_clear)
-    
-    
\ No newline at end of file
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime
+import gzip
+import json 
+import logging
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Any, BinaryIO, Callable, Optional
+
+from config.settings import DATA_DIR
+from core.metrics import metrics, timed_method
+from core.storage import DocumentStorage, RecordStorage
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['JSONHandler', 'JSONLineHandler']
+
+
+class JSONHandler(DocumentStorage):
+    """
+    JSON document store served from memory.
+
+    The parsed document is loaded once and every read is answered from it. Writes mark the
+    document dirty and schedule a debounced flush, which snapshots the document and replaces the
+    file atomically through a temporary copy.
+
+    A `shared` document is written by several processes. Each change is applied to a fresh copy of
+    the file under an exclusive lock and written immediately, and `refresh` picks up changes made
+    by other processes.
+    """
+
+    filename: str
+    filepath: Path
+    lock: asyncio.Lock
+    loop: asyncio.AbstractEventLoop
+    default_data: dict
+    flush_delay: float
+    compact: bool
+    shared: bool
+    _data: Any
+    _dirty: bool
+    _timer: Optional[asyncio.TimerHandle]
+    _flusher: Optional[asyncio.Task]
+    _stamp: Optional[tuple]
+
+    def __init__(self, filename: str, *args, default_data: dict = None, flush_delay: float = 1.0, compact: bool = False, shared: bool = False, **kwargs):
+        self.filename = DATA_DIR / filename
+        self.filepath = Path(self.filename)
+        self.lock = asyncio.Lock()
+        self.loop = kwargs.pop('loop', None) or asyncio.get_running_loop()
+        self.default_data = default_data or {}
+        self.flush_delay = flush_delay
+        self.compact = compact
+        self.shared = shared
+        self._dirty = False
+        self._timer = None
+        self._flusher = None
+        self._stamp = None
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        with self._file_lock():
+            if self.filepath.exists():
+                self._data = self.s_load()
+            else:
+                self.s_clear()
+                self.s_flush()
+
+    def s_load(self) -> Any:
+        with self.filepath.open('r', encoding='utf-8') as file:
+            self._stamp = self._file_stamp(file.fileno())
+            try:
+                return json.load(file)
+            except json.JSONDecodeError:
+                return {}
+
+    @staticmethod
+    def _file_stamp(fileno: int) -> tuple:
+        stat = os.fstat(fileno)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        Holds an exclusive lock on a sidecar file across processes; a no-op unless shared
+        """
+        if not self.shared or fcntl is None:
+            yield
+            return
+        with self.filepath.with_suffix('.lock').open('a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def s_dumps(self) -> str:
+        if self.compact:
+            return json.dumps(self._data, ensure_ascii=False, separators=(',', ':'))
+        return json.dumps(self._data, ensure_ascii=False, indent=4)
+
+    def s_replace(self, payload: str) -> None:
+        temp_filepath = self.filepath.with_suffix('.tmp')
+        with temp_filepath.open('w', encoding='utf-8') as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+            stamp = self._file_stamp(file.fileno())
+        os.replace(temp_filepath, self.filepath)
+        self._stamp = stamp
+
+    def s_flush(self) -> None:
+        self.s_replace(self.s_dumps())
+        self._dirty = False
+
+    def s_read(self) -> Any:
+        return self._data
+
+    def s_write(self, data: Any) -> None:
+        self._data = data
+        self._dirty = True
+
+    def s_get(self, key: str) -> Any:
+        return self._data.get(key)
+
+    def s_update(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._dirty = True
+
+    def s_remove(self, key: str) -> None:
+        if key in self._data:
+            del self._data[key]
+            self._dirty = True
+
+    def s_clear(self) -> None:
+        self.s_write(json.loads(json.dumps(self.default_data)))
+
+    def s_refresh(self) -> bool:
+        """
+        Reloads the document if another process replaced the file, returning whether it changed.
+        Unflushed local changes take precedence, so a dirty document is never reloaded.
+        """
+        if self._dirty:
+            return False
+        try:
+            stat = self.filepath.stat()
+        except FileNotFoundError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._stamp:
+            return False
+        self._data = self.s_load()
+        self._dirty = False
+        return True
+
+    def s_apply(self, mutation: Callable[[Any], None]) -> None:
+        """
+        Applies `mutation` to the latest copy of the document on disk and writes it straight back
+        """
+        with self._file_lock():
+            data = self.s_load() if self.filepath.exists() else json.loads(json.dumps(self.default_data))
+            mutation(data)
+            self._data = data
+            self.s_flush()
+
+    def _schedule_flush(self) -> None:
+        """
+        Debounces disk writes so a burst of changes produces a single flush
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._timer = None
+        if self._flusher is not None and not self._flusher.done():
+            # The running flush may have taken its snapshot before these changes, so try again later
+            self._schedule_flush()
+            return
+        self._flusher = self.loop.create_task(self._debounced_flush())
+
+    async def _debounced_flush(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            logging.getLogger('bot').exception(f'Failed to flush {self.filename}')
+
+    async def flush(self) -> None:
+        """
+        Snapshots the document on the event loop and writes it to disk in the executor
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._dirty:
+            return
+        async with self.lock:
+            payload = self.s_dumps()
+            self._dirty = False
+            try:
+                await metrics.run_in_executor(self.loop, 'executor.JSONHandler.s_replace', self.s_replace, payload)
+            except Exception:
+                self._dirty = True
+                raise
+
+    async def _apply(self, mutation: Callable[[Any], None]) -> None:
+        async with self.lock:
+            await metrics.run_in_executor(self.loop, 'executor.JSONHandler.s_apply', self.s_apply, mutation)
+
+    async def refresh(self) -> bool:
+        """
+        Picks up changes written to the file by other processes or by hand
+        """
+        async with self.lock:
+            return await metrics.run_in_executor(self.loop, 'executor.JSONHandler.s_refresh', self.s_refresh)
+
+    @timed_method('storage')
+    async def modify(self, key: str, func: Callable[[Any], Any]) -> Any:
+        """
+        Replaces the value of `key` with `func(value)` as one atomic read-modify-write
+        """
+        if not self.shared:
+            self.s_update(key, func(self.s_get(key)))
+            self._schedule_flush()
+        else:
+            await self._apply(lambda data: data.__setitem__(key, func(data.get(key))))
+        return self.s_get(key)
+
+    @timed_method('storage')
+    async def read(self) -> Any:
+        return self.s_read()
+
+    @timed_method('storage')
+    async def write(self, data: Any) -> None:
+        if self.shared:
+            return await self._apply(lambda document: (document.clear(), document.update(data)))
+        self.s_write(data)
+        self._schedule_flush()
+
+    @timed_method('storage')
+    async def get(self, key: str) -> Any:
+        return self.s_get(key)
+
+    @timed_method('storage')
+    async def update(self, key: str, value: Any) -> None:
+        if self.shared:
+            return await self._apply(lambda data: data.__setitem__(key, value))
+        self.s_update(key, value)
+        self._schedule_flush()
+
+    @timed_method('storage')
+    async def remove(self, key: str) -> None:
+        if self.shared:
+            return await self._apply(lambda data: data.pop(key, None))
+        self.s_remove(key)
+        self._schedule_flush()
+
+    @timed_method('storage')
+    async def clear(self) -> None:
+        if self.shared:
+            default_data = json.loads(json.dumps(self.default_data))
+            return await self._apply(lambda data: (data.clear(), data.update(default_data)))
+        self.s_clear()
+        self._schedule_flush()
+
+
+class _GzipBlockWriter:
+    """
+    Writes a gzip file as a series of independent members holding `block_size` uncompressed bytes
+    each. `blocks` records the file offset where every member starts, so a reader can seek straight
+    to the member holding any uncompressed offset instead of decompressing from the start.
+    """
+
+    file: BinaryIO
+    block_size: int
+    blocks: list[int]
+    _buffer: bytearray
+
+    def __init__(self, file: BinaryIO, block_size: int):
+        self.file = file
+        self.block_size = block_size
+        self.blocks = []
+        self._buffer = bytearray()
+
+    def _write_block(self, length: int) -> None:
+        self.blocks.append(self.file.tell())
+        self.file.write(gzip.compress(bytes(self._buffer[:length]), mtime=0))
+        del self._buffer[:length]
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._write_block(self.block_size)
+
+    def close(self) -> None:
+        if self._buffer:
+            self._write_block(len(self._buffer))
+
+
+class JSONLineHandler(RecordStorage):
+    """
+    Append-only JSON lines store keyed on `key_name`.
+
+    Every record is located through an in-memory index of segment and byte offset that is persisted
+    to a sidecar `.idx` file. Updates append a new version of the record and removals append a
+    tombstone, so single-record operations never rewrite the file. Dead versions are reclaimed
+    by `compact` once they make up enough of a segment.
+
+    Without `segment_size` or `segment_age` the store is the single file `filename`. With either of
+    them the store becomes a directory of numbered segments next to it: once the active segment
+    grows past `segment_size` bytes or `segment_age` seconds it is closed and gzipped in blocks of
+    `block_size` bytes, so reading one record decompresses a single block, and a
+    `manifest.json` records the `time_field` range of each segment so that `scan` can skip
+    segments outside the requested window.
+
+    `expire` drops whole segments, oldest first, once everything in them is past the cutoff or the
+    store is over its size limit, and otherwise tombstones expired records a batch at a time,
+    compacting the segment once it has been gone through. Compaction keeps the tombstones that
+    hide older versions in earlier segments, so removed records stay removed when the index is
+    rebuilt.
+
+    The `header` is written as a line of its own at the start of each segment, and again whenever
+    it changes, so every file describes the records it holds.
+    """
+
+    filename: str
+    filepath: Path
+    dirpath: Path
+    indexpath: Path
+    segmented: bool
+    segment_size: Optional[int]
+    segment_age: Optional[float]
+    time_field: Optional[str]
+    compact_ratio: float
+    compact_min_bytes: int
+    segments: dict[int, dict]
+    _index: dict
+    _file: Optional[BinaryIO]
+    _expiring: Optional[dict]
+
+    _tombstone = '_deleted'
+    _header = '_header'
+    block_size = 1 << 16
+
+    def __init__(self, filename: str, key_name: str, *args, default_data: Any = None, segment_size: int = None, segment_age: float = None, time_field: str = None, compact_ratio: float = 0.5, compact_min_bytes: int = 1 << 20, **kwargs):
+        super().__init__(key_name, *args, **kwargs)
+        self.filename = DATA_DIR / filename
+        self.filepath = Path(self.filename)
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.segmented = bool(segment_size or segment_age)
+        self.time_field = time_field
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        if self.segmented:
+            self.dirpath = self.filepath.with_suffix('')
+            self.indexpath = self.dirpath / 'index.idx'
+        else:
+            self.dirpath = self.filepath.parent
+            self.indexpath = self.filepath.with_name(self.filepath.name + '.idx')
+        self._file = None
+        self._expiring = None
+        self._ensure_exists()
+        self._load_index()
+        self.header = next((segment['header'] for segment in reversed(self.segments.values()) if segment.get('header')), None)
+        
+    def _ensure_exists(self):
+        if not self.dirpath.exists():
+            self.dirpath.mkdir(parents=True)
+        if self.segmented and self.filepath.is_file():
+            # Adopt a log written before segmentation as the first segment
+            os.replace(self.filepath, self.dirpath / self._segment_name(0))
+            self.filepath.with_name(self.filepath.name + '.idx').unlink(missing_ok=True)
+        if not self.segmented and not self.filepath.exists():
+            self.filepath.touch()
+
+    def _segment_name(self, segment_id: int, closed: bool = False) -> str:
+        if not self.segmented:
+            return self.filepath.name
+        return f'{segment_id:06d}{self.filepath.suffix}' + ('.gz' if closed else '')
+
+    def _segment_path(self, segment: dict) -> Path:
+        return self.dirpath / segment['file']
+
+    def _new_segment(self, segment_id: int, closed: bool = False) -> dict:
+        segment = {
+            'id': segment_id, 'file': self._segment_name(segment_id, closed), 'closed': closed,
+            'size': 0, 'dead': 0, 'records': 0, 'first': None, 'last': None, 'opened': time.time(),
+        }
+        self.segments[segment_id] = segment
+        return segment
+
+    @property
+    def _active(self) -> dict:
+        return self.segments[next(reversed(self.segments))]
+
+    def _load_index(self):
+        """
+        Loads the sidecar index and catches it up with any lines appended after it was saved. The
+        index is rebuilt from the segments when any of them differs from what it recorded.
+        """
+        self.segments = {}
+        try:
+            with self.indexpath.open('r', encoding='utf-8') as file:
+                saved = json.load(file)
+            self.segments = {segment['id']: segment for segment in saved['segments']}
+            self._index = {key: (segment_id, offset, length) for key, segment_id, offset, length in saved['entries']}
+            active = self._active
+            # A closed segment rewritten after the index was last saved, such as by a compaction
+            # interrupted before the save, no longer matches the size recorded for it
+            closed = all(self._segment_path(segment).stat().st_size == segment['disk'] for segment in self.segments.values() if segment is not active)
+            size = self._segment_path(active).stat().st_size
+            if closed and active['size'] <= size:
+                if active['size'] < size:
+                    self._scan_segment(active, active['size'])
+                return
+        except (OSError, ValueError, KeyError, TypeError, StopIteration):
+            pass
+        self._rebuild_index({segment.get('file'): segment for segment in self.segments.values()})
+
+    def _rebuild_index(self, known: dict = None):
+        """
+        Reads every segment from the start. The block table of a closed segment listed in `known`
+        is kept when the file still has the size recorded with it.
+        """
+        known = known or {}
+        self.segments, self._index = {}, {}
+        if self.segmented:
+            suffixes = (self.filepath.suffix, self.filepath.suffix + '.gz')
+            names = sorted(path.name for path in self.dirpath.glob('[0-9]*') if path.name.endswith(suffixes))
+            for name in names:
+                segment = self._new_segment(int(name.split('.')[0]), name.endswith('.gz'))
+                segment['file'] = name
+        else:
+            self._new_segment(0)
+        if not self.segments:
+            self._new_segment(0)
+            self._segment_path(self._active).touch()
+        for segment in self.segments.values():
+            if segment['closed']:
+                segment['disk'] = self._disk_size(segment)
+                previous = known.get(segment['file']) or {}
+                if previous.get('blocks') and previous.get('disk') == segment['disk']:
+                    segment.update(blocks=previous['blocks'], block_size=previous['block_size'])
+            self._scan_segment(segment, 0)
+
+    @contextmanager
+    def _open_segment(self, segment: dict, start: int = 0):
+        """
+        Opens a segment for reading from `start` on, yielding the file and the segment offset its
+        position 0 corresponds to. Closed segments are opened at the gzip block holding `start`.
+        """
+        path = self._segment_path(segment)
+        if not segment['closed']:
+            with path.open('rb') as file:
+                yield file, 0
+            return
+        blocks = segment.get('blocks')
+        block = min(start // segment['block_size'], len(blocks) - 1) if blocks else 0
+        with path.open('rb') as raw:
+            raw.seek(blocks[block] if blocks else 0)
+            with gzip.GzipFile(fileobj=raw, mode='rb') as file:
+                yield file, block * segment['block_size'] if blocks else 0
+
+    def _iter_segment(self, segment: dict, start: int = 0):
+        """
+        Yields the offset and raw bytes of every complete line in a segment from `start` on
+        """
+        with self._open_segment(segment, start) as (file, base):
+            file.seek(start - base)
+            offset = start
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                yield offset, line
+                offset += len(line)
+
+    def _scan_segment(self, segment: dict, start: int):
+        segment['size'] = start
+        for offset, line in self._iter_segment(segment, start):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if isinstance(record, dict) and self.key_name in record:
+                self._apply(record, segment, offset, len(line))
+            elif isinstance(record, dict) and self._header in record:
+                segment['header'] = record[self._header]
+            else:
+                segment['dead'] += len(line)
+            segment['size'] = offset + len(line)
+
+    def _apply(self, record: dict, segment: dict, offset: int, length: int):
+        """
+        Points the index at a freshly written line, accounting for the version it supersedes
+        """
+        value = record[self.key_name]
+        previous = self._index.pop(value, None)
+        if previous is not None and previous[0] in self.segments:
+            self.segments[previous[0]]['dead'] += previous[2]
+        segment['records'] += 1
+        if record.get(self._tombstone):
+            segment['dead'] += length
+            return
+        self._index[value] = (segment['id'], offset, length)
+        moment = record.get(self.time_field) if self.time_field else None
+        if moment is not None:
+            if segment['first'] is None or moment < segment['first']:
+                segment['first'] = moment
+            if segment['last'] is None or moment > segment['last']:
+                segment['last'] = moment
+
+    def s_save_index(self) -> None:
+        temp_filepath = self.indexpath.with_suffix('.tmp')
+        with temp_filepath.open('w', encoding='utf-8') as file:
+            json.dump({
+                'segments': list(self.segments.values()),
+                'entries': [[key, *location] for key, location in self._index.items()],
+            }, file)
+        os.replace(temp_filepath, self.indexpath)
+        if self.segmented:
+            self.s_save_manifest()
+
+    def s_save_manifest(self) -> None:
+        temp_filepath = self.dirpath / 'manifest.tmp'
+        with temp_filepath.open('w', encoding='utf-8') as file:
+            json.dump([
+                {field: segment.get(field) for field in ('file', 'closed', 'size', 'records', 'first', 'last', 'header')}
+                for segment in self.segments.values()
+            ], file, indent=4)
+        os.replace(temp_filepath, self.dirpath / 'manifest.json')
+
+    def _open_file(self) -> BinaryIO:
+        if self._file is None:
+            self._file = self._segment_path(self._active).open('ab')
+            self._file.seek(0, os.SEEK_END)
+        return self._file
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _should_rotate(self) -> bool:
+        active = self._active
+        if not self.segmented or not active['size'] or self.scanning:
+            return False
+        if self.segment_size and active['size'] >= self.segment_size:
+            return True
+        return bool(self.segment_age and time.time() - active['opened'] >= self.segment_age)
+
+    def s_rotate(self) -> None:
+        """
+        Closes the active segment, compresses it and starts a new one
+        """
+        self._close_file()
+        active = self._active
+        source = self._segment_path(active)
+        active['file'] = self._segment_name(active['id'], True)
+        with source.open('rb') as reader, self._segment_path(active).open('wb') as file:
+            writer = _GzipBlockWriter(file, self.block_size)
+            shutil.copyfileobj(reader, writer)
+            writer.close()
+            active.update(closed=True, blocks=writer.blocks, block_size=self.block_size, disk=file.tell())
+        segment = self._new_segment(active['id'] + 1)
+        self._segment_path(segment).touch()
+        self.s_save_index()
+        source.unlink()
+
+    def _read_at(self, segment_id: int, offset: int, length: int) -> dict:
+        with self._open_segment(self.segments[segment_id], offset) as (file, base):
+            file.seek(offset - base)
+            return json.loads(file.read(length))
+
+    def _overlaps(self, segment: dict, start: Optional[str], end: Optional[str]) -> bool:
+        if segment['first'] is None:
+            return True
+        return (end is None or segment['first'] <= end) and (start is None or segment['last'] >= start)
+
+    def s_scan(self, start: datetime = None, end: datetime = None):
+        """
+        Yields the current version of every record in write order, limited to the `time_field`
+        window between `start` and `end` when given
+        """
+        start = start.isoformat() if start else None
+        end = end.isoformat() if end else None
+        for segment in list(self.segments.values()):
+            if (start or end) and not self._overlaps(segment, start, end):
+                continue
+            segment_id = segment['id']
+            for offset, line in self._iter_segment(segment):
+                record = json.loads(line)
+                location = self._index.get(record.get(self.key_name))
+                if location is None or location[0] != segment_id or location[1] != offset:
+                    continue
+                if start or end:
+                    moment = record.get(self.time_field)
+                    if moment is None or (start and moment < start) or (end and moment > end):
+                        continue
+                yield record
+
+    @property
+    def name(self) -> str:
+        return self.filepath.name
+
+    def s_has(self, value: Any) -> bool:
+        return value in self._index
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def s_write_lines(self, records: list, rotate: bool = True) -> None:
+        """
+        Appends the given records through the held file handle with a single writelines call
+        """
+        if rotate and self._should_rotate():
+            self.s_rotate()
+        active = self._active
+        file = self._open_file()
+        if self.header is not None and active.get('header') != self.header:
+            header = self._encode({self._header: self.header})
+            file.write(header)
+            active['header'] = self.header
+            active['size'] += len(header)
+        lines = [self._encode(record) for record in records]
+        file.writelines(lines)
+        file.flush()
+        for record, line in zip(records, lines):
+            self._apply(record, active, active['size'], len(line))
+            active['size'] += len(line)
+
+    def s_get(self, key: Any = None, value: Any = None) -> dict:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        key = key or self.key_name
+        if key == self.key_name:
+            location = self._index.get(value)
+            return self._read_at(*location) if location is not None else None
+        for line in self.s_scan():
+            if line.get(key) == value:
+                return line
+
+    def s_get_all(self, key: Any = None, value: Any = None) -> list:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        key = key or self.key_name
+        if key == self.key_name:
+            line = self.s_get(key, value)
+            return [line] if line is not None else []
+        return [line for line in self.s_scan() if line.get(key) == value]
+    
+    def s_read(self) -> list:
+        return list(self.s_scan())
+    
+    def s_add_many(self, records: list) -> None:
+        if self.unique_only:
+            unique = {}
+            for record in records:
+                value = record[self.key_name]
+                if value not in self._index and value not in unique:
+                    unique[value] = record
+            records = list(unique.values())
+        if records:
+            self.s_write_lines(records)
+
+    def s_update_many(self, records: list) -> None:
+        # Each record keeps its key, so new versions are appended in one write and the index
+        # accounts for the versions they supersede
+        self.s_write_lines(records)
+
+    def s_update(self, key: Any = None, value: Any = None, data: dict = None) -> None:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        key = key or self.key_name
+        current = value if key == self.key_name else (self.s_get(key, value) or {}).get(self.key_name)
+        records = [data]
+        if current is not None and current in self._index and current != data[self.key_name]:
+            records.append({self.key_name: current, self._tombstone: True})
+        self.s_write_lines(records)
+        
+    def s_remove(self, key: Any = None, value: Any = None) -> None:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        key = key or self.key_name
+        if key == self.key_name:
+            values = [value] if value in self._index else []
+        else:
+            values = [line[self.key_name] for line in self.s_scan() if line.get(key) == value]
+        if values:
+            self.s_write_lines([{self.key_name: item, self._tombstone: True} for item in values])
+
+    def s_clear(self) -> None:
+        self._close_file()
+        for segment in self.segments.values():
+            self._segment_path(segment).unlink(missing_ok=True)
+        self.segments, self._index = {}, {}
+        self._segment_path(self._new_segment(0)).touch()
+        self.s_save_index()
+
+    def _needs_compaction(self, segment: dict) -> bool:
+        return segment['dead'] >= self.compact_min_bytes and segment['dead'] >= segment['size'] * self.compact_ratio
+
+    def s_needs_compaction(self) -> bool:
+        return any(self._needs_compaction(segment) for segment in self.segments.values())
+
+    def _tombstones(self, segment: dict) -> dict:
+        """
+        Finds the tombstones in a segment that still hide an older version of a removed record.
+        Only segments after the first can have such versions before them, and only the last
+        tombstone of a key that has not been written again is needed.
+        """
+        if segment['id'] == next(iter(self.segments)):
+            return {}
+        tombstones = {}
+        for offset, line in self._iter_segment(segment):
+            if self._tombstone.encode() not in line:
+                continue
+            record = json.loads(line)
+            value = record.get(self.key_name)
+            if record.get(self._tombstone) and value not in self._index:
+                tombstones.pop(value, None)
+                tombstones[value] = (offset, len(line))
+        return tombstones
+
+    def s_compact_segment(self, segment: dict) -> int:
+        """
+        Rewrites one segment with only the current version of each record, and the tombstones that
+        removed records from older segments, returning the bytes reclaimed. Closed segments left
+        with neither are deleted outright.
+        """
+        segment_id = segment['id']
+        live = [(offset, length, key) for key, (owner, offset, length) in self._index.items() if owner == segment_id]
+        tombstones = self._tombstones(segment)
+        lines = sorted([*live, *((offset, length, None) for offset, length in tombstones.values())])
+        path = self._segment_path(segment)
+        if not lines and segment is not self._active:
+            path.unlink(missing_ok=True)
+            del self.segments[segment_id]
+            return segment['size']
+        if segment is self._active:
+            self._close_file()
+        temp_filepath = path.with_name(path.name + '.tmp')
+        size = 0
+        with self._open_segment(segment) as (reader, _), temp_filepath.open('wb') as file:
+            writer = _GzipBlockWriter(file, self.block_size) if segment['closed'] else file
+            if segment.get('header'):
+                header = self._encode({self._header: segment['header']})
+                writer.write(header)
+                size += len(header)
+            for offset, length, key in lines:
+                reader.seek(offset)
+                writer.write(reader.read(length))
+                if key is not None:
+                    self._index[key] = (segment_id, size, length)
+                size += length
+            if segment['closed']:
+                writer.close()
+                segment.update(blocks=writer.blocks, block_size=self.block_size)
+            segment['disk'] = file.tell()
+        os.replace(temp_filepath, path)
+        reclaimed = segment['size'] - size
+        # Kept tombstones are not counted as dead, or the segment would be compacted over and over
+        segment.update(size=size, dead=0, records=len(lines))
+        return reclaimed
+
+    def s_compact(self) -> int:
+        """
+        Compacts every segment with enough dead versions, returning the bytes reclaimed
+        """
+        reclaimed = 0
+        for segment in list(self.segments.values()):
+            if self._needs_compaction(segment):
+                reclaimed += self.s_compact_segment(segment)
+        self.s_save_index()
+        return reclaimed
+
+    def _disk_size(self, segment: dict) -> int:
+        try:
+            return self._segment_path(segment).stat().st_size
+        except OSError:
+            return 0
+
+    def _drop_segment(self, segment: dict) -> tuple[list, int]:
+        """
+        Deletes the oldest segment with every record it holds the current version of. Segments
+        are only dropped oldest first: a later one may hold tombstones, or newer versions, that
+        keep older versions in the segments before it from coming back when the index is rebuilt.
+        """
+        segment_id = segment['id']
+        removed = [key for key, location in self._index.items() if location[0] == segment_id]
+        for key in removed:
+            del self._index[key]
+        reclaimed = self._disk_size(segment)
+        self._segment_path(segment).unlink(missing_ok=True)
+        del self.segments[segment_id]
+        self.s_save_index()
+        return removed, reclaimed
+
+    def _start_expiring(self, before: Optional[str], max_bytes: Optional[int]) -> Optional[tuple[list, int, bool]]:
+        """
+        Drops the oldest segment once it is expired as a whole, or else picks the segment to go
+        through record by record; returns a result when there is no segment to go through
+        """
+        active = self._active
+        oldest = next(iter(self.segments.values()))
+        if oldest is not active and before and oldest['last'] is not None and oldest['last'] < before:
+            return (*self._drop_segment(oldest), False)
+        excess = sum(self._disk_size(segment) for segment in self.segments.values()) - max_bytes if max_bytes else 0
+        if excess > 0 and oldest is not active:
+            return (*self._drop_segment(oldest), False)
+        target = next((segment for segment in self.segments.values() if before and segment['first'] is not None and segment['first'] < before), None)
+        if target is None and excess > 0:
+            target = active
+        else:
+            excess = 0
+        if target is None:
+            return [], 0, True
+        live = sorted((offset, length, key) for key, (owner, offset, length) in self._index.items() if owner == target['id'])
+        if not live:
+            target['first'] = target['last'] = None
+            return [], 0, excess > 0
+        self._expiring = {'segment': target['id'], 'live': live, 'position': 0, 'excess': excess, 'first': None, 'last': None, 'stale': False}
+
+    def s_expire(self, before: Optional[datetime], max_bytes: Optional[int], limit: int) -> tuple[list, int, bool]:
+        before = before.isoformat() if before and self.time_field else None
+        if self._expiring is None:
+            result = self._start_expiring(before, max_bytes)
+            if result is not None:
+                return result
+        state = self._expiring
+        segment = self.segments.get(state['segment'])
+        if segment is None:
+            self._expiring = None
+            return [], 0, False
+        batch = state['live'][state['position']:state['position'] + limit]
+        state['position'] += len(batch)
+        expired = []
+        with self._open_segment(segment, batch[0][0] if batch else 0) as (file, base):
+            for offset, length, key in batch:
+                # Records updated or compacted since the pass started are left for the next pass
+                if self._index.get(key) != (segment['id'], offset, length):
+                    state['stale'] = True
+                    continue
+                file.seek(offset - base)
+                moment = json.loads(file.read(length)).get(self.time_field) if self.time_field else None
+                if state['excess'] > 0 or (before and moment is not None and moment < before):
+                    expired.append(key)
+                    state['excess'] -= length
+                elif moment is not None:
+                    state['first'] = moment if state['first'] is None else min(state['first'], moment)
+                    state['last'] = moment if state['last'] is None else max(state['last'], moment)
+        if expired:
+            # Rotating would compress the segment being gone through while its size is still counted
+            self.s_write_lines([{self.key_name: key, self._tombstone: True} for key in expired], rotate=False)
+        if state['position'] < len(state['live']):
+            return expired, 0, False
+        self._expiring = None
+        if not state['stale']:
+            segment['first'], segment['last'] = state['first'], state['last']
+        reclaimed = 0
+        if segment['dead']:
+            size = self._disk_size(segment)
+            self.s_compact_segment(segment)
+            reclaimed = size - (self._disk_size(segment) if segment['id'] in self.segments else 0)
+        self.s_save_index()
+        return expired, reclaimed, False
+
+    def s_idle(self) -> None:
+        self._close_file()
+        if self._should_rotate():
+            self.s_rotate()
+        self.s_save_index()
+
+    def s_close(self) -> None:
+        self._close_file()
+        self.s_save_index()
@@ -1,82 +1,135 @@
-from discord import Embed
-from discord.ext import commands
-
-__all__ = ['Help']
-
-class Help(commands.HelpCommand):
-
-    def get_command_signature(self, command: commands.Command, context: commands.Context):
-        aliases = "|".join(command.aliases)
-        partial_invoke = f"[{command.name}|{aliases}]" if command.aliases else command.name
-        complete_invoke = command.qualified_name.replace(command.name, "")
-        signature = f"{context.prefix}{complete_invoke}{partial_invoke} {command.signature}"
-        return signature
-
-    async def send_bot_help(self, mapping):
-        embed = Embed(
-            title = 'Help', 
-            description = 'Here is my command set below! Specify a category or command after this command to get more information about each one! '
-        )
-        for cog in mapping:
-            commandset = ', '.join([command.name for command in [await self.filter_commands(mapping[cog], sort = True)][0]])
-            if commandset:
-                embed.add_field(
-                    name = cog.qualified_name if cog else (cog or 'Miscellaneous'), 
-                    value = '`' + commandset + '`',
-                    inline = False
-                ) 
-        channel = self.get_destination()     
-        return await channel.send(embed = embed)
-
-    async def send_command_help(self, command):
-        cmd = self.get_command_signature(command, self.context)
-        embed = Embed(title = f'Help for {command}', description = f'`{cmd}`')
-        embed.add_field(name = 'Description', value = command.help)
-        channel = self.get_destination()   
-        return await channel.send(embed = embed)
-
-    async def send_group_help(self, group):
-        cmd = self.get_command_signature(group, self.context)
-        embed = Embed(title = f'Help for {group}', description = f'`{cmd}`')
-        embed.add_field(name = 'Description', value = group.help)
-        subcommands = f'`{", ".join([command.name for command in group.walk_commands()])}`' if hasattr(group, "all_commands") else None
-        embed.add_field(name = 'Subcommands', value = subcommands, inline = False) if subcommands else None
-        channel = self.get_destination()    
-        return await channel.send(embed = embed)
-
-    async def send_cog_help(self, cog):
-        cogdata = self.get_bot_mapping()
-        cogdata = cogdata[cog]
-        embed = Embed(title = f'Help for {cog.qualified_name if cog else cog}')
-        embed.add_field(
-                name = 'Commands', 
-                value = '`'+', '.join([command.name for command in cogdata])+'`',
-                inline = False
-            )
-        channel = self.get_destination()     
-        return await channel.send(embed = embed)
-
-    async def on_help_command_error(self, context, error):
-        embed = Embed(
-            title = 'Command / Group Not Found! ',
-            description = error
-        )
-        return await context.send(embed = embed)
-
-    async def command_not_found(self, string):
-        embed = Embed(
-            title = 'Command / Group Not Found! ',
-            description = f'The command or category `{string}` simply does not exist! You may have mispelt the command name! '
-        )
-        return embed
-    
-    async def subcommand_not_found(self, command, string):
-        embed = Embed(
-            title = 'Subcommand Not Found! ',
-            description = f'The subcommand `{string}` simply does not exist! You may have mispelt the subcommand name! '
-        )
-        return embed
-
-    async def send_error_message(self, error):
-        channel = self.get_destination()
+from typing import Optional
+
+from discord import Embed
+from discord.ext import commands
+
+from core.paginator import EmbedPaginator
+
+__all__ = ['Help']
+
+class Help(commands.HelpCommand):
+    """
+    Help with its listings cached on the bot and split across pages.
+
+    Which commands a member may run depends only on whether they own the bot and on their and the
+    bot's permissions where help was asked, so the filtered bot help is cached per such profile.
+    Cog help lists every command of the cog and is cached per cog. The bot clears the cache whenever
+    a cog is added or removed, which covers loading and reloading extensions.
+    """
+
+    _fields_per_page = 8
+    _field_limit = 1024
+    _page_limit = 5000
+
+    def _cache(self) -> dict:
+        return self.context.bot._help_cache
+
+    async def _profile(self) -> tuple:
+        context = self.context
+        owner = await context.bot.is_owner(context.author)
+        if context.guild is None:
+            return owner, None
+        channel = context.channel
+        return owner, context.author.guild_permissions.value, channel.permissions_for(context.author).value, channel.permissions_for(context.me).value
+
+    @classmethod
+    def _command_fields(cls, name: str, names: list[str]) -> list[tuple[str, str]]:
+        """
+        Lists command names in as many fields as it takes to stay within the field value limit
+        """
+        chunks, chunk, length = [], [], 2
+        for command_name in names:
+            if chunk and length + len(command_name) + 2 > cls._field_limit:
+                chunks.append(chunk)
+                chunk, length = [], 2
+            chunk.append(command_name)
+            length += len(command_name) + 2
+        if chunk:
+            chunks.append(chunk)
+        return [(name if index == 0 else f'{name} (continued)', '`' + ', '.join(chunk) + '`') for index, chunk in enumerate(chunks)]
+
+    @classmethod
+    def _pages(cls, title: str, description: Optional[str], fields: list[tuple[str, str]]) -> list[Embed]:
+        pages = []
+        for name, value in fields:
+            if not pages or len(pages[-1].fields) >= cls._fields_per_page or len(pages[-1]) + len(name) + len(value) > cls._page_limit:
+                pages.append(Embed(title = title, description = description))
+            pages[-1].add_field(name = name, value = value, inline = False)
+        return pages or [Embed(title = title, description = description)]
+
+    async def _send_pages(self, pages: list[Embed]):
+        if len(pages) == 1:
+            return await self.get_destination().send(embed = pages[0])
+        return await EmbedPaginator(pages, self.context.author.id).send(self.get_destination())
+
+    def get_command_signature(self, command: commands.Command, context: commands.Context):
+        aliases = "|".join(command.aliases)
+        partial_invoke = f"[{command.name}|{aliases}]" if command.aliases else command.name
+        complete_invoke = command.qualified_name.replace(command.name, "")
+        signature = f"{context.prefix}{complete_invoke}{partial_invoke} {command.signature}"
+        return signature
+
+    async def send_bot_help(self, mapping):
+        key = ('bot', await self._profile())
+        pages = self._cache().get(key)
+        if pages is None:
+            fields = []
+            for cog in mapping:
+                commandset = [command.name for command in await self.filter_commands(mapping[cog], sort = True)]
+                if commandset:
+                    fields.extend(self._command_fields(cog.qualified_name if cog else 'Miscellaneous', commandset))
+            pages = self._cache()[key] = self._pages(
+                'Help',
+                'Here is my command set below! Specify a category or command after this command to get more information about each one! ',
+                fields,
+            )
+        return await self._send_pages(pages)
+
+    async def send_command_help(self, command):
+        cmd = self.get_command_signature(command, self.context)
+        embed = Embed(title = f'Help for {command}', description = f'`{cmd}`')
+        embed.add_field(name = 'Description', value = command.help)
+        channel = self.get_destination()   
+        return await channel.send(embed = embed)
+
+    async def send_group_help(self, group):
+        cmd = self.get_command_signature(group, self.context)
+        embed = Embed(title = f'Help for {group}', description = f'`{cmd}`')
+        embed.add_field(name = 'Description', value = group.help)
+        subcommands = f'`{", ".join([command.name for command in group.walk_commands()])}`' if hasattr(group, "all_commands") else None
+        embed.add_field(name = 'Subcommands', value = subcommands, inline = False) if subcommands else None
+        channel = self.get_destination()    
+        return await channel.send(embed = embed)
+
+    async def send_cog_help(self, cog):
+        key = ('cog', cog.qualified_name)
+        pages = self._cache().get(key)
+        if pages is None:
+            commandset = [command.name for command in cog.get_commands()]
+            pages = self._cache()[key] = self._pages(f'Help for {cog.qualified_name}', None, self._command_fields('Commands', commandset))
+        return await self._send_pages(pages)
+
+    async def on_help_command_error(self, context, error):
+        embed = Embed(
+            title = 'Command / Group Not Found! ',
+            description = error
+        )
+        return await context.send(embed = embed)
+
+    async def command_not_found(self, string):
+        embed = Embed(
+            title = 'Command / Group Not Found! ',
+            description = f'The command or category `{string}` simply does not exist! You may have mispelt the command name! '
+        )
+        return embed
+    
+    async def subcommand_not_found(self, command, string):
+        embed = Embed(
+            title = 'Subcommand Not Found! ',
+            description = f'The subcommand `{string}` simply does not exist! You may have mispelt the subcommand name! '
+        )
+        return embed
+
+    async def send_error_message(self, error):
+        channel = self.get_destination()
         return await channel.send(embed = error)
\ No newline at end of file
@@ -0,0 +1,534 @@
+import asyncio
+from datetime import datetime
+import itertools
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import queue
+import struct
+import threading
+from typing import Any, AsyncIterator, BinaryIO, Callable, Optional
+
+from core.metrics import metrics
+from core.records import MessageRecord, open_message_storage, queue_message
+from core.storage import RecordStorage
+
+__all__ = ['IngestClient', 'RemoteRecordStorage', 'SpillBuffer']
+
+_header = struct.Struct('>I')
+
+
+class SpillBuffer:
+    """
+    Bounded FIFO of serialized batches on disk.
+
+    Batches are appended as length-prefixed blobs and read back in order from a moving offset; the
+    file is truncated once it has been read to the end. Anything left over from a previous run is
+    replayed first, so batches spilled before a crash are not lost.
+    """
+
+    filepath: Path
+    max_bytes: int
+    size: int
+    _offset: int
+    _file: Optional[BinaryIO]
+
+    def __init__(self, filepath: Path, max_bytes: int):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.size = filepath.stat().st_size if filepath.exists() else 0
+        self._offset = 0
+        self._file = None
+
+    @property
+    def pending(self) -> int:
+        return self.size - self._offset
+
+    def _open(self) -> BinaryIO:
+        if self._file is None:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.filepath.open('a+b')
+        return self._file
+
+    def s_push(self, payload: bytes) -> bool:
+        """
+        Appends a batch, returning False without writing it if the buffer is full
+        """
+        if self.pending + _header.size + len(payload) > self.max_bytes:
+            return False
+        file = self._open()
+        file.write(_header.pack(len(payload)) + payload)
+        file.flush()
+        self.size += _header.size + len(payload)
+        return True
+
+    def s_pop(self) -> Optional[bytes]:
+        if not self.pending:
+            return None
+        file = self._open()
+        file.seek(self._offset)
+        header = file.read(_header.size)
+        length = _header.unpack(header)[0] if len(header) == _header.size else None
+        payload = file.read(length) if length is not None else b''
+        if length is None or len(payload) < length:
+            # A batch cut short by a crash while it was being spilled cannot be recovered
+            self._offset = self.size
+            payload = None
+        else:
+            self._offset += _header.size + length
+        if not self.pending:
+            file.truncate(0)
+            self.size = self._offset = 0
+        return payload
+
+    def s_keep(self, head: list[bytes], tail: list[bytes]) -> None:
+        """
+        Rewrites the file as `head`, the batches not read yet and then `tail`, so that everything
+        still unsent is replayed in order on the next start
+        """
+        file = self._open()
+        file.seek(self._offset)
+        unread = file.read(self.pending)
+        temporary = self.filepath.with_suffix('.tmp')
+        with temporary.open('wb') as output:
+            for payload in head:
+                output.write(_header.pack(len(payload)) + payload)
+            output.write(unread)
+            for payload in tail:
+                output.write(_header.pack(len(payload)) + payload)
+            output.flush()
+            os.fsync(output.fileno())
+        self.s_close()
+        os.replace(temporary, self.filepath)
+        self.size = self.filepath.stat().st_size
+        self._offset = 0
+
+    def s_close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class IngestWorker:
+    """
+    Runs in the ingestion process and owns the Overwatch message stores, applying the operations
+    sent by `IngestClient` in the order they were sent
+    """
+
+    requests: multiprocessing.Queue
+    responses: multiprocessing.Queue
+    handlers: dict[int, RecordStorage]
+    opening: dict[int, asyncio.Task]
+    scans: dict[int, tuple[asyncio.Event, asyncio.Task]]
+
+    def __init__(self, requests: multiprocessing.Queue, responses: multiprocessing.Queue):
+        self.requests = requests
+        self.responses = responses
+        self.handlers = {}
+        self.opening = {}
+        self.scans = {}
+
+    async def handler(self, channel_id: int) -> RecordStorage:
+        """
+        Returns a channel's store, opening it in the executor the first time; a scan asking for the
+        store while it opens waits for the same one
+        """
+        handler = self.handlers.get(channel_id)
+        if handler is None:
+            opening = self.opening.get(channel_id)
+            if opening is None:
+                opening = self.opening[channel_id] = self.loop.create_task(open_message_storage(channel_id, loop=self.loop))
+            handler = self.handlers[channel_id] = await opening
+            self.opening.pop(channel_id, None)
+        return handler
+
+    def log(self, message: str) -> None:
+        self.responses.put(('log', None, message))
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        while True:
+            payload = await self.loop.run_in_executor(None, self.requests.get)
+            if payload is None:
+                break
+            for operation in pickle.loads(payload):
+                try:
+                    await self.apply(*operation)
+                except Exception as e:
+                    token = operation[1] if operation[0] not in ('message', 'modify') else None
+                    if token is None:
+                        self.log(f'Ingestion worker failed to apply {operation[0]}: {e!r}')
+                    else:
+                        self.responses.put(('error', token, repr(e)))
+        for handler in self.handlers.values():
+            await handler.close()
+        self.responses.put(None)
+
+    async def apply(self, kind: str, *args) -> None:
+        if kind == 'message':
+            record, = args
+            queue_message(await self.handler(record.channel_id), record)
+        elif kind == 'modify':
+            channel_id, value, change = args
+            handler = await self.handler(channel_id)
+            handler.queue_modify(value, change)
+        elif kind == 'flush':
+            token, channel_id = args
+            for handler in ([await self.handler(channel_id)] if channel_id is not None else list(self.handlers.values())):
+                await handler.flush()
+            self.responses.put(('result', token, None))
+        elif kind == 'close':
+            token, channel_id = args
+            handler = self.handlers.pop(channel_id, None)
+            if handler is not None:
+                await handler.close()
+            self.responses.put(('result', token, None))
+        elif kind == 'get':
+            token, channel_id, value = args
+            handler = await self.handler(channel_id)
+            self.responses.put(('result', token, await handler.get(value=value)))
+        elif kind == 'expire':
+            token, channel_id, before, max_bytes, limit = args
+            handler = await self.handler(channel_id)
+            self.responses.put(('result', token, await handler.expire(before, max_bytes, limit)))
+        elif kind == 'scan':
+            token, channel_id, start, end, batch_size = args
+            resume = asyncio.Event()
+            self.scans[token] = (resume, self.loop.create_task(self.scan(token, resume, channel_id, start, end, batch_size)))
+        elif kind == 'next':
+            token, = args
+            if token in self.scans:
+                self.scans[token][0].set()
+        elif kind == 'cancel':
+            token, = args
+            if token in self.scans:
+                self.scans[token][1].cancel()
+
+    async def scan(self, token: int, resume: asyncio.Event, channel_id: int, start: Optional[datetime], end: Optional[datetime], batch_size: int) -> None:
+        """
+        Streams a scan back one batch at a time, waiting for the client to ask for the next so a slow
+        consumer never has more than one batch in flight
+        """
+        try:
+            handler = await self.handler(channel_id)
+            async for batch in handler.scan(start, end, batch_size):
+                resume.clear()
+                self.responses.put(('batch', token, batch))
+                await resume.wait()
+            self.responses.put(('result', token, None))
+        except Exception as e:
+            self.responses.put(('error', token, repr(e)))
+        finally:
+            self.scans.pop(token, None)
+
+
+def run_worker(requests: multiprocessing.Queue, responses: multiprocessing.Queue) -> None:
+    asyncio.run(IngestWorker(requests, responses).run())
+
+
+class IngestClient:
+    """
+    Hands Overwatch storage work to a separate ingestion process.
+
+    The ingest path only copies a message's fields into a `MessageRecord` and appends it to a
+    buffer. A sender task pickles the buffer in batches in the executor and puts them on a bounded
+    multiprocessing queue, and the worker serializes, deduplicates and writes the records, so none
+    of that runs on the bot's event loop or under its GIL. When the queue is full, batches spill to a bounded file on disk and are
+    replayed in order once the worker catches up. Once the spill file is full too, the sender
+    stalls, and `saturated` tells the ingest path to wait for `drained` before it buffers more.
+    Requests that need an answer, such as flushes and reads, are matched to their responses by token.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    queue_size: int
+    batch_size: int
+    max_buffered: int
+    restarts: int
+    _process: Optional[multiprocessing.Process]
+    _buffer: list
+    _spill: SpillBuffer
+    _spilled: Optional[bytes]
+    _waiters: dict[int, asyncio.Future]
+    _streams: dict[int, asyncio.Queue]
+
+    def __init__(self, spill_file: Path, *args, queue_size: int = 256, batch_size: int = 200, spill_size: int = 256 * 1024 * 1024, max_buffered: int = 10000, flush_interval: float = 0.05, **kwargs):
+        self.loop = kwargs.pop('loop', asyncio.get_running_loop())
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.flush_interval = flush_interval
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._requests = None
+        self._responses = None
+        self._process = None
+        self._buffer = []
+        self._spill = SpillBuffer(spill_file, spill_size)
+        self._spilled = None
+        self._tokens = itertools.count()
+        self._waiters = {}
+        self._streams = {}
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._sender = None
+        self._reader = None
+
+    @property
+    def saturated(self) -> bool:
+        return len(self._buffer) >= self.max_buffered
+
+    def _spawn(self) -> None:
+        """
+        Starts a worker with fresh queues; a worker that was killed may have died holding a queue's
+        lock, so its queues cannot be handed on
+        """
+        self._requests = self._context.Queue(self.queue_size)
+        self._responses = self._context.Queue()
+        self._process = self._context.Process(target=run_worker, args=(self._requests, self._responses), name='overwatch-ingest', daemon=True)
+        self._process.start()
+        self._reader = threading.Thread(target=self._read_responses, args=(self._responses,), name='overwatch-ingest-reader', daemon=True)
+        self._reader.start()
+
+    def start(self) -> None:
+        self._spawn()
+        self._sender = self.loop.create_task(self._send_loop())
+
+    def _ensure_worker(self) -> None:
+        if not self._process.is_alive():
+            self._restart()
+
+    def _restart(self) -> None:
+        self.restarts += 1
+        metrics.increment('ingest.restarts')
+        logging.getLogger('bot').error(f'Ingestion worker exited with code {self._process.exitcode}, restarting it; batches it had not written are lost')
+        self._retire()
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_exception(RuntimeError('Ingestion worker exited'))
+        for stream in self._streams.values():
+            stream.put_nowait(('error', 'worker exited'))
+        self._spawn()
+
+    def _retire(self) -> None:
+        """
+        Lets go of the queues of a worker that did not exit cleanly. It may have died holding their
+        locks or with a pipe full, so nothing more is put on them and their feeder threads are not
+        waited for at exit; the reader stops once it sees its queue was replaced.
+        """
+        self._requests.cancel_join_thread()
+        self._responses.cancel_join_thread()
+        self._requests = self._responses = None
+
+    def _read_responses(self, responses: multiprocessing.Queue) -> None:
+        while True:
+            try:
+                response = responses.get(timeout=1.0)
+            except queue.Empty:
+                if responses is not self._responses:
+                    return
+                continue
+            if response is None:
+                return
+            self.loop.call_soon_threadsafe(self._dispatch, *response)
+
+    def _dispatch(self, kind: str, token: Optional[int], value: Any) -> None:
+        if kind == 'log':
+            logging.getLogger('bot').error(value)
+        elif token in self._streams:
+            self._streams[token].put_nowait((kind, value))
+        elif token in self._waiters and not self._waiters[token].done():
+            if kind == 'error':
+                self._waiters[token].set_exception(RuntimeError(f'Ingestion worker error: {value}'))
+            else:
+                self._waiters[token].set_result(value)
+
+    def send(self, operation: tuple) -> None:
+        """
+        Buffers an operation for the worker without blocking
+        """
+        self._buffer.append(operation)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+        if self.saturated:
+            self._drained.clear()
+
+    async def drained(self) -> None:
+        await self._drained.wait()
+
+    async def _send_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._send_pending()
+            except Exception:
+                logging.getLogger('bot').exception('Failed to send to the ingestion worker')
+
+    async def _send_pending(self) -> None:
+        self._ensure_worker()
+        await self._replay()
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            await self._submit(await self.loop.run_in_executor(None, pickle.dumps, batch, pickle.HIGHEST_PROTOCOL))
+            del self._buffer[:len(batch)]
+        self._drained.set()
+
+    def _put(self, payload: bytes) -> bool:
+        try:
+            self._requests.put_nowait(payload)
+        except queue.Full:
+            return False
+        return True
+
+    async def _replay(self) -> bool:
+        """
+        Moves spilled batches back onto the queue in order, returning whether the spill file is empty
+        """
+        while self._spilled is not None or self._spill.pending:
+            if self._spilled is None:
+                self._spilled = await self.loop.run_in_executor(None, self._spill.s_pop)
+                if self._spilled is None:
+                    continue
+            if not self._put(self._spilled):
+                return False
+            self._spilled = None
+        return True
+
+    async def _submit(self, payload: bytes) -> None:
+        # Anything already spilled has to reach the worker first, so new batches queue behind it
+        if self._spilled is None and not self._spill.pending and self._put(payload):
+            return
+        while not await self.loop.run_in_executor(None, self._spill.s_push, payload):
+            metrics.increment('ingest.stalled')
+            await asyncio.sleep(0.1)
+            self._ensure_worker()
+            await self._replay()
+        metrics.increment('ingest.spilled')
+
+    async def request(self, kind: str, *args, timeout: float = 60.0) -> Any:
+        """
+        Sends an operation that the worker answers, once everything sent before it has been applied
+        """
+        token = next(self._tokens)
+        future = self._waiters[token] = self.loop.create_future()
+        self.send((kind, token, *args))
+        self._wakeup.set()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._waiters.pop(token, None)
+
+    async def scan(self, channel_id: int, start: datetime = None, end: datetime = None, batch_size: int = 500) -> AsyncIterator[list]:
+        token = next(self._tokens)
+        stream = self._streams[token] = asyncio.Queue()
+        self.send(('scan', token, channel_id, start, end, batch_size))
+        self._wakeup.set()
+        finished = False
+        try:
+            while True:
+                kind, value = await stream.get()
+                if kind == 'error':
+                    finished = True
+                    raise RuntimeError(f'Ingestion worker error: {value}')
+                if kind == 'result':
+                    finished = True
+                    return
+                yield value
+                self.send(('next', token))
+                self._wakeup.set()
+        finally:
+            self._streams.pop(token, None)
+            if not finished:
+                self.send(('cancel', token))
+
+    def handler(self, channel_id: int) -> 'RemoteRecordStorage':
+        return RemoteRecordStorage(self, channel_id)
+
+    async def _drain(self) -> None:
+        await self._send_pending()
+        while not await self._replay():
+            self._ensure_worker()
+            await asyncio.sleep(0.1)
+
+    def _stop_worker(self, timeout: float) -> None:
+        """
+        Asks the worker to exit once it has written what it was sent, killing it if it does not take
+        the request or finish within `timeout` seconds each
+        """
+        try:
+            self._requests.put(None, timeout=timeout)
+            self._process.join(timeout)
+        except queue.Full:
+            pass
+        if self._process.is_alive():
+            logging.getLogger('bot').error(f'Ingestion worker did not exit within {timeout}s, killing it')
+            self._process.kill()
+            self._process.join()
+        if self._process.exitcode != 0:
+            self._retire()
+
+    async def close(self, timeout: float = 60.0) -> None:
+        """
+        Sends everything buffered or spilled, then stops the worker once it has written it all. A
+        worker that exits meanwhile is restarted; whatever has not reached the worker after
+        `timeout` seconds is kept in the spill file and replayed on the next start.
+        """
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.getLogger('bot').error(f'Ingestion worker did not catch up within {timeout}s, keeping what it was not sent in {self._spill.filepath}')
+            batches = [
+                await self.loop.run_in_executor(None, pickle.dumps, self._buffer[start:start + self.batch_size], pickle.HIGHEST_PROTOCOL)
+                for start in range(0, len(self._buffer), self.batch_size)
+            ]
+            head = [self._spilled] if self._spilled is not None else []
+            await self.loop.run_in_executor(None, self._spill.s_keep, head, batches)
+            self._buffer, self._spilled = [], None
+        await self.loop.run_in_executor(None, self._stop_worker, timeout)
+        await self.loop.run_in_executor(None, self._reader.join, 5.0)
+        self._spill.s_close()
+
+
+class RemoteRecordStorage:
+    """
+    Stands in for the `RecordStorage` of a channel whose store is owned by the ingestion worker.
+    `queue` takes a `MessageRecord`, which the worker serializes and queues with `queue_message`.
+    """
+
+    client: IngestClient
+    channel_id: int
+
+    def __init__(self, client: IngestClient, channel_id: int):
+        self.client = client
+        self.channel_id = channel_id
+
+    def queue(self, record: MessageRecord) -> None:
+        self.client.send(('message', record))
+
+    def queue_modify(self, value: Any, change: Callable[[dict], dict]) -> None:
+        self.client.send(('modify', self.channel_id, value, change))
+
+    async def flush(self) -> None:
+        await self.client.request('flush', self.channel_id)
+
+    async def close(self) -> None:
+        await self.client.request('close', self.channel_id)
+
+    async def get(self, key: Any = None, value: Any = None) -> dict:
+        return await self.client.request('get', self.channel_id, value)
+
+    async def expire(self, before: datetime = None, max_bytes: int = None, limit: int = 1000) -> tuple[list, int, bool]:
+        return await self.client.request('expire', self.channel_id, before, max_bytes, limit)
+
+    async def scan(self, start: datetime = None, end: datetime = None, batch_size: int = 500) -> AsyncIterator[list]:
+        async for batch in self.client.scan(self.channel_id, start, end, batch_size):
+            yield batch
@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler
+import queue
+
+__all__ = ['JSONFormatter', 'LogQueueHandler']
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a single JSON object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Hands records to a bounded in-process queue for a `QueueListener` thread.
+
+    Only the message is merged on the calling thread; tracebacks are formatted by the listener, so
+    logging an exception costs the event loop no more than a plain message. When the queue is full
+    records are dropped and counted rather than blocking the caller.
+    """
+
+    dropped: int
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
@@ -0,0 +1,78 @@
+import sys
+from itertools import islice
+from typing import Any, Iterable
+
+from discord import Client, Intents, MemberCacheFlags
+
+__all__ = ['build_intents', 'build_member_cache_flags', 'cache_report']
+
+def _flags(cls: type, names: list[str], setting: str):
+    if names == ['all']:
+        return cls.all()
+    flags = cls.none()
+    for name in names:
+        if name not in cls.VALID_FLAGS:
+            raise ValueError(f'Unknown {setting} flag: {name}')
+        setattr(flags, name, True)
+    return flags
+
+def build_intents(names: list[str]) -> Intents:
+    """
+    Builds the gateway intents from flag names, or `all`
+    """
+    return _flags(Intents, names, 'BOT_INTENTS')
+
+def build_member_cache_flags(names: list[str], intents: Intents) -> MemberCacheFlags:
+    """
+    Builds the member cache flags from flag names, or `all`, keeping only those the intents allow
+    """
+    allowed = MemberCacheFlags.from_intents(intents)
+    if names == ['all']:
+        return allowed
+    flags = _flags(MemberCacheFlags, names, 'BOT_MEMBER_CACHE')
+    return MemberCacheFlags._from_value(flags.value & allowed.value)
+
+
+def _object_size(obj: Any) -> int:
+    """
+    Shallow size of an object plus the attributes it holds directly, which covers the strings,
+    numbers and small containers a cached model owns without double counting shared references
+    """
+    size = sys.getsizeof(obj)
+    slots = [slot for cls in type(obj).__mro__ for slot in getattr(cls, '__slots__', ())]
+    values = [getattr(obj, slot, None) for slot in slots]
+    if hasattr(obj, '__dict__'):
+        values.extend(obj.__dict__.values())
+    for value in values:
+        if isinstance(value, (str, bytes, int, float, tuple, list, dict, set)):
+            size += sys.getsizeof(value)
+    return size
+
+def _estimate(objects: Iterable, count: int, sample: int = 200) -> int:
+    sampled = list(islice(objects, sample))
+    if not sampled:
+        return 0
+    return sum(_object_size(obj) for obj in sampled) * count // len(sampled)
+
+def cache_report(bot: Client) -> list[tuple[str, int, int]]:
+    """
+    Returns `(cache, entries, estimated bytes)` rows for the client's model caches.
+
+    Sizes are extrapolated from a sample of each cache, so they are estimates of the order of
+    magnitude rather than exact accounting.
+    """
+    state = bot._connection
+    guilds = list(bot.guilds)
+    caches = {
+        'guilds': (guilds, len(guilds)),
+        'members': ((member for guild in guilds for member in guild._members.values()), sum(len(guild._members) for guild in guilds)),
+        'users': (state._users.values(), len(state._users)),
+        'channels': ((channel for guild in guilds for channel in guild._channels.values()), sum(len(guild._channels) for guild in guilds)),
+        'threads': ((thread for guild in guilds for thread in guild._threads.values()), sum(len(guild._threads) for guild in guilds)),
+        'roles': ((role for guild in guilds for role in guild._roles.values()), sum(len(guild._roles) for guild in guilds)),
+        'voice_states': ((voice for guild in guilds for voice in guild._voice_states.values()), sum(len(guild._voice_states) for guild in guilds)),
+        'emojis': (state._emojis.values(), len(state._emojis)),
+        'stickers': (state._stickers.values(), len(state._stickers)),
+        'messages': (state._messages or (), len(state._messages or ())),
+    }
+    return [(name, count, _estimate(objects, count)) for name, (objects, count) in caches.items()]
@@ -0,0 +1,142 @@
+import asyncio
+from bisect import bisect_left
+from functools import wraps
+import time
+from typing import Any, Callable
+
+__all__ = ['Histogram', 'Metrics', 'metrics', 'timed_method']
+
+
+class Histogram:
+    """
+    Latency histogram over fixed, logarithmically spaced buckets.
+
+    Buckets grow by a factor of sqrt(2) from 10µs to a few minutes, so percentiles are estimated to
+    within about 20% with constant memory however many samples are observed.
+    """
+
+    bounds = [1e-5 * 2 ** (step / 2) for step in range(50)]
+
+    count: int
+    total: float
+    maximum: float
+    buckets: list[int]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+
+    def percentile(self, quantile: float) -> float:
+        if not self.count:
+            return 0.0
+        target = quantile * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[index] if index < len(self.bounds) else self.maximum, self.maximum)
+        return self.maximum
+
+
+class Metrics:
+    """
+    Registry of named latency histograms and counters for the running bot
+    """
+
+    histograms: dict[str, Histogram]
+    counters: dict[str, int]
+    started: float
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.monotonic()
+
+    def observe(self, name: str, seconds: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        self.histograms.clear()
+        self.counters.clear()
+        self.started = time.monotonic()
+
+    async def run_in_executor(self, loop: asyncio.AbstractEventLoop, name: str, func: Callable, *args) -> Any:
+        """
+        Runs `func` in the default executor, recording how long it queued and how long it ran
+        """
+        submitted = time.perf_counter()
+        def call():
+            started = time.perf_counter()
+            return started, func(*args)
+        started, result = await loop.run_in_executor(None, call)
+        finished = time.perf_counter()
+        self.observe('executor.wait', started - submitted)
+        self.observe(name, finished - started)
+        return result
+
+    async def monitor_loop_lag(self, interval: float = 0.5) -> None:
+        """
+        Records how late the event loop wakes a sleeping task, which is time spent blocked
+        """
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            self.observe('loop.lag', max(time.perf_counter() - expected, 0.0))
+
+    def summary(self) -> list[tuple[str, int, float, float, float]]:
+        """
+        Returns `(name, count, p50, p95, p99)` rows sorted by name, with latencies in seconds
+        """
+        return [
+            (name, histogram.count, histogram.percentile(0.5), histogram.percentile(0.95), histogram.percentile(0.99))
+            for name, histogram in sorted(self.histograms.items())
+        ]
+
+    def prometheus(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format
+        """
+        lines = ['# TYPE bot_latency_seconds summary']
+        for name, histogram in sorted(self.histograms.items()):
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f'bot_latency_seconds{{name="{name}",quantile="{quantile}"}} {histogram.percentile(quantile):.6f}')
+            lines.append(f'bot_latency_seconds_sum{{name="{name}"}} {histogram.total:.6f}')
+            lines.append(f'bot_latency_seconds_count{{name="{name}"}} {histogram.count}')
+        lines.append('# TYPE bot_events_total counter')
+        for name, count in sorted(self.counters.items()):
+            lines.append(f'bot_events_total{{name="{name}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed_method(category: str) -> Callable:
+    """
+    Decorates an async method so each call is recorded as `{category}.{Class}.{method}`
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                metrics.observe(f'{category}.{type(self).__name__}.{func.__name__}', time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,61 @@
+from discord import ButtonStyle, Embed, Interaction, Message
+from discord.abc import Messageable
+from discord.ui import Button, View, button
+
+__all__ = ['EmbedPaginator']
+
+class EmbedPaginator(View):
+    """
+    Button navigation over a fixed list of embeds, usable only by the member who asked for them
+    """
+
+    pages: list[Embed]
+    index: int
+    author_id: int
+    message: Message
+
+    def __init__(self, pages: list[Embed], author_id: int, *, timeout: float = 120.0):
+        super().__init__(timeout = timeout)
+        self.pages = pages
+        self.index = 0
+        self.author_id = author_id
+        for number, page in enumerate(pages, start = 1):
+            page.set_footer(text = f'Page {number}/{len(pages)}')
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = self.index >= len(self.pages) - 1
+
+    async def send(self, destination: Messageable, **kwargs) -> Message:
+        if len(self.pages) == 1:
+            self.stop()
+            self.message = await destination.send(embed = self.pages[0], **kwargs)
+        else:
+            self.message = await destination.send(embed = self.pages[0], view = self, **kwargs)
+        return self.message
+
+    async def interaction_check(self, interaction: Interaction) -> bool:
+        return interaction.user.id == self.author_id
+
+    async def _show(self, interaction: Interaction):
+        self._update_buttons()
+        await interaction.response.edit_message(embed = self.pages[self.index], view = self)
+
+    @button(label = 'Previous', style = ButtonStyle.secondary)
+    async def previous_page(self, interaction: Interaction, _: Button):
+        self.index = max(self.index - 1, 0)
+        await self._show(interaction)
+
+    @button(label = 'Next', style = ButtonStyle.secondary)
+    async def next_page(self, interaction: Interaction, _: Button):
+        self.index = min(self.index + 1, len(self.pages) - 1)
+        await self._show(interaction)
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        try:
+            await self.message.edit(view = self)
+        except Exception:
+            pass
@@ -1,15 +1,39 @@
-from discord.ext import commands
-from discord import Message
-
-from config.settings import COMMAND_PREFIX
-
-__all__ = ['get_prefix']
-
-async def get_prefix(bot: commands.Bot, message: Message):
-    """
-    Get the prefix for a message
-    """
-    prefix_set = [ COMMAND_PREFIX ]
-    if message.guild:
-        pass # To be implemented
-    return commands.when_mentioned_or(*prefix_set)(bot, message)
+from discord.ext import commands
+from discord import Message
+from typing import Optional
+
+from config.settings import COMMAND_PREFIX
+
+__all__ = ['get_prefix', 'invalidate_prefix']
+
+_prefix_cache: dict[Optional[int], list[str]] = {}
+
+def _build_prefixes(bot: commands.Bot, guild_id: Optional[int]) -> list[str]:
+    prefix_set = [ COMMAND_PREFIX ]
+    if guild_id is not None:
+        prefix_set = bot._prefix_handler.s_get(str(guild_id)) or prefix_set
+    return [f'<@{bot.user.id}> ', f'<@!{bot.user.id}> ', *prefix_set]
+
+async def get_prefix(bot: commands.Bot, message: Message):
+    """
+    Get the prefix for a message
+
+    Prefix lists, mentions included, are built once per guild and served from a cache until
+    `invalidate_prefix` is called for that guild.
+    """
+    guild_id = message.guild.id if message.guild else None
+    prefixes = _prefix_cache.get(guild_id)
+    if prefixes is None:
+        if bot.user is None:
+            return commands.when_mentioned_or(COMMAND_PREFIX)(bot, message)
+        prefixes = _prefix_cache[guild_id] = _build_prefixes(bot, guild_id)
+    return prefixes
+
+def invalidate_prefix(guild_id: Optional[int] = None):
+    """
+    Drop the cached prefixes for a guild, or for every guild when none is given
+    """
+    if guild_id is None:
+        _prefix_cache.clear()
+    else:
+        _prefix_cache.pop(guild_id, None)
@@ -0,0 +1,160 @@
+from datetime import datetime
+from typing import Any, Optional
+
+import discord
+
+from config.settings import OVERWATCH_FLUSH_INTERVAL, OVERWATCH_FLUSH_SIZE, OVERWATCH_SEGMENT_AGE, OVERWATCH_SEGMENT_SIZE
+from core.storage import RecordStorage, open_record_storage
+
+__all__ = ['MessageRecord', 'apply_delete', 'apply_edit', 'apply_reaction', 'expand_record', 'open_message_storage', 'queue_message']
+
+MESSAGE_COLUMNS = {
+    'author_id': lambda record: record['author']['id'],
+    'created_at': lambda record: record['created_at'],
+}
+
+
+async def open_message_storage(channel_id: int, **kwargs) -> RecordStorage:
+    """
+    Opens the Overwatch message log of a channel; shared by the bot and the ingestion worker so both
+    open the store the same way
+    """
+    return await open_record_storage(
+        'overwatch', channel_id, 'id', unique_only=True,
+        flush_interval=OVERWATCH_FLUSH_INTERVAL, flush_size=OVERWATCH_FLUSH_SIZE,
+        segment_size=OVERWATCH_SEGMENT_SIZE, segment_age=OVERWATCH_SEGMENT_AGE,
+        columns=MESSAGE_COLUMNS, time_field='created_at', **kwargs,
+    )
+
+class MessageRecord:
+    """
+    The logged fields of a message, copied off the event loop's objects as plain values. Embeds
+    are kept as their `discord.Embed` objects and only converted by `to_dict`, which in ingest mode
+    runs in the worker.
+
+    Only IDs and what changes per message are stored with each record: the channel and guild
+    names are the same for every message of a store, so `queue_message` hands them to the store as
+    its header, which backends write once per file or segment. `to_dict` leaves out empty and
+    default fields; readers fill them back in with `expand_record`.
+    """
+
+    __slots__ = (
+        'id', 'content', 'author_id', 'author_name', 'discriminator', 'bot',
+        'channel_id', 'channel_name', 'guild_id', 'guild_name',
+        'created_at', 'edited_at', 'attachments', 'embeds', 'reactions', 'pinned', 'tts',
+    )
+
+    def __init__(self, message: discord.Message):
+        author, channel, guild = message.author, message.channel, message.guild
+        self.id = message.id
+        self.content = message.content
+        self.author_id, self.author_name, self.discriminator, self.bot = author.id, author.name, author.discriminator, author.bot
+        self.channel_id, self.channel_name = channel.id, channel.name
+        self.guild_id, self.guild_name = guild.id, guild.name
+        self.created_at, self.edited_at = message.created_at, message.edited_at
+        self.attachments = tuple((attachment.id, attachment.filename, attachment.url) for attachment in message.attachments)
+        self.embeds = tuple(message.embeds)
+        self.reactions = tuple((str(reaction.emoji), reaction.count) for reaction in message.reactions)
+        self.pinned, self.tts = message.pinned, message.tts
+
+    def header(self) -> dict:
+        return {'channel': {'id': self.channel_id, 'name': self.channel_name}, 'guild': {'id': self.guild_id, 'name': self.guild_name}}
+
+    def to_dict(self) -> dict:
+        author = {'id': self.author_id, 'name': self.author_name}
+        if self.discriminator != '0':
+            author['discriminator'] = self.discriminator
+        if self.bot:
+            author['bot'] = True
+        record = {'id': self.id, 'author': author, 'created_at': self.created_at.isoformat()}
+        if self.content:
+            record['content'] = self.content
+        if self.edited_at:
+            record['edited_at'] = self.edited_at.isoformat()
+        if self.attachments:
+            record['attachments'] = [{'id': attachment_id, 'filename': filename, 'url': url} for attachment_id, filename, url in self.attachments]
+        if self.embeds:
+            record['embeds'] = [embed.to_dict() for embed in self.embeds]
+        if self.reactions:
+            record['reactions'] = [{'emoji': emoji, 'count': count} for emoji, count in self.reactions]
+        if self.pinned:
+            record['pinned'] = True
+        if self.tts:
+            record['tts'] = True
+        return record
+
+def queue_message(handler: RecordStorage, record: MessageRecord) -> None:
+    """
+    Queues a message on its channel's store, updating the store's header when the channel or
+    guild was renamed
+    """
+    header = handler.header
+    if header is None or header['channel']['name'] != record.channel_name or header['guild']['name'] != record.guild_name:
+        handler.header = record.header()
+    handler.queue(record.to_dict())
+
+def expand_record(record: dict, header: dict = None) -> dict:
+    """
+    Returns a stored record with its omitted fields filled in, along with the channel and guild
+    from `header`. Records logged before the compact layout come back unchanged.
+    """
+    expanded = {
+        'id': record['id'], 'content': '', 'author': None, 'channel': None, 'guild': None, 'created_at': None, 'edited_at': None,
+        'attachments': [], 'embeds': [], 'reactions': [], 'pinned': False, 'tts': False,
+        **(header or {}), **record,
+    }
+    expanded['author'] = author = dict(record['author'])
+    author.setdefault('discriminator', '0')
+    author.setdefault('bot', False)
+    return expanded
+
+def _set_field(record: dict, field: str, value: Any) -> None:
+    # Empty fields are left out of stored records, the same as `MessageRecord.to_dict` does
+    if value:
+        record[field] = value
+    else:
+        record.pop(field, None)
+
+def apply_edit(data: dict, record: dict) -> dict:
+    """
+    Folds a MESSAGE_UPDATE payload into a stored record, keeping replaced content as a revision
+    """
+    if 'content' in data and data['content'] != record.get('content', ''):
+        record.setdefault('revisions', []).append({'content': record.get('content', ''), 'edited_at': record.get('edited_at') or record['created_at']})
+        record['content'] = data['content']
+    if data.get('edited_timestamp'):
+        record['edited_at'] = datetime.fromisoformat(data['edited_timestamp']).isoformat()
+    if 'embeds' in data:
+        _set_field(record, 'embeds', data['embeds'])
+    if 'attachments' in data:
+        _set_field(record, 'attachments', [
+            {'id': int(attachment['id']), 'filename': attachment['filename'], 'url': attachment['url']}
+            for attachment in data['attachments']
+        ])
+    if 'pinned' in data:
+        _set_field(record, 'pinned', data['pinned'])
+    return record
+
+def apply_delete(deleted_at: str, record: dict) -> dict:
+    record['deleted_at'] = deleted_at
+    return record
+
+def apply_reaction(emoji: Optional[str], delta: int, record: dict) -> dict:
+    """
+    Adjusts the stored count for `emoji` by `delta`; a delta of 0 clears it, or every reaction when `emoji` is None
+    """
+    reactions = record.get('reactions', [])
+    if emoji is None:
+        reactions = []
+    elif delta == 0:
+        reactions = [reaction for reaction in reactions if reaction['emoji'] != emoji]
+    else:
+        for reaction in reactions:
+            if reaction['emoji'] == emoji:
+                reaction['count'] += delta
+                break
+        else:
+            reactions.append({'emoji': emoji, 'count': delta})
+        reactions = [reaction for reaction in reactions if reaction['count'] > 0]
+    _set_field(record, 'reactions', reactions)
+    return record
@@ -0,0 +1,279 @@
+from array import array
+import asyncio
+from bisect import bisect_left
+from datetime import datetime
+import heapq
+from itertools import islice
+import json
+import os
+from pathlib import Path
+import re
+from typing import Any, Optional, TextIO
+
+from config.settings import DATA_DIR
+from core.metrics import metrics
+
+__all__ = ['SearchIndex', 'tokenize']
+
+_word = re.compile(r'\w{2,}')
+
+
+def tokenize(text: str, limit: int = 128) -> list:
+    """
+    Splits text into the distinct lowercase terms that are indexed, capped at `limit`
+    """
+    terms = dict.fromkeys(word[:32] for word in _word.findall(text.lower()))
+    return list(terms)[:limit]
+
+
+class SearchIndex:
+    """
+    Inverted index over the messages logged for one guild.
+
+    Documents are stored column-wise in arrays by position, and every term maps to an array of the
+    positions that contain it. Authors and channels are indexed as the pseudo-terms `a:{id}` and
+    `c:{id}`, which cannot collide with real terms. Changes are appended to a log that is replayed
+    by `load`, so the index is maintained incrementally and never rebuilt from the message logs.
+    `compact` rewrites the log without removed messages and rebuilds the arrays from it, so the
+    text of expired messages does not outlive them; `needs_compaction` tells when edits and
+    removals have left enough dead entries to make that worthwhile.
+
+    Positions follow the order messages were indexed, which is also their time order until older
+    messages are backfilled. `search` walks positions backwards while that holds, and otherwise
+    picks the newest matches by timestamp.
+    """
+
+    filename: str
+    filepath: Path
+    lock: asyncio.Lock
+    loop: asyncio.AbstractEventLoop
+    loaded: bool
+    compact_ratio: float
+    compact_min: int
+    _ordered: bool
+    _ids: array
+    _channels: array
+    _authors: array
+    _times: array
+    _positions: dict
+    _postings: dict
+    _removed: set
+    _pending: list
+    _backlog: list
+    _changes: Optional[list]
+    _file: Optional[TextIO]
+
+    def __init__(self, filename: str, *args, compact_ratio: float = 0.5, compact_min: int = 10000, **kwargs):
+        self.filename = DATA_DIR / filename
+        self.filepath = Path(self.filename)
+        self.lock = asyncio.Lock()
+        self.loop = kwargs.pop('loop', None) or asyncio.get_running_loop()
+        self.loaded = False
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._ordered = True
+        self._ids, self._channels, self._authors, self._times = array('Q'), array('Q'), array('Q'), array('d')
+        self._positions, self._postings, self._removed = {}, {}, set()
+        self._pending, self._backlog = [], []
+        self._changes = None
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self._ids) - len(self._removed)
+
+    @property
+    def needs_compaction(self) -> bool:
+        return len(self._removed) >= self.compact_min and len(self._removed) >= len(self._ids) * self.compact_ratio
+
+    def _apply(self, entry: list) -> None:
+        if len(entry) == 1:
+            position = self._positions.get(entry[0])
+            if position is not None:
+                self._removed.add(position)
+            return
+        message_id, channel_id, author_id, timestamp, terms = entry
+        previous = self._positions.get(message_id)
+        if previous is not None:
+            self._removed.add(previous)
+        position = len(self._ids)
+        if position and timestamp < self._times[-1]:
+            self._ordered = False
+        self._positions[message_id] = position
+        self._ids.append(message_id)
+        self._channels.append(channel_id)
+        self._authors.append(author_id)
+        self._times.append(timestamp)
+        for term in (*terms, f'a:{author_id}', f'c:{channel_id}'):
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array('I')
+            postings.append(position)
+
+    def s_load(self) -> None:
+        if not self.filepath.exists():
+            return
+        with self.filepath.open('r', encoding='utf-8') as file:
+            for line in file:
+                if line.endswith('\n'):
+                    self._apply(json.loads(line))
+
+    def s_write(self, entries: list) -> None:
+        if self._file is None:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.filepath.open('a', encoding='utf-8')
+        self._file.writelines(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n' for entry in entries)
+        self._file.flush()
+
+    def s_close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def s_compact(self, compacted: 'SearchIndex') -> None:
+        """
+        Rewrites the log with the latest entry of every message still indexed, applying each to
+        the empty index `compacted`
+        """
+        live = {}
+        if self.filepath.exists():
+            with self.filepath.open('r', encoding='utf-8') as file:
+                for line in file:
+                    if line.endswith('\n'):
+                        entry = json.loads(line)
+                        # Re-adding a message moves it to the end, as it does in memory
+                        live.pop(entry[0], None)
+                        if len(entry) > 1:
+                            live[entry[0]] = entry
+        temp_filepath = self.filepath.with_suffix('.tmp')
+        with temp_filepath.open('w', encoding='utf-8') as file:
+            for entry in live.values():
+                compacted._apply(entry)
+                file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.s_close()
+        os.replace(temp_filepath, self.filepath)
+
+    async def load(self) -> None:
+        """
+        Replays the index log, applying anything that arrived while it was being read
+        """
+        if self.loaded:
+            return
+        async with self.lock:
+            await metrics.run_in_executor(self.loop, 'executor.SearchIndex.s_load', self.s_load)
+            for entry in self._backlog:
+                self._apply(entry)
+            self._backlog = []
+            self.loaded = True
+
+    def _record(self, entry: list) -> None:
+        self._pending.append(entry)
+        if self._changes is not None:
+            self._changes.append(entry)
+        if self.loaded:
+            self._apply(entry)
+        else:
+            self._backlog.append(entry)
+
+    def add(self, message_id: int, channel_id: int, author_id: int, created_at: datetime, text: str) -> None:
+        """
+        Indexes one message; called from the ingest path so it only touches memory
+        """
+        self._record([message_id, channel_id, author_id, created_at.timestamp(), tokenize(text)])
+
+    def remove(self, message_id: int) -> None:
+        self._record([message_id])
+
+    async def _write_pending(self) -> None:
+        entries, self._pending = self._pending, []
+        try:
+            await metrics.run_in_executor(self.loop, 'executor.SearchIndex.s_write', self.s_write, entries)
+        except Exception:
+            self._pending[:0] = entries
+            raise
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        async with self.lock:
+            if self._pending:
+                await self._write_pending()
+
+    async def compact(self) -> None:
+        """
+        Drops removed messages from the log and from memory. Changes made while the log is
+        rewritten are applied to the compacted index once it replaces the current one.
+        """
+        if not self.loaded or not self._removed:
+            return
+        async with self.lock:
+            if self._pending:
+                await self._write_pending()
+            compacted = SearchIndex(self.filepath, loop=self.loop, compact_ratio=self.compact_ratio, compact_min=self.compact_min)
+            self._changes = []
+            try:
+                await metrics.run_in_executor(self.loop, 'executor.SearchIndex.s_compact', self.s_compact, compacted)
+            finally:
+                changes, self._changes = self._changes, None
+            self._ids, self._channels, self._authors, self._times = compacted._ids, compacted._channels, compacted._authors, compacted._times
+            self._positions, self._postings, self._removed = compacted._positions, compacted._postings, compacted._removed
+            self._ordered = compacted._ordered
+            for entry in changes:
+                self._apply(entry)
+
+    async def close(self) -> None:
+        await self.flush()
+        async with self.lock:
+            await metrics.run_in_executor(self.loop, 'executor.SearchIndex.s_close', self.s_close)
+
+    def search(self, terms: list = (), author_id: int = None, channel_id: int = None, after: datetime = None, before: datetime = None, limit: int = 100) -> list:
+        """
+        Returns `(message_id, channel_id)` pairs for up to `limit` matching messages, newest first.
+
+        Every term must match. Posting lists are sorted, so candidates from the shortest list are
+        checked against the others by binary search and the cost follows the rarest term rather
+        than the size of the log. Once backfilled messages have put positions out of time order,
+        every candidate is ranked by its timestamp instead of stopping at the first `limit`.
+        """
+        if not self.loaded:
+            return []
+        keys = [*terms]
+        if author_id is not None:
+            keys.append(f'a:{author_id}')
+        if channel_id is not None:
+            keys.append(f'c:{channel_id}')
+        if keys:
+            postings = [self._postings.get(key) for key in keys]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = postings[0]
+            for other in postings[1:]:
+                candidates = [position for position in candidates if self._contains(other, position)]
+                if not candidates:
+                    return []
+        else:
+            candidates = range(len(self._ids))
+        start = after.timestamp() if after else None
+        end = before.timestamp() if before else None
+        matches = (position for position in reversed(candidates) if self._matches(position, start, end))
+        if self._ordered:
+            positions = list(islice(matches, limit))
+        else:
+            positions = heapq.nlargest(limit, matches, key=self._times.__getitem__)
+        return [(self._ids[position], self._channels[position]) for position in positions]
+
+    def _matches(self, position: int, start: Optional[float], end: Optional[float]) -> bool:
+        if position in self._removed:
+            return False
+        timestamp = self._times[position]
+        return (start is None or timestamp >= start) and (end is None or timestamp <= end)
+
+    @staticmethod
+    def _contains(postings: array, position: int) -> bool:
+        index = bisect_left(postings, position)
+        return index < len(postings) and postings[index] == position
+
+    def stats(self) -> dict[str, Any]:
+        return {'documents': len(self), 'terms': len(self._postings)}
@@ -0,0 +1,266 @@
+import json
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Callable, Iterator, Optional
+
+from config.settings import DATA_DIR
+from core.storage import RecordStorage
+
+__all__ = ['SQLiteDatabase', 'SQLiteLineHandler']
+
+
+class SQLiteDatabase:
+    """
+    A shared SQLite connection in WAL mode.
+
+    Every handler for the same database file shares one connection, serialised through `lock`
+    since handlers run their statements from executor threads.
+    """
+
+    _databases: dict = {}
+    _opening = threading.Lock()
+
+    filepath: Path
+    connection: sqlite3.Connection
+    lock: threading.Lock
+    users: int
+
+    def __init__(self, filepath: Path):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.users = 0
+
+    @classmethod
+    def open(cls, filename: str) -> 'SQLiteDatabase':
+        filepath = DATA_DIR / filename
+        # Handlers are opened from executor threads, which must not race to connect twice
+        with cls._opening:
+            database = cls._databases.get(filepath)
+            if database is None:
+                filepath.parent.mkdir(parents=True, exist_ok=True)
+                database = cls._databases[filepath] = cls(filepath)
+            database.users += 1
+        return database
+
+    def release(self) -> None:
+        with self._opening:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self._databases.pop(self.filepath, None)
+        with self.lock:
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.connection.close()
+
+    def execute(self, sql: str, parameters: tuple = ()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def execute_many(self, statements: list) -> None:
+        """
+        Runs `(sql, rows)` pairs with executemany inside a single transaction
+        """
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for sql, rows in statements:
+                    self.connection.executemany(sql, rows)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+
+class SQLiteLineHandler(RecordStorage):
+    """
+    Record store backed by one table of a shared SQLite database.
+
+    Each handler sees the rows of its own `scope` (for Overwatch, a channel), and the primary key
+    is `(scope, key)` so the same key may be stored under several scopes. Records are kept as
+    JSON alongside the key, the scope and any `columns`, which map a column name to a
+    callable extracting its value from a record. Every extracted column is indexed. The `header`
+    of each scope is kept once in a `{table}_headers` table.
+
+    `expire` deletes rows in batches, by `time_field` for the age limit and in insertion order for
+    the size limit, which is measured on the stored JSON and worked out once per pass. Freed pages
+    are reused by later writes rather than returned to the filesystem.
+    """
+
+    database: SQLiteDatabase
+    table: str
+    scope: Any
+    columns: dict
+    time_field: Optional[str]
+    _stored_header: Optional[dict]
+    _excess: Optional[int]
+
+    def __init__(self, filename: str, table: str, scope: Any, key_name: str, *args, columns: dict[str, Callable[[dict], Any]] = None, time_field: str = None, **kwargs):
+        super().__init__(key_name, *args, **kwargs)
+        self.database = SQLiteDatabase.open(filename)
+        self.table = table
+        self.scope = scope
+        self.columns = columns or {}
+        self.time_field = time_field
+        self._create_table()
+        rows = self.database.execute(f'SELECT data FROM {self.table}_headers WHERE scope = ?', (self.scope,))
+        self.header = self._stored_header = json.loads(rows[0][0]) if rows else None
+        self._excess = None
+
+    @property
+    def name(self) -> str:
+        return f'{self.table}:{self.scope}'
+
+    def _create_table(self):
+        extra = ''.join(f', {column}' for column in self.columns)
+        self.database.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key NOT NULL, scope NOT NULL{extra}, data TEXT NOT NULL, PRIMARY KEY (scope, key))')
+        for column in ('scope', *self.columns):
+            self.database.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_{column} ON {self.table} ({column})')
+        self.database.execute(f'CREATE TABLE IF NOT EXISTS {self.table}_headers (scope PRIMARY KEY, data TEXT NOT NULL)')
+
+    def _row(self, record: dict) -> tuple:
+        return (
+            record[self.key_name],
+            self.scope,
+            *(extract(record) for extract in self.columns.values()),
+            json.dumps(record, ensure_ascii=False, separators=(',', ':')),
+        )
+
+    def _write(self, statements: list) -> None:
+        """
+        Runs `statements` in one transaction, storing the header as well if it changed
+        """
+        header = self.header
+        if header is not None and header != self._stored_header:
+            statements.append((f'INSERT OR REPLACE INTO {self.table}_headers VALUES (?, ?)', [(self.scope, json.dumps(header, ensure_ascii=False))]))
+        self.database.execute_many(statements)
+        if header is not None:
+            self._stored_header = header
+
+    def _insert(self, replace: bool) -> str:
+        """
+        Inserts rows, either skipping stored keys or updating them in place. Updates keep the
+        rowid, which orders rows by when they were first stored for scans and size-based expiry.
+        """
+        placeholders = ', '.join('?' * (len(self.columns) + 3))
+        if not replace:
+            return f'INSERT OR IGNORE INTO {self.table} VALUES ({placeholders})'
+        assignments = ', '.join(f'{column} = excluded.{column}' for column in (*self.columns, 'data'))
+        return f'INSERT INTO {self.table} VALUES ({placeholders}) ON CONFLICT (scope, key) DO UPDATE SET {assignments}'
+
+    def _column(self, key: Any) -> str:
+        key = key or self.key_name
+        if key == self.key_name:
+            return 'key'
+        if key in self.columns:
+            return key
+        return f"json_extract(data, '$.{key}')"
+
+    def _where(self, key: Any) -> str:
+        return f'{self._column(key)} = ?'
+
+    def s_has(self, value: Any) -> bool:
+        return bool(self.database.execute(f'SELECT 1 FROM {self.table} WHERE scope = ? AND key = ?', (self.scope, value)))
+
+    def _is_stored(self, value: Any) -> bool:
+        # Duplicates are dropped by INSERT OR IGNORE when the batch is written
+        return False
+
+    def s_get(self, key: Any = None, value: Any = None) -> dict:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        rows = self.database.execute(f'SELECT data FROM {self.table} WHERE scope = ? AND {self._where(key)} LIMIT 1', (self.scope, value))
+        return json.loads(rows[0][0]) if rows else None
+
+    def s_get_all(self, key: Any = None, value: Any = None) -> list:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        rows = self.database.execute(f'SELECT data FROM {self.table} WHERE scope = ? AND {self._where(key)} ORDER BY rowid', (self.scope, value))
+        return [json.loads(data) for data, in rows]
+
+    def s_read(self) -> list:
+        rows = self.database.execute(f'SELECT data FROM {self.table} WHERE scope = ? ORDER BY rowid', (self.scope,))
+        return [json.loads(data) for data, in rows]
+
+    def s_scan(self, start: datetime = None, end: datetime = None) -> Iterator[dict]:
+        clauses, parameters = ['scope = ?'], [self.scope]
+        if self.time_field and start:
+            clauses.append(f'{self._column(self.time_field)} >= ?')
+            parameters.append(start.isoformat())
+        if self.time_field and end:
+            clauses.append(f'{self._column(self.time_field)} <= ?')
+            parameters.append(end.isoformat())
+        last = None
+        while True:
+            # Page by rowid so the shared connection is not held for the whole scan
+            rows = self.database.execute(
+                f'SELECT rowid, data FROM {self.table} WHERE {" AND ".join(clauses)}{" AND rowid > ?" if last else ""} ORDER BY rowid LIMIT 500',
+                (*parameters, last) if last else tuple(parameters),
+            )
+            if not rows:
+                return
+            for last, data in rows:
+                yield json.loads(data)
+
+    def s_add_many(self, records: list) -> None:
+        self._write([(self._insert(not self.unique_only), [self._row(record) for record in records])])
+
+    def s_update(self, key: Any = None, value: Any = None, data: dict = None) -> None:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        statements = []
+        if (key or self.key_name) != self.key_name or value != data[self.key_name]:
+            statements.append((f'DELETE FROM {self.table} WHERE scope = ? AND {self._where(key)}', [(self.scope, value)]))
+        statements.append((self._insert(True), [self._row(data)]))
+        self._write(statements)
+
+    def s_update_many(self, records: list) -> None:
+        self._write([(self._insert(True), [self._row(record) for record in records])])
+
+    def s_remove(self, key: Any = None, value: Any = None) -> None:
+        if value is None:
+            raise ValueError('Value cannot be None')
+        self.database.execute(f'DELETE FROM {self.table} WHERE scope = ? AND {self._where(key)}', (self.scope, value))
+
+    def s_clear(self) -> None:
+        self.database.execute_many([
+            (f'DELETE FROM {self.table} WHERE scope = ?', [(self.scope,)]),
+            (f'DELETE FROM {self.table}_headers WHERE scope = ?', [(self.scope,)]),
+        ])
+        self._stored_header = None
+
+    def _delete_rows(self, rows: list) -> tuple[list, int, bool]:
+        self.database.execute_many([(f'DELETE FROM {self.table} WHERE rowid = ?', [(rowid,) for rowid, _, _ in rows])])
+        return [key for _, key, _ in rows], sum(length for _, _, length in rows), False
+
+    def s_expire(self, before: Optional[datetime], max_bytes: Optional[int], limit: int) -> tuple[list, int, bool]:
+        if before is not None and self.time_field:
+            rows = self.database.execute(
+                f'SELECT rowid, key, length(data) FROM {self.table} WHERE scope = ? AND {self._column(self.time_field)} < ? LIMIT ?',
+                (self.scope, before.isoformat(), limit),
+            )
+            if rows:
+                return self._delete_rows(rows)
+        if max_bytes:
+            if self._excess is None:
+                total, = self.database.execute(f'SELECT COALESCE(SUM(length(data)), 0) FROM {self.table} WHERE scope = ?', (self.scope,))[0]
+                self._excess = total - max_bytes
+            if self._excess > 0:
+                rows = self.database.execute(f'SELECT rowid, key, length(data) FROM {self.table} WHERE scope = ? ORDER BY rowid LIMIT ?', (self.scope, limit))
+                expired = []
+                for row in rows:
+                    if self._excess <= 0:
+                        break
+                    expired.append(row)
+                    self._excess -= row[2]
+                if expired:
+                    return self._delete_rows(expired)
+        self._excess = None
+        return [], 0, True
+
+    def s_close(self) -> None:
+        self.database.release()
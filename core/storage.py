@@ -0,0 +1,400 @@
+from abc import ABC, abstractmethod
+import asyncio
+from datetime import datetime
+from functools import partial
+from itertools import islice
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from config.settings import DATA_BACKEND
+from core.metrics import metrics, timed_method
+
+__all__ = ['DocumentStorage', 'RecordStorage', 'open_record_storage']
+
+
+class DocumentStorage(ABC):
+    """
+    Storage for a single keyed document, such as bot configuration.
+    """
+
+    @abstractmethod
+    async def read(self) -> Any: ...
+
+    @abstractmethod
+    async def write(self, data: Any) -> None: ...
+
+    @abstractmethod
+    async def get(self, key: str) -> Any: ...
+
+    @abstractmethod
+    async def update(self, key: str, value: Any) -> None: ...
+
+    @abstractmethod
+    async def remove(self, key: str) -> None: ...
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+    @abstractmethod
+    async def flush(self) -> None: ...
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class RecordStorage(ABC):
+    """
+    Storage for records identified by `key_name`.
+
+    Backends implement the synchronous `s_*` methods, which are run in the executor under `lock`.
+    This base class provides the async API and the write buffer: `queue` collects records in
+    memory and a background flusher hands them to `s_add_many` in batches. Changes to stored
+    records are buffered the same way by `queue_modify` and applied by `s_modify_many` once the
+    pending records have been written.
+
+    `header` holds metadata shared by every record of the store, such as the channel a message log
+    belongs to. Backends store it once per file or segment rather than with every record, and load
+    the latest one back when the store is opened.
+
+    A `scan` releases the lock between batches, so while one is in progress compaction, expiry and
+    segment rotation are put off: moving records around underneath it would make it skip them.
+    """
+
+    key_name: str
+    header: Optional[dict]
+    lock: asyncio.Lock
+    loop: asyncio.AbstractEventLoop
+    unique_only: bool
+    flush_interval: float
+    flush_size: int
+    idle_timeout: float
+    _pending: list
+    _queued: set
+    _modifications: dict[Any, list[Callable[[dict], dict]]]
+    _flusher: Optional[asyncio.Task]
+    _stopping: bool
+    _scans: int
+
+    def __init__(self, key_name: str, *args, unique_only: bool = False, flush_interval: float = 1.0, flush_size: int = 500, idle_timeout: float = 300.0, **kwargs):
+        self.key_name = key_name
+        self.header = None
+        self.lock = asyncio.Lock()
+        self.loop = kwargs.pop('loop', None) or asyncio.get_running_loop()
+        self.unique_only = unique_only
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.idle_timeout = idle_timeout
+        self._pending = []
+        self._queued = set()
+        self._modifications = {}
+        self._last_write = time.monotonic()
+        self._flush_event = asyncio.Event()
+        self._flusher = None
+        self._stopping = False
+        self._scans = 0
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    @property
+    def scanning(self) -> bool:
+        return self._scans > 0
+
+    @abstractmethod
+    def s_has(self, value: Any) -> bool: ...
+
+    @abstractmethod
+    def s_get(self, key: Any = None, value: Any = None) -> dict: ...
+
+    @abstractmethod
+    def s_get_all(self, key: Any = None, value: Any = None) -> list: ...
+
+    @abstractmethod
+    def s_read(self) -> list: ...
+
+    @abstractmethod
+    def s_scan(self, start: datetime = None, end: datetime = None) -> Iterator[dict]: ...
+
+    @abstractmethod
+    def s_add_many(self, records: list) -> None: ...
+
+    @abstractmethod
+    def s_update(self, key: Any = None, value: Any = None, data: dict = None) -> None: ...
+
+    @abstractmethod
+    def s_remove(self, key: Any = None, value: Any = None) -> None: ...
+
+    @abstractmethod
+    def s_clear(self) -> None: ...
+
+    def s_update_many(self, records: list) -> None:
+        for record in records:
+            self.s_update(self.key_name, record[self.key_name], record)
+
+    def s_modify_many(self, modifications: dict[Any, list[Callable[[dict], dict]]]) -> int:
+        """
+        Applies each record's queued changes in order and writes the results, skipping records
+        that are not stored; returns how many records were changed
+        """
+        records = []
+        for value, changes in modifications.items():
+            record = self.s_get(self.key_name, value)
+            if record is None:
+                continue
+            for change in changes:
+                record = change(record)
+            records.append(record)
+        if records:
+            self.s_update_many(records)
+        return len(records)
+
+    def s_add(self, data: dict) -> None:
+        self.s_add_many([data])
+
+    def _is_stored(self, value: Any) -> bool:
+        """
+        Duplicate check used by `queue` on the event loop, so it must not block
+        """
+        return self.s_has(value)
+
+    def s_needs_compaction(self) -> bool:
+        return False
+
+    def s_compact(self) -> int:
+        return 0
+
+    def s_expire(self, before: Optional[datetime], max_bytes: Optional[int], limit: int) -> tuple[list, int, bool]:
+        """
+        Takes one bounded step towards removing the records older than `before` and the oldest
+        records beyond `max_bytes`, examining at most about `limit` records. Returns the keys of
+        the records removed, the bytes reclaimed and whether there is nothing left to remove.
+        """
+        return [], 0, True
+
+    def s_idle(self) -> None:
+        """
+        Called from the flusher once nothing has been written for a while
+        """
+
+    def s_close(self) -> None:
+        """
+        Releases any resources held by the backend
+        """
+
+    async def _run(self, func: Callable, *args) -> Any:
+        return await metrics.run_in_executor(self.loop, f'executor.{type(self).__name__}.{func.__name__}', func, *args)
+
+    @staticmethod
+    def _next_batch(records: Iterator[dict], batch_size: int) -> list:
+        return list(islice(records, batch_size))
+
+    def queue(self, data: dict) -> None:
+        """
+        Buffers a record for the background flusher without touching the disk
+        """
+        value = data[self.key_name]
+        if self.unique_only and (value in self._queued or self._is_stored(value)):
+            return
+        self._queued.add(value)
+        self._pending.append(data)
+        if self._flusher is None:
+            self.start()
+        if len(self._pending) >= self.flush_size:
+            self._flush_event.set()
+
+    def queue_modify(self, value: Any, change: Callable[[dict], dict]) -> None:
+        """
+        Buffers a change to the stored record `value`; `change` receives the current record in the
+        executor and returns its new version
+        """
+        self._modifications.setdefault(value, []).append(change)
+        if self._flusher is None:
+            self.start()
+        if len(self._modifications) >= self.flush_size:
+            self._flush_event.set()
+
+    def start(self) -> None:
+        """
+        Starts the background flusher for queued records
+        """
+        if self._flusher is None or self._flusher.done():
+            self._flusher = self.loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        idle = False
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            if self._stopping:
+                return
+            try:
+                if self._pending or self._modifications:
+                    await self.flush()
+                    idle = False
+                if not self.scanning and self.s_needs_compaction():
+                    await self.compact()
+                if not idle and time.monotonic() - self._last_write > self.idle_timeout:
+                    async with self.lock:
+                        await self._run(self.s_idle)
+                    idle = True
+            except Exception:
+                logging.getLogger('bot').exception(f'Failed to flush {self.name}')
+
+    async def flush(self) -> None:
+        if self._pending:
+            records, self._pending = self._pending, []
+            async with self.lock:
+                try:
+                    await self._run(self.s_add_many, records)
+                    self._last_write = time.monotonic()
+                except Exception:
+                    self._pending[:0] = records
+                    raise
+                finally:
+                    self._queued.difference_update(record[self.key_name] for record in records)
+        if self._modifications:
+            modifications, self._modifications = self._modifications, {}
+            async with self.lock:
+                try:
+                    await self._run(self.s_modify_many, modifications)
+                    self._last_write = time.monotonic()
+                except Exception:
+                    for value, changes in self._modifications.items():
+                        modifications.setdefault(value, []).extend(changes)
+                    self._modifications = modifications
+                    raise
+
+    @timed_method('storage')
+    async def compact(self) -> int:
+        """
+        Runs `s_compact`, unless a scan is in progress; the flusher tries again once it is over
+        """
+        await self.flush()
+        async with self.lock:
+            if self.scanning:
+                return 0
+            return await self._run(self.s_compact)
+
+    @timed_method('storage')
+    async def expire(self, before: datetime = None, max_bytes: int = None, limit: int = 1000) -> tuple[list, int, bool]:
+        """
+        Runs one step of `s_expire`, holding the lock only for that step. While a scan is in
+        progress nothing is removed and the step reports that it is done, so the store is picked
+        up again on the next retention run instead of waiting on the scan.
+        """
+        await self.flush()
+        async with self.lock:
+            if self.scanning:
+                return [], 0, True
+            return await self._run(self.s_expire, before, max_bytes, limit)
+
+    async def close(self) -> None:
+        """
+        Stops the flusher, writes any buffered records and releases the backend. The flusher is
+        asked to stop and awaited rather than cancelled, since cancelling it would release the lock
+        while an executor thread is still writing.
+        """
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            self._stopping = True
+            self._flush_event.set()
+            try:
+                await flusher
+            finally:
+                self._stopping = False
+        await self.flush()
+        async with self.lock:
+            await self._run(self.s_close)
+
+    @timed_method('storage')
+    async def get(self, key: Any = None, value: Any = None) -> dict:
+        await self.flush()
+        async with self.lock:
+            return await self._run(self.s_get, key, value)
+
+    @timed_method('storage')
+    async def get_all(self, key: Any = None, value: Any = None) -> list:
+        await self.flush()
+        async with self.lock:
+            return await self._run(self.s_get_all, key, value)
+
+    @timed_method('storage')
+    async def read(self) -> list:
+        await self.flush()
+        async with self.lock:
+            return await self._run(self.s_read)
+
+    async def scan(self, start: datetime = None, end: datetime = None, batch_size: int = 500) -> AsyncIterator[list]:
+        """
+        Streams stored records in batches, limited to the time window between `start` and `end`
+        """
+        self._scans += 1
+        try:
+            await self.flush()
+            records = self.s_scan(start, end)
+            while True:
+                async with self.lock:
+                    batch = await self._run(self._next_batch, records, batch_size)
+                if not batch:
+                    return
+                yield batch
+        finally:
+            self._scans -= 1
+
+    @timed_method('storage')
+    async def add(self, data: dict) -> None:
+        await self.flush()
+        async with self.lock:
+            await self._run(self.s_add, data)
+            self._last_write = time.monotonic()
+
+    @timed_method('storage')
+    async def update(self, key: Any = None, value: Any = None, data: dict = None) -> None:
+        await self.flush()
+        async with self.lock:
+            await self._run(self.s_update, key, value, data)
+            self._last_write = time.monotonic()
+        self.start()
+
+    @timed_method('storage')
+    async def remove(self, key: Any = None, value: Any = None) -> None:
+        await self.flush()
+        async with self.lock:
+            await self._run(self.s_remove, key, value)
+            self._last_write = time.monotonic()
+        self.start()
+
+    @timed_method('storage')
+    async def clear(self) -> None:
+        self._pending = []
+        self._queued.clear()
+        self._modifications = {}
+        async with self.lock:
+            await self._run(self.s_clear)
+
+
+async def open_record_storage(name: str, scope: Any, key_name: str, *args, backend: str = None, columns: dict = None, segment_size: int = None, segment_age: float = None, **kwargs) -> RecordStorage:
+    """
+    Opens the record store `scope` within the dataset `name` using the configured backend.
+
+    The JSON backend keeps one `{name}/{scope}.json1` log per scope, split into segments when
+    `segment_size` or `segment_age` is given. The SQLite backend keeps every scope of a dataset in
+    one `{name}.sqlite3` database with `columns` extracted and indexed. Opening a store loads its
+    index from disk, so it is done in the executor.
+    """
+    loop = kwargs['loop'] = kwargs.get('loop') or asyncio.get_running_loop()
+    backend = backend or DATA_BACKEND
+    if backend == 'json':
+        from core.handler import JSONLineHandler
+        factory = partial(JSONLineHandler, f'{name}/{scope}.json1', key_name, *args, segment_size=segment_size, segment_age=segment_age, **kwargs)
+    elif backend == 'sqlite':
+        from core.sqlite import SQLiteLineHandler
+        factory = partial(SQLiteLineHandler, f'{name}.sqlite3', name, scope, key_name, *args, columns=columns, **kwargs)
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    return await metrics.run_in_executor(loop, f'executor.{factory.func.__name__}.open', factory)
@@ -1,11 +1,8 @@
-import asyncio 
-from core.bot import Bot
-
-bot = Bot()
-
-async def main():
-    async with bot:
-        await bot.start()
-
-if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+from config.settings import CLUSTER_PROCESSES, SHARD_COUNT
+from core.cluster import Cluster, run_bot
+
+if __name__ == '__main__':
+    if CLUSTER_PROCESSES > 1:
+        Cluster(CLUSTER_PROCESSES, SHARD_COUNT).run()
+    else:
+        run_bot()
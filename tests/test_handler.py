@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'test')
+os.environ['DATA_DIR'] = tempfile.mkdtemp()
+
+from core.handler import JSONLineHandler
+
+
+class SegmentedLogTests(unittest.IsolatedAsyncioTestCase):
+    """
+    Removed records must stay removed once the index has to be rebuilt from the segments
+    """
+
+    def open(self, filename: str) -> JSONLineHandler:
+        return JSONLineHandler(filename, 'id', unique_only=True, segment_size=3000, time_field='created_at', compact_min_bytes=100)
+
+    async def reopen(self, handler: JSONLineHandler) -> JSONLineHandler:
+        await handler.close()
+        handler.indexpath.unlink()
+        return self.open(handler.filepath.relative_to(os.environ['DATA_DIR']))
+
+    async def test_rebuild_after_compaction(self):
+        handler = self.open('compacted.json1')
+        for i in range(60):
+            handler.queue({'id': i, 'created_at': '2024-01-01', 'content': 'y' * 20})
+        await handler.flush()
+        handler.queue({'id': 1000, 'created_at': '2024-01-01', 'content': 'z'})
+        await handler.flush()
+        self.assertGreater(len(handler.segments), 1)
+        await handler.remove(value=5)
+        for j in range(30):
+            await handler.update(value=1000, data={'id': 1000, 'created_at': '2024-01-01', 'content': 'z' * j})
+        self.assertGreater(await handler.compact(), 0)
+        self.assertIsNone(await handler.get(value=5))
+        handler = await self.reopen(handler)
+        self.assertIsNone(await handler.get(value=5))
+        self.assertEqual((await handler.get(value=1000))['content'], 'z' * 29)
+        await handler.close()
+
+    async def test_rebuild_after_expiry(self):
+        handler = self.open('expired.json1')
+        for i in range(60):
+            handler.queue({'id': i, 'created_at': '2030-01-01', 'content': 'y' * 20})
+        await handler.flush()
+        await handler.remove(value=5)
+        for i in range(100, 160):
+            handler.queue({'id': i, 'created_at': '2020-01-01', 'content': 'y' * 20})
+        await handler.flush()
+        handler.queue({'id': 1000, 'created_at': '2030-01-01'})
+        await handler.flush()
+        self.assertEqual(len(handler.segments), 3)
+        before = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        while not (await handler.expire(before=before))[2]:
+            pass
+        self.assertIsNone(await handler.get(value=100))
+        handler = await self.reopen(handler)
+        self.assertIsNone(await handler.get(value=5))
+        self.assertIsNone(await handler.get(value=100))
+        self.assertIsNotNone(await handler.get(value=6))
+        await handler.close()
+
+    async def test_compaction_during_scan(self):
+        handler = self.open('scanned.json1')
+        for i in range(2000):
+            handler.queue({'id': i, 'created_at': '2020-01-01', 'content': 'y' * 20})
+        await handler.flush()
+        for i in range(1500):
+            handler.queue_modify(i, lambda record: {**record, 'content': 'edited'})
+        await handler.flush()
+        self.assertTrue(handler.s_needs_compaction())
+        seen = set()
+        async for batch in handler.scan(batch_size=50):
+            if not seen:
+                self.assertEqual(await handler.compact(), 0)
+                self.assertEqual(await handler.expire(before=datetime(2021, 1, 1, tzinfo=timezone.utc)), ([], 0, True))
+                segments = len(handler.segments)
+                await handler.add({'id': 5000, 'created_at': '2020-01-01'})
+                self.assertEqual(len(handler.segments), segments)
+            seen.update(record['id'] for record in batch)
+        self.assertTrue(seen.issuperset(range(2000)))
+        self.assertGreater(await handler.compact(), 0)
+        await handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()